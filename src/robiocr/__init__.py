@@ -0,0 +1,44 @@
+""" Extract the measurements of Robi scales from the images the Fitdays app shares.
+
+    from robiocr import MeasurementExtractor
+
+    result = MeasurementExtractor().extract(jpeg_bytes, image_name="IMG_1234.jpeg")
+"""
+from robiocr.extract_fitdays import (
+    DEFAULT_RECIPES,
+    ExtractionResult,
+    MeasurementExtractor,
+    PreprocessingEngine,
+    PreprocessingRecipe,
+    decode_image,
+    default_sinks,
+    load_recipes,
+)
+from robiocr.fitdays_database import MeasurementDatabase
+from robiocr.fitdays_ocr import OcrLine, Word, ocr_lines
+from robiocr.fitdays_profiles import MeasurementProfile, ProfileRegistry
+from robiocr.fitdays_record import MeasurementRecord, RecordSchema
+from robiocr.fitdays_sinks import CsvSink, DatabaseCopySink, ExcelSink, Sink
+
+__all__ = [
+    "DEFAULT_RECIPES",
+    "CsvSink",
+    "DatabaseCopySink",
+    "ExcelSink",
+    "ExtractionResult",
+    "MeasurementDatabase",
+    "MeasurementExtractor",
+    "MeasurementProfile",
+    "MeasurementRecord",
+    "OcrLine",
+    "PreprocessingEngine",
+    "PreprocessingRecipe",
+    "ProfileRegistry",
+    "RecordSchema",
+    "Sink",
+    "Word",
+    "decode_image",
+    "default_sinks",
+    "load_recipes",
+    "ocr_lines",
+]
@@ -1,422 +1,1189 @@
 """ Reads jpg with data that Robi scales produce and extracts the data from it.
+
+MeasurementExtractor is the one extraction engine of robiocr, used by the
+command line, the upload service and the tuner. Its stages can be replaced:
+
+- decode: turns the bytes of an image into an OpenCV image (decode_image)
+- OCR backend: returns the lines of words with confidences of an image (ocr_lines)
+- parse: the profile registry, which picks the profile of an image and matches
+  the measurements in the OCR lines
+- sinks: outputs besides the database (fitdays_sinks)
 """
+import argparse
+import io
 import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import sqlite3
-import pytesseract
-# from PIL import Image
-import cv2
-# import numpy as np
 from os import listdir
 from os.path import isfile, join
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
 
-SQLITE_DB = "/Volumes/backup/sqlite/fitdays_health_data.db"
+import cv2
+import numpy as np
+from PIL import Image
+import sqlite3
+
+from robiocr.fitdays_archive import ArchiveReader, BundleWriter, image_name, split_path
+from robiocr.fitdays_database import MeasurementDatabase
+from robiocr.fitdays_fingerprint import FingerprintIndex, file_hash, fingerprint
+from robiocr.fitdays_header import DATE_FORMAT, exif_date, parse_header
+from robiocr.fitdays_io import BackgroundIO
+from robiocr.fitdays_jobs import Job, JobQueue
+from robiocr.fitdays_memory import MemoryBudget, MemoryBudgetExceeded, release_memory
+from robiocr.fitdays_ocr import OcrLine, Word, lines_to_text, ocr_lines
+from robiocr.fitdays_profiles import DEFAULT_REGION_CONFIG, CompiledMeasurement, MeasurementProfile, ProfileRegistry
+from robiocr.fitdays_profiling import MeasurementProfiler
+from robiocr.fitdays_record import MeasurementRecord
+from robiocr.fitdays_sinks import CsvSink, DatabaseCopySink, ExcelSink, Sink
+
+logger = logging.getLogger(__name__)
+
+# Logging of the command line tools
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Constants
+SQLITE_DB = "fitdays_health_data.db"
+SQLITE_COPY_TARGET = "/Volumes/backup/sqlite/fitdays_health_data.db"
 DOWNLOAD_FOLDER = "/Users/marcel-jankrijgsman/Downloads"
-# DOWNLOAD_FOLDER = "/Volumes/backup/Health/Robo S11 shared data"
-# ROBI_IMAGE = "/Users/marcel-jankrijgsman/Downloads/IMG_DF9D52131FAD-1.jpeg"
+BACKUP_FOLDER = "/Volumes/backup/Health/RoboS11Images"
+# Append processed images to rolling zip bundles in BACKUP_FOLDER instead of moving the files
+BUNDLE_BACKUPS = False
+# Profiles that come with the package
+PROFILES_FOLDER = str(Path(__file__).parent / "profiles")
+UNKNOWN_USER = "Unknown"
+# Fields read with a lower OCR confidence (0-100) get a second, targeted OCR pass
+MIN_CONFIDENCE = 60
+# Recipe chain from the tuner (fitdays_tuning.py), DEFAULT_RECIPES are used if the file doesn't exist
+RECIPES_FILE = "recipes.json"
+# Constant subtracted from the local mean by adaptive thresholds
+ADAPTIVE_THRESHOLD_OFFSET = 10
+# Decode images as grayscale and OCR the text region strip by strip, for machines with little RAM
+LOW_MEMORY = False
+# Maximum resident memory of the extractor process in MB, None for no limit
+MEMORY_BUDGET_MB = None
+
+
+class PreprocessingRecipe(NamedTuple):
+    """One way of preparing the text region for an OCR attempt."""
+    name: str
+    color_conversion: Optional[int] = cv2.COLOR_BGR2GRAY
+    xscale: float = 1.0
+    yscale: float = 1.0
+    apply_threshold: bool = False
+    threshold_type: int = cv2.THRESH_BINARY + cv2.THRESH_OTSU
+    psm: Optional[int] = None
+    # Kernel size of a Gaussian blur after scaling, 0 for no blur
+    blur: int = 0
+    # Block size of an adaptive threshold instead of threshold_type, 0 for a global threshold
+    adaptive_block: int = 0
+
+    @property
+    def tesseract_config(self) -> str:
+        return f"--psm {self.psm}" if self.psm is not None else ""
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Recipe as JSON-serializable values, with the color conversion by its OpenCV name."""
+        values = self._asdict()
+        if self.color_conversion is not None:
+            values["color_conversion"] = next(
+                name for name in dir(cv2) if name.startswith("COLOR_BGR2") and getattr(cv2, name) == self.color_conversion
+            )
+        return values
+
+    @classmethod
+    def from_dict(cls, values: Dict[str, Any]) -> "PreprocessingRecipe":
+        """Recipe from the values of to_dict."""
+        values = dict(values)
+        if isinstance(values.get("color_conversion"), str):
+            values["color_conversion"] = getattr(cv2, values["color_conversion"])
+        return cls(**values)
+
+
+def load_recipes(path: str) -> List[PreprocessingRecipe]:
+    """Load a recipe chain, as written by fitdays_tuning.py.
 
+    Args:
+        path: JSON file with a 'recipes' list
 
-def read_extract_json(measurement_json_file):
-    # open the json file with measurement names
-    with open(measurement_json_file, "r", encoding="utf8") as json_file:
-        # read the file
-        measurement_names = json_file.read()
-        # print the data
-        return json.loads(measurement_names)
+    Returns:
+        Recipes in the order they are tried
+    """
+    with open(path, encoding="utf8") as f:
+        recipes = [PreprocessingRecipe.from_dict(values) for values in json.load(f)["recipes"]]
+    if not recipes:
+        raise ValueError(f"No recipes in {path}")
+    return recipes
+
+
+# OCR attempts for the general measurements, tried in order until the key
+# measurements are found.
+DEFAULT_RECIPES = [
+    PreprocessingRecipe("no processing", psm=6),
+    PreprocessingRecipe("grayscale + 1.5x scaling", xscale=1.5, yscale=1.5, apply_threshold=True),
+    PreprocessingRecipe("grayscale + 2x scaling", xscale=2.0, yscale=2.0, apply_threshold=True),
+    PreprocessingRecipe("gray + x 1.7x, y 1.7x scaling", xscale=1.7, yscale=1.7, apply_threshold=True, psm=6),
+]
+
+
+class PreprocessingEngine:
+    """Prepare the text region of a page once and derive every OCR attempt from it.
+
+    The page is cropped to the text region of the profile layout (the
+    indicator table, without the header, the status column, the segment
+    charts with the body silhouettes and the footer) and blank bands between the table
+    rows are collapsed before anything is rescaled. Color conversions are
+    cached per page and rescaling and thresholding happen in one scratch
+    buffer that is reused across attempts and images.
+    """
 
+    def __init__(
+        self,
+        ink_threshold: int = 160,
+        min_ink_pixels: int = 2,
+        band_padding: int = 8
+    ):
+        """Initialize the engine.
+
+        Args:
+            ink_threshold: Gray value below which a pixel counts as text
+            min_ink_pixels: Number of text pixels a row needs to count as a text row
+            band_padding: Rows of background kept above and below each text line
+        """
+        self.ink_threshold = ink_threshold
+        self.min_ink_pixels = min_ink_pixels
+        self.band_padding = band_padding
+        self._scratch = np.empty(0, dtype=np.uint8)
+        self._region: Optional[np.ndarray] = None
+        self._text_rows: Optional[np.ndarray] = None
+        self._converted: Dict[Optional[int], np.ndarray] = {}
+
+    def load(self, img: np.ndarray, text_region: Tuple[int, int, int, int]) -> None:
+        """Set the page that the next recipes are rendered from.
+
+        Args:
+            img: Decoded BGR or grayscale image
+            text_region: (x_start, x_end, y_start, y_end) of the part of the page with text
+        """
+        x_start, x_end, y_start, y_end = text_region
+        self._region = img[y_start:y_end, x_start:x_end]
+        self._converted = {}
+
+        gray = self._region if self._region.ndim == 2 else cv2.cvtColor(self._region, cv2.COLOR_BGR2GRAY)
+        self._text_rows = self._find_text_rows(gray)
+        self._converted[cv2.COLOR_BGR2GRAY] = gray[self._text_rows]
+
+    def release(self) -> None:
+        """Drop the loaded page and the scratch buffer, so their memory can be given back."""
+        self._region = None
+        self._text_rows = None
+        self._converted = {}
+        self._scratch = np.empty(0, dtype=np.uint8)
+
+    def _find_text_rows(self, gray: np.ndarray) -> np.ndarray:
+        """Return a boolean mask of the rows near text, using a row projection."""
+        ink = np.count_nonzero(gray < self.ink_threshold, axis=1) >= self.min_ink_pixels
+        # Grow every text row by band_padding rows on both sides
+        window = np.ones(2 * self.band_padding + 1, dtype=np.int32)
+        return np.convolve(ink.astype(np.int32), window, mode="same") > 0
+
+    def _get_converted(self, color_conversion: Optional[int]) -> np.ndarray:
+        """Return the compacted text region in the requested color space."""
+        if self._region is None:
+            raise RuntimeError("No page loaded, call load() first")
+        if self._region.ndim == 2:
+            # A page decoded as grayscale has no other color spaces
+            color_conversion = cv2.COLOR_BGR2GRAY
+        if color_conversion not in self._converted:
+            img = self._region[self._text_rows]
+            if color_conversion is not None:
+                img = cv2.cvtColor(img, color_conversion)
+            self._converted[color_conversion] = img
+        return self._converted[color_conversion]
+
+    def render(self, recipe: PreprocessingRecipe) -> np.ndarray:
+        """Render the loaded page according to a recipe.
+
+        The result may be a view of the scratch buffer, so it is only valid
+        until the next call to render.
+        """
+        return self._render(self._get_converted(recipe.color_conversion), recipe)
 
-def get_text_from_image(image):
-    # Get text from image
-    imagetext = pytesseract.image_to_string(image)
-    return imagetext
+    def render_rows(self, recipe: PreprocessingRecipe, y_start: int, y_end: int) -> Tuple[np.ndarray, int]:
+        """Render a horizontal strip of the loaded page according to a recipe.
 
+        Only the strip is scaled and thresholded, so the scratch buffer stays
+        the size of one strip instead of the whole scaled page.
 
-def get_date_from_image(image):
-    """ get_date_from_image
+        Args:
+            recipe: Recipe to render with
+            y_start, y_end: Rows of the strip in the compacted page, before scaling
 
-        This function reads an image from the Fitdays app
-        and first crops it to the top 290 pixels.
-        This is where the username and date and time are located.
+        Returns:
+            Tuple of (rendered strip, its first row in the coordinates of the rendered page);
+            the strip is only valid until the next call to render or render_rows
+        """
+        img = self._get_converted(recipe.color_conversion)
+        y_start, y_end = max(y_start, 0), min(y_end, img.shape[0])
+        return self._render(img[y_start:y_end], recipe), int(round(y_start * recipe.yscale))
 
-    Args:
-        image (str): Name of the image file
+    def render_strips(self, recipe: PreprocessingRecipe, max_block_height: int) -> Iterator[Tuple[np.ndarray, int]]:
+        """Render the loaded page strip by strip, cut at the blank bands between text blocks.
 
-    Returns:
-        str: Username from the image
-        str: Date and time from the image
-    """
-    # First read image with cv2
-    cv2im = cv2.imread(image, cv2.IMREAD_COLOR)
-    # Crop the image to only the top 290 pixels
-    cv2im_top = cv2im[0:290, 0:cv2im.shape[1]]
+        Args:
+            recipe: Recipe to render with
+            max_block_height: Maximum height of a strip before scaling
 
-    # Write the cropped image to a file
-    # cv2.imwrite(f"cv2image_top.jpeg", cv2im_top)
+        Yields:
+            Tuples of (rendered strip, its first row in the coordinates of the rendered page);
+            every strip is only valid until the next one is yielded
+        """
+        img = self._get_converted(recipe.color_conversion)
+        for y_start, y_end in self.split_blocks(img, self.band_padding, max_block_height):
+            yield self.render_rows(recipe, y_start, y_end)
+
+    def _render(self, img: np.ndarray, recipe: PreprocessingRecipe) -> np.ndarray:
+        """Scale, blur and threshold a converted image into the scratch buffer."""
+        # The first step writes into the scratch buffer, the next ones work in place
+        in_scratch = False
+        if recipe.xscale != 1.0 or recipe.yscale != 1.0:
+            height = int(round(img.shape[0] * recipe.yscale))
+            width = int(round(img.shape[1] * recipe.xscale))
+            img = cv2.resize(img, (width, height), dst=self._scratch_view(img, height, width),
+                             interpolation=cv2.INTER_CUBIC)
+            in_scratch = True
+        if recipe.blur:
+            dst = img if in_scratch else self._scratch_view(img, img.shape[0], img.shape[1])
+            img = cv2.GaussianBlur(img, (recipe.blur, recipe.blur), 0, dst=dst)
+            in_scratch = True
+        if recipe.apply_threshold:
+            dst = img if in_scratch else self._scratch_view(img, img.shape[0], img.shape[1])
+            if recipe.adaptive_block:
+                img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                            recipe.adaptive_block, ADAPTIVE_THRESHOLD_OFFSET, dst=dst)
+            else:
+                img = cv2.threshold(img, 127, 255, recipe.threshold_type, dst=dst)[1]
 
-    # Print text from the image
-    image_text = pytesseract.image_to_string(cv2im_top)
-    print(f"Image text: {image_text}")
+        return img
 
-    # Get text from the second line
-    lines = image_text.split("\n")
-    username = lines[0]
-    date_text = lines[1]
-    print(f"Date text: {date_text}")
-    datetime_text = datetime.strptime(date_text,'%H:%M %d/%m/%Y')
-    print(f"Date time text: {datetime_text.strftime('%Y-%m-%d %H:%M:00.000')}")
+    def split_blocks(self, img: np.ndarray, min_gap: int, max_block_height: int) -> List[Tuple[int, int]]:
+        """Split a rendered image into blocks of text rows at blank bands.
 
-    return username, datetime_text.strftime('%Y-%m-%d %H:%M:00.000')
+        Blank bands of at least min_gap rows separate the blocks. Neighbouring
+        blocks are merged as long as they stay under max_block_height, so
+        Tesseract gets a few medium sized inputs instead of many tiny ones.
 
+        Args:
+            img: Rendered image (grayscale, binary or color)
+            min_gap: Minimum height of a blank band between two blocks
+            max_block_height: Maximum height of a merged block
 
-def rework_image(image_name, colourconversion = cv2.COLOR_BGR2GRAY, apply_rescale=True, resize_x=2, resize_y=2,
-                 apply_threshold=True, threshold_type=cv2.THRESH_BINARY + cv2.THRESH_OTSU):
-    """ Rework the image so it can be used for OCR
+        Returns:
+            List of (y_start, y_end) in page order
+        """
+        gray = img if img.ndim == 2 else img.mean(axis=2)
+        ink = np.count_nonzero(gray < self.ink_threshold, axis=1) >= self.min_ink_pixels
+        if not ink.any():
+            return []
+
+        # Start and end of every run of text rows
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], ink.view(np.int8), [0]))))
+        runs = edges.reshape(-1, 2)
+
+        blocks: List[Tuple[int, int]] = []
+        block_start, block_end = int(runs[0][0]), int(runs[0][1])
+        for run_start, run_end in runs[1:]:
+            gap = run_start - block_end
+            if gap >= min_gap and run_end - block_start > max_block_height:
+                blocks.append((block_start, block_end))
+                block_start = int(run_start)
+            block_end = int(run_end)
+        blocks.append((block_start, block_end))
+
+        # Cut halfway through the blank bands, so no block touches its text
+        cuts = [0] + [(end + start) // 2 for (_, end), (start, _) in zip(blocks, blocks[1:])] + [img.shape[0]]
+        return list(zip(cuts[:-1], cuts[1:]))
+
+    def _scratch_view(self, img: np.ndarray, height: int, width: int) -> np.ndarray:
+        """Return a view of the scratch buffer with the given size, growing it if needed."""
+        shape = (height, width) + img.shape[2:]
+        size = int(np.prod(shape))
+        if self._scratch.size < size:
+            self._scratch = np.empty(size, dtype=np.uint8)
+        return self._scratch[:size].reshape(shape)
+
+
+def decode_image(data: bytes, grayscale: bool = False) -> Optional[np.ndarray]:
+    """Decode an encoded image (JPEG or PNG) with OpenCV.
 
     Args:
-        image_name (cv2 image): image to be reworked
-        colourconversion (_type_, optional): _description_. Defaults to cv2.COLOR_BGR2GRAY.
-        rescale (bool, optional): _description_. Defaults to True.
-        resize_x (int, optional): _description_. Defaults to 2.
-        resize_y (int, optional): _description_. Defaults to 2.
+        data: Encoded image
+        grayscale: Decode straight to one channel instead of BGR
 
     Returns:
-        _type_: _description_
-    """    
-    # im = Image.open("IMG_44254DD16026-1.jpeg") # the ROBI image with data
-    cvim = cv2.imread(image_name, cv2.IMREAD_COLOR)
-
-    # Convert colour space of the image (default is to grey)
-    if colourconversion is not None:
-        cvim = cv2.cvtColor(cvim, colourconversion)
-        # cv2.imwrite(f"{image_name}_converted.jpeg", cvim)
-    # Rescale the image, if needed.
-    # imrescaled = cv2.resize(cvim, None, fx=1.5, fy=1.5, interpolation=cv2.INTER_CUBIC)
-    if apply_rescale:
-        cvim = cv2.resize(cvim, None, fx=resize_x, fy=resize_y, interpolation=cv2.INTER_CUBIC)
-        # cv2.imwrite(f"{image_name}_rescaled.jpeg", cvim)
-
-    # Apply threshold to get image with only b&w (binarization)
-    # Image Thresholding is an intensity transformation function in which the values of pixels below
-    # a particular threshold are reduced, and the values above that threshold are boosted.  This
-    # generally results in a bilevel image at the end, where the image is composed of black and white
-    # pixels.
-    if apply_threshold:
-        cvim = cv2.threshold(cvim, 127, 255, threshold_type)[1]
-        # cv2.imwrite(f"{image_name}_threshold.jpeg", cvim)
-
-    return cvim
-
-
-def interpret_text(ocr_text, unprocessed_image, robi_date, robi_user, measurement_names_json):
-    # Create an empty dictionary to store the data
-    health_dict = {}
-    health_dict["Date"] = robi_date
-    health_dict["Username"] = robi_user
-    health_dict["Image_name"] = unprocessed_image
-
-    # First split the text in lines
-    lines = ocr_text.split("\n")
-    for line in lines:
-        # print(f"line: {line}")
-
-        # Go through the measurement names in the json file
-        for measurement_item in measurement_names_json['measurements']:
-
-            # Search for the measurement name in the line
-            if measurement_item['string_in_line'] in line:
-                print(f"{line}")
-                # The name of the measurement is the key
-                key  = measurement_item['name']
-
-                # The value in the line is the value
-                value = line.split(" ")[1]
-
-                # Check if value starts with a number
-                # Because there are some lines where
-                # the name can be found, but it isn't followed
-                # by a number
-                if value[0].isdigit():
-                    # Remove the unit at the end of the value
-                    print(f"Value: {value}")
-
-                    # If there is a unit at the end of the value, remove it
-                    # But also check that there is a unit after the value
-                    if measurement_item['unit'] in value and measurement_item['unit'] != "":
-                        print(f"Unit: {measurement_item['unit']}")
-                        value_just_digit = value.split(measurement_item['unit'])[0]
-                        print(f"Value just digit: {value_just_digit}")
-                        health_dict[key] = value_just_digit # .replace(".", ",")
-                    else:
-                        health_dict[key] = value # .replace(".", ",")
-
-    return health_dict
-
-
-# 4150:4220, 150:400
-def get_segment_data(image_name, start_x, end_x, start_y, end_y):
-    # Read the image
-    cv2im = cv2.imread(image_name, cv2.IMREAD_COLOR)
-    # Crop the image to the arm left
-    cv2im_segment = cv2im[start_y:end_y, start_x:end_x]
-
-    # Write the cropped image to disk
-    # cv2im_armleft_file = "cv2im_armleft_cropped.jpg"
-    # cv2.imwrite(cv2im_armleft_file, cv2im_armleft)
-    
-    # Get text from the image. psm 6 is for a single uniform block of text.
-    segment_text = pytesseract.image_to_string(cv2im_segment, config='--psm 6')
-    # Print text from the image
-
-    # Remove _, — and - signs from the text
-    # These pop up when the underlining is misinterpreted
-    segment_text = segment_text.replace("_", "").replace("-", "").replace("—", "")
-    return segment_text
-
-
-def get_list_of_processed_images(sqlite_db):
-    # Get list of processed images from the database
-    conn = sqlite3.connect(sqlite_db)
-    c = conn.cursor()
-    query = """SELECT Image_name
-                FROM measurements
-                """
-    c.execute(query)
-    rows = c.fetchall()
-    conn.close()
-
-    # Get image names without path. But there are None types.
-    rows = [row[0].split("/")[-1] for row in rows if row[0] is not None]
-    return rows
-
-
-# Look for new IMG_nnnnnn.jpeg images in Downloads folder
-# and process them
-def get_images_in_folder(download_folder):
-    # Get list of IMG.jpeg files in the download folder
-    onlyfiles = [f for f in listdir(download_folder) if isfile(join(download_folder, f)) and f.startswith("IMG_") and f.endswith(".jpeg")]
-
-    # Also append a list of files named JPEG-afbeelding-44F2-B7FA-C4-0.jpeg
-    onlyfiles.extend([f for f in listdir(download_folder) if isfile(join(download_folder, f)) and f.startswith("JPEG-afbeelding") and f.endswith(".jpeg")])
-
-    # # Get list of IMG.jpeg files with path
-    # onlyfiles = [join(download_folder, f) for f in onlyfiles]
-
-    # print(f"onlyfiles: {onlyfiles}")
-    return onlyfiles
-
-
-def find_unprocessed_images(image_files, processed_images):
-    # Find the unprocessed images
-    unprocessed_images = []
-    for image_file in image_files:
-        if image_file not in processed_images:
-            unprocessed_images.append(image_file)
-    
-    # print(f"Unprocessed images: {unprocessed_images}")
-    return unprocessed_images
+        Decoded image, or None if the data isn't an image
+    """
+    flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
 
 
-def check_resolution_of_image(image_name):
-    # Check that the resolution is 1290x7509
-    im = cv2.imread(image_name, cv2.IMREAD_COLOR)
-    # print(f"Image: {image_name}")
-    # Check that image has shape
-    if im is None:
-        return False
-    
-    # print(f"Resolution: {im.shape}")
-    if im.shape[0] == 7509 and im.shape[1] == 1290:
-        return True
-    else:
-        return False
-    
+def default_sinks(db_path: str = SQLITE_DB) -> List[Sink]:
+    """CSV and Excel files with the latest measurement and, if SQLITE_COPY_TARGET is set, a copy of the database."""
+    sinks: List[Sink] = [CsvSink(), ExcelSink()]
+    if SQLITE_COPY_TARGET:
+        sinks.append(DatabaseCopySink(db_path, SQLITE_COPY_TARGET))
+    return sinks
 
-if __name__ == "__main__":
-    # Get measurement names from json file
-    measurement_names_json = read_extract_json("measurement_names.json")
 
-    images_in_downloads = get_images_in_folder(DOWNLOAD_FOLDER)
-    # print(f"Images in downloads: {images_in_downloads}")
-    processed_images = get_list_of_processed_images(SQLITE_DB)
-    # print(f"Processed images: {processed_images}")
-    unprocessed_images = find_unprocessed_images(images_in_downloads, processed_images)
+class ExtractionResult(NamedTuple):
+    """Measurements read from one image."""
+    record: MeasurementRecord
+    # OCR confidence (0-100) per field of the record
+    confidences: Dict[str, float]
+    profile: MeasurementProfile
 
-    # Add the path to the image
-    unprocessed_images = [join(DOWNLOAD_FOLDER, image) for image in unprocessed_images]
 
-    # Check the resolution of unprocessed images
-    unprocessed_images = [image for image in unprocessed_images if check_resolution_of_image(image) == True]
-    print(f"Unprocessed images with correct resolution: {unprocessed_images}")        
+class MeasurementExtractor:
+    """Extract measurements from Robi scale images."""
     
+    def __init__(
+        self,
+        profiles_path: str = PROFILES_FOLDER,
+        db_path: str = SQLITE_DB,
+        download_folder: str = DOWNLOAD_FOLDER,
+        ocr_workers: Optional[int] = None,
+        bundle_backups: bool = BUNDLE_BACKUPS,
+        low_memory: bool = LOW_MEMORY,
+        memory_budget_mb: Optional[int] = MEMORY_BUDGET_MB,
+        recipes_path: Optional[str] = None,
+        profiles: Optional[ProfileRegistry] = None,
+        decoder: Callable[[bytes, bool], Optional[np.ndarray]] = decode_image,
+        ocr: Callable[..., List[OcrLine]] = ocr_lines,
+        sinks: Optional[List[Sink]] = None
+    ):
+        """Initialize the extractor with paths and stages.
+
+        The database is only opened when images are processed, extract()
+        works without it.
+        
+        Args:
+            profiles_path: Path to a measurement profile JSON file or a folder with profiles
+            db_path: Path to the SQLite database
+            download_folder: Path to the folder with images to process
+            ocr_workers: Number of text blocks OCRed in parallel, defaults to the number of CPUs
+            bundle_backups: Append processed images to zip bundles in BACKUP_FOLDER instead of moving them
+            low_memory: Decode images as grayscale, OCR the text region one strip at a time and
+                release the buffers after every image
+            memory_budget_mb: Maximum resident memory in MB; an image that doesn't fit is
+                put back in the queue instead of being decoded
+            recipes_path: JSON file with the preprocessing recipes to try, DEFAULT_RECIPES if it is
+                None or doesn't exist
+            profiles: Profile registry that parses the OCR text, instead of loading profiles_path
+            decoder: Decodes image bytes, called with the bytes and whether to decode to grayscale
+            ocr: OCR backend with the signature of fitdays_ocr.ocr_lines(img, config, y_offset)
+            sinks: Outputs of saved measurements besides the database, defaults to default_sinks()
+        """
+        # Text blocks are OCRed in parallel, so keep every Tesseract process on one thread
+        os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+        self.profiles_path = profiles_path
+        self.db_path = db_path
+        self.db = MeasurementDatabase(db_path)
+        self._jobs: Optional[JobQueue] = None
+        self._fingerprints: Optional[FingerprintIndex] = None
+        self.download_folder = download_folder
+        self.profiles = profiles or ProfileRegistry.from_path(profiles_path)
+        self.decoder = decoder
+        self.ocr = ocr
+        self.sinks = default_sinks(db_path) if sinks is None else sinks
+        self.preprocessing = PreprocessingEngine()
+        if recipes_path and Path(recipes_path).exists():
+            self.recipes = load_recipes(recipes_path)
+            logger.info(f"Loaded {len(self.recipes)} preprocessing recipes from {recipes_path}")
+        else:
+            self.recipes = list(DEFAULT_RECIPES)
+        self.low_memory = low_memory
+        self.memory_budget = MemoryBudget(memory_budget_mb) if memory_budget_mb else None
+        # Strips are OCRed one at a time in low-memory mode, the pool is only used for the whole page
+        self.ocr_pool = ThreadPoolExecutor(max_workers=ocr_workers or os.cpu_count() or 1)
+        self.reader = ArchiveReader()
+        # Exports, the database copy and backups run in the background, the OCR doesn't wait for them
+        self.io = BackgroundIO()
+        self.bundles = BundleWriter(BACKUP_FOLDER) if bundle_backups and BACKUP_FOLDER else None
+
+    @property
+    def jobs(self) -> JobQueue:
+        """Queue of images to process, opened on first use."""
+        if self._jobs is None:
+            self._jobs = JobQueue(self.db_path)
+        return self._jobs
+
+    @property
+    def fingerprints(self) -> FingerprintIndex:
+        """Fingerprints of the processed images, loaded on first use."""
+        if self._fingerprints is None:
+            self._fingerprints = FingerprintIndex(self.db.conn)
+        return self._fingerprints
+    
+    def get_unprocessed_images(self) -> List[str]:
+        """Get list of unprocessed images with the correct resolution."""
+        images = self._get_images_in_folder()
+        processed_images = self.db.get_processed_images()
+        unprocessed_images = self._find_unprocessed_images(images, processed_images)
+        
+        # Add full path to images, images that are already queued have been checked before
+        queued = self.jobs.known_images()
+        unprocessed_paths = [join(self.download_folder, img) for img in unprocessed_images]
+        
+        # Filter by resolution
+        return [img for img in unprocessed_paths if img not in queued and self._check_resolution(img)]
+    
+    def _get_images_in_folder(self) -> List[str]:
+        """Get list of potential Robi scale images in the download folder."""
+        files = listdir(self.download_folder)
+        img_files = [
+            f for f in files 
+            if isfile(join(self.download_folder, f)) and self._is_image_name(f)
+        ]
+        return img_files
+
+    @staticmethod
+    def _is_image_name(name: str) -> bool:
+        """Check if a file name is that of an image shared by the Fitdays app."""
+        return ((name.startswith("IMG_") and name.endswith(".jpeg")) or
+                (name.startswith("JPEG-afbeelding") and name.endswith(".jpeg")))
+
+    def queue_archive(self, archive_path: str) -> int:
+        """Queue the unprocessed images inside a zip or tar archive.
+
+        The members are read in memory, nothing is extracted to disk.
+
+        Returns:
+            Number of queued images
+        """
+        processed_images = set(self.db.get_processed_images())
+        queued = self.jobs.known_images()
+        members = [
+            path for path in self.reader.members(archive_path, self._is_image_name)
+            if path not in queued and image_name(path) not in processed_images
+        ]
+        new_jobs = self.jobs.enqueue(path for path in members if self._check_resolution(path))
+        logger.info(f"Queued {new_jobs} images from {archive_path}")
+        return new_jobs
+    
+    def _find_unprocessed_images(self, all_images: List[str], processed_images: List[str]) -> List[str]:
+        """Find images that haven't been processed yet."""
+        return [img for img in all_images if img not in processed_images]
+    
+    def _check_resolution(self, image_path: str) -> bool:
+        """Check if image has the expected Robi scale resolution (1290x7509)."""
+        # Only the JPEG header is parsed, the image isn't decoded
+        try:
+            with Image.open(self.reader.open(image_path)) as img:
+                width, height = img.size
+        except (OSError, KeyError) as e:
+            logger.warning(f"Could not read image: {image_path} ({e})")
+            return False
+        
+        return height == 7509 and width == 1290
+    
+    def process_images(self) -> None:
+        """Queue the new images in the download folder and process the queue."""
+        new_jobs = self.jobs.enqueue(self.get_unprocessed_images())
+        if new_jobs:
+            logger.info(f"Found {new_jobs} new images to process")
+        self.run_jobs()
+
+    def run_jobs(self, worker: Optional[str] = None) -> None:
+        """Process queued images until no job is due.
+
+        Several processes can run this at the same time, every job is claimed
+        by one of them. A job of which the measurement was saved before the
+        process died is marked done without processing the image again.
+
+        Args:
+            worker: Name of this worker in the jobs table, defaults to host:pid
+        """
+        rowids = []
+        while True:
+            job = self.jobs.claim(worker)
+            if job is None:
+                break
+            try:
+                rowid = self._run_job(job)
+            except MemoryBudgetExceeded as e:
+                # Other workers are using the memory, leave the rest of the queue to them
+                logger.warning(f"Stopping this worker: {e}")
+                break
+            if rowid is not None:
+                rowids.append(rowid)
+
+        failed_io = self.io.flush()
+        if failed_io:
+            logger.error(f"{failed_io} exports or backups failed, see the errors above")
+
+        counts = self.jobs.counts()
+        logger.info(f"Processed {len(rowids)} images, queue: " + ", ".join(f"{n} {s}" for s, n in counts.items()))
+        self.update_profile()
+
+    def _run_job(self, job: Job) -> Optional[int]:
+        """Process the image of one claimed job and record the outcome in the queue."""
+        saved = self.db.measurement_for_image(job.image_path) or self.fingerprints.linked_measurement(job.image_path)
+        if saved is not None:
+            logger.info(f"Image was saved before as measurement {saved}: {job.image_path}")
+            self.jobs.complete(job, saved)
+            return None
+
+        try:
+            rowid = self.process_single_image(job.image_path)
+        except MemoryBudgetExceeded as e:
+            # Not a problem of the image, it is tried again later without counting the attempt
+            self.jobs.release(job, str(e))
+            raise
+        except Exception as e:
+            logger.error(f"Error processing image {job.image_path}: {e}")
+            self.jobs.fail(job, f"{type(e).__name__}: {e}")
+            return None
+
+        if rowid is not None:
+            self.jobs.complete(job, rowid)
+            return rowid
+
+        # Duplicates are linked to the measurement of the earlier copy
+        duplicate_of = self.fingerprints.linked_measurement(job.image_path)
+        if duplicate_of is not None:
+            self.jobs.complete(job, duplicate_of)
+        else:
+            self.jobs.fail(job, "Measurement was not saved to the database")
+        return None
+
+    def update_profile(self) -> None:
+        """Add the measurements since the last update to the data-quality profile and log what changed."""
+        profiler = MeasurementProfiler(self.db.conn)
+        if not profiler.update():
+            return
+        for alert in profiler.alerts():
+            logger.warning(f"Data quality: {alert}")
+    
+    def process_single_image(self, image_path: str) -> Optional[int]:
+        """Process a single image and save the extracted data.
 
-    for unprocessed_image in unprocessed_images:
-
-        # Get the date from the image.
-        robi_user, robi_date = get_date_from_image(unprocessed_image)
-
-        # Save the image to a file
-        # cv2.imwrite(f"{ROBI_IMAGE}_rescaled.jpeg", imbin)
-        print("Trying to extract data from image no grayscale and no rescaling")
-        # Get text from image, language is Dutch
-        text = get_text_from_image(unprocessed_image)
-
-        # Interpret the text
-        health_dict = interpret_text(text, unprocessed_image, robi_date, robi_user, measurement_names_json)
-        print(health_dict)
+        A copy of an image that was processed before is recognised from its
+        fingerprint before any OCR, an exact copy from the hash of the file
+        even before it is decoded. It is linked to the earlier measurement
+        and moved to the backup folder like a processed image.
 
-        # Check if gewicht has value in the dictionary
-        if "Gewicht" in health_dict or "BMR" in health_dict:
-            print(f"Gewicht: {health_dict['Gewicht']}")
-            print(f"BMR: {health_dict['BMR']}")
+        Returns:
+            Rowid of the new measurement, or None if it was not saved to the
+            database or the image is a duplicate
+        """
+        logger.info(f"Processing image: {image_path}")
+
+        # Read the file once, it is hashed and decoded from the same bytes
+        data, mtime = self.reader.read(image_path)
+        sha256 = file_hash(data)
+        # Exact copies are found by their hash, without decoding the image
+        duplicate_of = self.fingerprints.find_exact(sha256)
+        if duplicate_of is not None:
+            logger.info(f"Skipping exact copy of measurement {duplicate_of}: {image_path}")
+            self.fingerprints.add_exact_copy(image_path, sha256, duplicate_of)
+            self._move_to_backup(image_path)
+            return None
+
+        self._check_memory(data, image_path)
+        img = self._decode(data)
+        if img is None:
+            raise ValueError(f"Could not read image: {image_path}")
+
+        fp = fingerprint(data, img, self.profiles.default.header_box, sha256)
+        # Date of the file, in case the header has no readable date
+        file_date = exif_date(data) or datetime.fromtimestamp(mtime)
+        del data
+        # Re-encoded copies are found by the header
+        similar = self.fingerprints.find_similar(fp)
+        duplicate_of = similar[0] if similar is not None else None
+        if duplicate_of is not None:
+            logger.info(f"Skipping duplicate of measurement {duplicate_of}: {image_path}")
+            self.fingerprints.add(image_path, fp, duplicate_of, duplicate=True)
+            self._move_to_backup(image_path)
+            return None
+        
+        result = self.extract(img, image_name=image_path, file_date=file_date)
+        health_dict, confidences = result.record, result.confidences
+        if self.low_memory:
+            del img
+            self.preprocessing.release()
+            release_memory()
+        
+        # Save data to outputs
+        rowid = self.save_data(health_dict, confidences)
+        if rowid is not None:
+            self.fingerprints.add(image_path, fp, rowid)
+        logger.info(f"Successfully processed image: {image_path}")
+
+        self._move_to_backup(image_path)
+        return rowid
+
+    def _decode(self, data: bytes) -> Optional[np.ndarray]:
+        """Decode an image, straight to grayscale in low-memory mode."""
+        return self.decoder(data, self.low_memory)
+
+    def _check_memory(self, data: bytes, image_path: str) -> None:
+        """Make sure decoding and processing the image fits in the memory budget.
+
+        Raises:
+            MemoryBudgetExceeded: If the image doesn't fit
+        """
+        if self.memory_budget is None:
+            return
+        # Only the header is parsed for the size
+        with Image.open(io.BytesIO(data)) as header:
+            width, height = header.size
+        channels = 1 if self.low_memory else 3
+        # The decoded page, and about as much again for crops, renders and the Tesseract input
+        self.memory_budget.check(2 * width * height * channels, image_path)
+
+    def extract(
+        self,
+        image: Union[bytes, np.ndarray],
+        image_name: str = "",
+        file_date: Optional[datetime] = None
+    ) -> ExtractionResult:
+        """Read the measurements from an image in memory.
+
+        Nothing is read from or written to disk or the database: the default
+        OCR backend pipes the image to Tesseract. So this can be used from
+        other services or with images from archives or sockets.
+        One extractor reads one image at a time; use an extractor per thread.
+
+        Args:
+            image: Encoded image (JPEG or PNG bytes) or a decoded BGR or grayscale image;
+                in low-memory mode images are decoded and processed as grayscale
+            image_name: Name of the image, stored in the record
+            file_date: Date to use if the header has no readable date; for
+                encoded images the EXIF date is tried first
+
+        Returns:
+            Record with the measurements, OCR confidence per field and the profile that was used
+
+        Raises:
+            ValueError: If the image can't be decoded or no date can be found
+        """
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            file_date = exif_date(bytes(image)) or file_date
+            img = self._decode(image)
+            if img is None:
+                raise ValueError(f"Could not decode image {image_name}")
+        elif image.ndim == 2 and not self.low_memory:
+            img = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
         else:
-            # OCR didn't find the weight
-            print("Gewicht or BMR not found in first attempt")
-            # Retry with different rescaling
-            print("Trying to extract data from image with grayscale conversion and rescaling 1,5 times")
-            imbin2 = rework_image(unprocessed_image, cv2.COLOR_BGR2GRAY, True, 1.5, 1.5, True, 
-                                cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            img = image
+
+        # OCR confidence (0-100) of every extracted field
+        confidences: Dict[str, float] = {}
+
+        # Extract user and date, and pick the profile for the language of the image
+        header_lines = self._read_header(img)
+        header_text = lines_to_text(header_lines)
+        profile = self.profiles.detect(header_text)
+        username, date_time = self._parse_header(header_text, profile, file_date, header_lines, confidences)
+        logger.info(f"Image from {username} taken at {date_time} ({profile.language})")
+        
+        # Initialize the measurement record with metadata
+        health_dict = profile.schema.new(
+            Device_name=profile.device_name,
+            Date=date_time,
+            Username=username,
+            Image_name=image_name
+        )
+        
+        # Try to extract general measurements with different processing methods
+        health_dict = self.extract_general_measurements(img, health_dict, profile, confidences)
+        
+        # Extract body segment data
+        health_dict = self.extract_segment_data(img, health_dict, profile, confidences)
+
+        # Extract 'Vetvrij lichaamsgewicht'
+        health_dict = self.extract_vetvrij_lichaamsgewicht(img, health_dict, profile, confidences)
+
+        return ExtractionResult(health_dict, confidences, profile)
+
+    def _move_to_backup(self, image_path: str) -> None:
+        """Move a processed image to BACKUP_FOLDER directory in the background, if specified."""
+        if split_path(image_path)[1] is not None:
+            # Images from an archive are backed up already
+            return
+        if self.bundles is not None or BACKUP_FOLDER:
+            self.io.submit("backup", self._backup_image, image_path)
+
+    def _backup_image(self, image_path: str) -> None:
+        """Move a processed image to BACKUP_FOLDER directory or add it to a bundle there."""
+        if self.bundles is not None:
+            logger.info(f"Added processed image to {self.bundles.add(image_path)}")
+        elif BACKUP_FOLDER:
+            target_dir = Path(BACKUP_FOLDER)
+            target_dir.mkdir(parents=True, exist_ok=True)
+            target_path = target_dir / Path(image_path).name
+            # Path(image_path).rename(target_path)
+            # move using shutil.move to avoid cross-device link error
+            import shutil
+            shutil.move(image_path, target_path)
+            logger.info(f"Moved processed image to {target_path}")
+
+    def get_date_from_image(self, img: np.ndarray) -> Tuple[str, str]:
+        """Extract username and date from the top portion of the image.
+        
+        Args:
+            img: Decoded image
             
-            # Save the image to a file
-            # cv2.imwrite(f"{ROBI_IMAGE}_rescaled2.jpeg", imbin2)
-
-            # Get text from image, language is Dutch
-            text2 = get_text_from_image(imbin2)
-            health_dict2 = interpret_text(text2, unprocessed_image, robi_date, robi_user, measurement_names_json)
-
-            if "Gewicht" in health_dict2 or "BMR" in health_dict2:
-                print(f"Gewicht (attempt 2): {health_dict2['Gewicht']}")
-                print(f"BMR (attempt 2): {health_dict2['BMR']}")
-                health_dict = health_dict2
+        Returns:
+            Tuple of (username, formatted_date_time)
+        """
+        header_text = lines_to_text(self._read_header(img))
+        return self._parse_header(header_text, self.profiles.detect(header_text))
+
+    def _read_header(self, img: np.ndarray) -> List[OcrLine]:
+        """OCR the header with the username, date and the summary labels."""
+        # All profiles of a device share the header position
+        x_start, x_end, y_start, y_end = self.profiles.default.header_box
+        img_top = img[y_start:y_end, x_start:x_end]
+        
+        # Extract text from the image
+        lines = self.ocr(img_top)
+        logger.debug(f"Top text: {lines_to_text(lines)}")
+        return lines
+
+    def _parse_header(
+        self,
+        header_text: str,
+        profile: MeasurementProfile,
+        file_date: Optional[datetime] = None,
+        header_lines: Optional[List[OcrLine]] = None,
+        confidences: Optional[Dict[str, float]] = None
+    ) -> Tuple[str, str]:
+        """Parse username and date from the header text.
+
+        OCR noise in the date is tolerated. If no date can be recovered, the
+        date of the image file (EXIF or modification time) is used instead.
+
+        Args:
+            header_text: OCR text of the header
+            profile: Profile with the date formats to try
+            file_date: Date of the image file, for when the header has no date
+            header_lines: OCR lines of the header, for the confidences
+            confidences: Dictionary to add the confidences of Username and Date to
+
+        Returns:
+            Tuple of (username, formatted_date_time)
+        """
+        header = parse_header(header_text, profile.date_formats)
+
+        date = header.date
+        if date is None:
+            if file_date is None:
+                raise ValueError(f"No date found in header: {header_text!r}")
+            date = file_date
+            logger.warning(f"No date found in header, using file date {date}")
+
+        username = header.username
+        if not username:
+            username = UNKNOWN_USER
+            logger.warning(f"No username found in header: {header_text!r}")
+
+        if confidences is not None and header_lines:
+            line_confidences = {line.text: line.confidence for line in header_lines}
+            if header.username in line_confidences:
+                confidences["Username"] = line_confidences[header.username]
+            # A date from the EXIF data or the file time wasn't read by OCR and has no confidence
+            if header.date:
+                confidences["Date"] = line_confidences.get(header.date_line, 0.0)
+        
+        return username, date.strftime(DATE_FORMAT)
+    
+    def extract_general_measurements(
+        self,
+        img: np.ndarray,
+        health_dict: MeasurementRecord,
+        profile: Optional[MeasurementProfile] = None,
+        confidences: Optional[Dict[str, float]] = None
+    ) -> MeasurementRecord:
+        """Extract general measurements from the image using multiple approaches if needed.
+
+        The text region is prepared once and every attempt is rendered from it
+        with the next recipe in self.recipes. Values with a low OCR confidence
+        are read again from just their own box. In low-memory mode the page is
+        rendered and OCRed one strip at a time, and a value is read again from
+        a strip rendered around its box.
+        
+        Args:
+            img: Decoded image
+            health_dict: Measurement record with metadata
+            profile: Measurement profile, defaults to the default profile
+            confidences: Dictionary to add the OCR confidence of every value to
+            
+        Returns:
+            Updated measurement record with measurements
+        """
+        profile = profile or self.profiles.default
+        self.preprocessing.load(img, profile.text_region)
+
+        result, words = health_dict, {}
+        for attempt, recipe in enumerate(self.recipes, start=1):
+            logger.info(f"Extracting data - attempt {attempt}: {recipe.name}")
+            if self.low_memory:
+                lines = self._ocr_strips(recipe)
             else:
-                print("Gewicht or BMR not found in second attempt")
-                print("Trying to extract data from image with grayscale conversion and rescaling 2 times")
-                imbin3 = rework_image(unprocessed_image, cv2.COLOR_BGR2GRAY, True, 2, 2, True, 
-                                cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-                # cv2.imwrite(f"{unprocessed_image}_rescaled3.jpeg", imbin3)
-                # Get text from image, language is Dutch
-                text3 = get_text_from_image(imbin3)
-                health_dict3 = interpret_text(text3, unprocessed_image, robi_date, robi_user, measurement_names_json)
-
-                if "Gewicht" in health_dict3 or "BMR" in health_dict3:
-                    print(f"Gewicht (attempt 3): {health_dict3['Gewicht']}")
-                    print(f"BMR (attempt 3): {health_dict3['BMR']}")
-                    health_dict = health_dict3
+                processed_img = self.preprocessing.render(recipe)
+                lines = self._ocr_blocks(processed_img, recipe)
+            result, words = self._interpret_lines(lines, health_dict, profile)
+
+            # Check if key measurements were found
+            if self._has_key_measurements(result, profile):
+                break
+
+        # The rendered image of the last attempt is still valid here
+        by_column = {measure.column: measure for measure in profile.measurements}
+        for column, word in words.items():
+            if word.confidence < MIN_CONFIDENCE:
+                if self.low_memory:
+                    strip, strip_word = self._word_strip(recipe, word)
+                    new_word = self._reocr_word(strip, strip_word, by_column[column], result)
+                    words[column] = new_word._replace(top=word.top)
                 else:
-                    print("Gewicht not found in third attempt")
-
-                # print("Trying to extract data from image without colour conversion and rescaling 2 times")
-                # imbin3 = rework_image(unprocessed_image, None, True, 2, 2, True, 
-                #             cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-
-        # Arm left fat box: 4150:4220, 150:400
-        armleftfat = get_segment_data(unprocessed_image, 150, 400, 4150, 4220)
-        # Remove kg from the value
-        armleftfat = armleftfat.split("kg")[0]
-        # print(f"Arm left fat: {armleftfat}")
-        health_dict["fatarmleft"] = armleftfat
-        # Arm right fat box: 4150:4220, 850:1200
-        armrightfat = get_segment_data(unprocessed_image, 850, 1200, 4150, 4220)
-        armrightfat = armleftfat.split("kg")[0]
-        # print(f"Arm right fat: {armrightfat}")
-        health_dict["fatarmright"] = armrightfat
-        # Stomach fat box: 4150:4220, 850:1200
-        stomachfat = get_segment_data(unprocessed_image, 150, 400, 4425, 4500)
-        stomachfat = stomachfat.split("kg")[0]
-        # print(f"Stomach fat: {stomachfat}")
-        health_dict["fatstomach"] = stomachfat
-        legleftfat = get_segment_data(unprocessed_image, 150, 400, 4715, 4780)
-        # Remove kg from the value
-        legleftfat = legleftfat.split("kg")[0]
-        # print(f"Arm left fat: {armleftfat}")
-        health_dict["fatlegleft"] = legleftfat
-        legrightfat = get_segment_data(unprocessed_image, 850, 1200, 4715, 4780)
-        legrightfat = legrightfat.split("kg")[0]
-        # print(f"Leg right fat: {armrightfat}")
-        health_dict["fatlegright"] = legrightfat
-        print(f"Fat arm left: {armleftfat}, arm right: {armrightfat}, stomach: {stomachfat}, leg left: {legleftfat}, leg right: {legrightfat}")
-
-        # Arm left muscle
-        armleftmuscle = get_segment_data(unprocessed_image, 150, 400, 5475, 5540)
-        # Remove kg from the value
-        armleftmuscle = armleftmuscle.split("kg")[0]
-        health_dict["musclearmleft"] = armleftmuscle
-        # Arm right muscle
-        armrightmuscle = get_segment_data(unprocessed_image, 850, 1200, 5475, 5540)
-        armrightmuscle = armrightmuscle.split("kg")[0]
-        health_dict["musclearmright"] = armrightmuscle
-        # Stomach muscle
-        stomachmuscle = get_segment_data(unprocessed_image, 150, 400, 5750, 5810)
-        stomachmuscle = stomachmuscle.split("kg")[0]
-        health_dict["musclestomach"] = stomachmuscle
-        # Leg left muscle
-        legleftmuscle = get_segment_data(unprocessed_image, 150, 400, 6030, 6100)
-        # Remove kg from the value
-        legleftmuscle = legleftmuscle.split("kg")[0]
-        health_dict["musclelegleft"] = legleftmuscle
-        # Leg right muscle
-        legrightmuscle = get_segment_data(unprocessed_image, 850, 1200, 6030, 6100)
-        legrightmuscle = legrightmuscle.split("kg")[0]
-        health_dict["musclelegright"] = legrightmuscle
-        print(f"Muscle: arm left: {armleftmuscle}, arm right: {armrightmuscle}, stomach: {stomachfat}, leg left: {legleftfat}, leg right: {legrightfat}")
-
-
-        # Write the health dictionary to a csv file
-        # With keys as columns and values as rows
-        with open("health_data.csv", "w", encoding="utf8") as file:
-            # Write the header with the keys
-            file.write(";".join(health_dict.keys()) + "\n")
-            # Write the values
-            file.write(";".join(health_dict.values()) + "\n")
-
-        # Write the health dictionary to a database
-        # With keys as columns and values as rows
-        conn = sqlite3.connect(SQLITE_DB)
-        c = conn.cursor()
-
-        # Create table statement:
-        create_table = """CREATE TABLE IF NOT EXISTS measurements 
-            (Device_name TEXT,
-            Username TEXT,
-            Measurement_datetime DATETIME, 
-            Image_name TEXT,
-            Gewicht REAL, 
-            BMI REAL, 
-            Lichaamsvet REAL, 
-            Vetmassa REAL, 
-            Spiermassa REAL, 
-            Spiersnelheid REAL, 
-            Skeletspier REAL, 
-            Botmassa REAL, 
-            Eiwitmassa REAL, 
-            Eiwit REAL, 
-            Watergewicht REAL, 
-            Lichaamswater REAL, 
-            BMR INT, 
-            WHR REAL)
+                    words[column] = self._reocr_word(processed_img, word, by_column[column], result)
+
+        if confidences is not None:
+            confidences.update({column: word.confidence for column, word in words.items()})
+
+        # Return the best result we have
+        return result
+    
+    def _ocr_blocks(
+        self,
+        img: np.ndarray,
+        recipe: PreprocessingRecipe,
+        max_block_height: int = 400
+    ) -> List[OcrLine]:
+        """OCR the text blocks of a rendered image in parallel.
+
+        Args:
+            img: Rendered text region
+            recipe: Recipe the image was rendered with
+            max_block_height: Maximum height of a block before scaling
+
+        Returns:
+            OCR lines of all blocks in page order, with boxes in the coordinates of img
         """
+        blocks = self.preprocessing.split_blocks(
+            img,
+            min_gap=int(self.preprocessing.band_padding * recipe.yscale),
+            max_block_height=int(max_block_height * recipe.yscale)
+        )
+        logger.debug(f"OCR of {len(blocks)} text blocks")
+        block_lines = self.ocr_pool.map(
+            lambda block: self.ocr(img[block[0]:block[1]], config=recipe.tesseract_config, y_offset=block[0]),
+            blocks
+        )
+        return [line for lines in block_lines for line in lines]
+
+    def _ocr_strips(self, recipe: PreprocessingRecipe, max_block_height: int = 400) -> List[OcrLine]:
+        """OCR the loaded page one rendered strip at a time.
+
+        Only one strip is scaled at a time, so this needs a fraction of the
+        memory of rendering the whole page.
+
+        Args:
+            recipe: Recipe to render the strips with
+            max_block_height: Maximum height of a strip before scaling
+
+        Returns:
+            OCR lines of all strips in page order, with boxes in the coordinates of the rendered page
+        """
+        lines: List[OcrLine] = []
+        for strip, y_offset in self.preprocessing.render_strips(recipe, max_block_height):
+            lines.extend(self.ocr(strip, config=recipe.tesseract_config, y_offset=y_offset))
+        return lines
+
+    def _word_strip(self, recipe: PreprocessingRecipe, word: Word, padding: int = 6) -> Tuple[np.ndarray, Word]:
+        """Render the rows around a word of the rendered page, for reading it again.
 
-        # Print the create table statement
-        # print(create_table)
-        # Create a table with the keys as columns
-        c.execute(create_table)
-
-        # Insert statement
-        insert_statement = """INSERT INTO measurements
-        (Device_name, Username, Measurement_datetime, Image_name, Gewicht, Lichaamsvet, BMI, Watergewicht,
-        Vetmassa, Spiermassa, Spiersnelheid, Skeletspier, Botmassa, Eiwitmassa, Eiwit, Lichaamswater, BMR, WHR,
-        fatarmleft, fatarmright, fatstomach, fatlegleft, fatlegright, musclearmleft, musclearmright, musclestomach,
-        musclelegleft, musclelegright)
-        VALUES 
-        ('Robi S11' , :Username, DATETIME(:Date), :Image_name, 
-        :Gewicht, :Lichaamsvet, :BMI, :Watergewicht, :Vetmassa, :Spiermassa, :Spiersnelheid, :Skeletspier, 
-        :Botmassa, :Eiwitmassa, :Eiwit, :Lichaamswater, :BMR, :WHR, :fatarmleft, :fatarmright, :fatstomach,
-        :fatlegleft, :fatlegright, :musclearmleft, :musclearmright, :musclestomach, :musclelegleft, :musclelegright)
+        Returns:
+            Tuple of (rendered strip, the word with its box in the coordinates of the strip)
+        """
+        y_start = int((word.top - padding) / recipe.yscale)
+        y_end = int(np.ceil((word.top + word.height + padding) / recipe.yscale))
+        strip, y_offset = self.preprocessing.render_rows(recipe, y_start, y_end)
+        return strip, word._replace(top=word.top - y_offset)
+
+    def _reocr_word(
+        self,
+        img: np.ndarray,
+        word: Word,
+        measure: CompiledMeasurement,
+        health_dict: MeasurementRecord,
+        padding: int = 6
+    ) -> Word:
+        """OCR the box of one low-confidence value again, scaled up and as a single line.
+
+        The value in health_dict is replaced if the second read is more confident.
+
+        Returns:
+            The word that was kept
+        """
+        x_start, x_end, y_start, y_end = word.box
+        crop = img[max(y_start - padding, 0):y_end + padding, max(x_start - padding, 0):x_end + padding]
+        crop = cv2.resize(crop, None, fx=2.0, fy=2.0, interpolation=cv2.INTER_CUBIC)
+
+        # psm 7 = single text line
+        for line in self.ocr(crop, config="--psm 7"):
+            for new_word in line.words:
+                value = new_word.text
+                if measure.unit and measure.unit in value:
+                    value = value.split(measure.unit)[0]
+                if value and value[0].isdigit() and new_word.confidence > word.confidence:
+                    logger.info(f"Re-read {measure.column}: '{health_dict[measure.column]}' "
+                                f"({word.confidence:.0f}) -> '{value}' ({new_word.confidence:.0f})")
+                    health_dict[measure.column] = value
+                    return word._replace(text=new_word.text, confidence=new_word.confidence)
+        return word
+
+    def _has_key_measurements(self, health_dict: MeasurementRecord, profile: MeasurementProfile) -> bool:
+        """Check if dictionary contains any of the key measurements of the profile (e.g. Gewicht or BMR)."""
+        return any(column in health_dict for column in profile.key_columns)
+    
+    def _interpret_lines(
+        self,
+        lines: List[OcrLine],
+        base_dict: MeasurementRecord,
+        profile: MeasurementProfile
+    ) -> Tuple[MeasurementRecord, Dict[str, Word]]:
+        """Interpret OCR lines and extract measurements with the words they were read from.
+        
+        Args:
+            lines: OCR lines with words
+            base_dict: Record with metadata
+            profile: Profile with the compiled measurement matchers
+            
+        Returns:
+            Tuple of (record with extracted measurements, word of every value by column)
+        """
+        health_dict = base_dict.copy()
+        words: Dict[str, Word] = {}
+
+        for line in lines:
+            for measure, value in profile.match_line(line.text):
+                logger.debug(f"Found measurement: {line.text}")
+                health_dict[measure.column] = value
+                word = line.find_word(value)
+                if word is not None:
+                    words[measure.column] = word
+
+        return health_dict, words
+    
+    def extract_segment_data(
+        self,
+        img: np.ndarray,
+        health_dict: MeasurementRecord,
+        profile: Optional[MeasurementProfile] = None,
+        confidences: Optional[Dict[str, float]] = None
+    ) -> MeasurementRecord:
+        """Extract body segment data (fat and muscle) from the regions in the profile layout.
+        
+        Args:
+            img: Decoded image
+            health_dict: Measurement record with metadata and general measurements
+            profile: Measurement profile, defaults to the default profile
+            confidences: Dictionary to add the OCR confidence of every value to
+            
+        Returns:
+            Updated measurement record with segment data
         """
+        profile = profile or self.profiles.default
+
+        # Extract data for each segment
+        for region in profile.segments:
+            x_start, x_end, y_start, y_end = region.box
+            text, confidence = self._get_segment_text(img, x_start, x_end, y_start, y_end, region.config)
+            # Remove the unit and store the value
+            value = text.split(region.unit)[0] if region.unit and region.unit in text else text
+            health_dict[region.id] = value
+            if confidences is not None:
+                confidences[region.id] = confidence
+        
+        return health_dict
+    
+    def extract_vetvrij_lichaamsgewicht(
+        self,
+        img: np.ndarray,
+        health_dict: MeasurementRecord,
+        profile: Optional[MeasurementProfile] = None,
+        confidences: Optional[Dict[str, float]] = None
+    ) -> MeasurementRecord:
+        """Extract 'Vetvrij lichaamsgewicht' from a specific segment of the image.
+        It is hard to get this data from the general OCR text, because the
+        name is split over two lines.
+        
+        Args:
+            img: Decoded image
+            health_dict: Measurement record with metadata and general measurements
+            profile: Measurement profile, defaults to the default profile
+            confidences: Dictionary to add the OCR confidence of the value to
+        Returns:
+            Updated measurement record with 'Vetvrij lichaamsgewicht' value
+        """
+        profile = profile or self.profiles.default
+        if "fatfreemass" not in profile.fields:
+            return health_dict
+
+        measure = profile.by_id["fatfreemass"]
+        region = profile.fields["fatfreemass"]
+        x_start, x_end, y_start, y_end = region.box
+        
+        text, confidence = self._get_segment_text(img, x_start, x_end, y_start, y_end, region.config)
+        logger.debug(f"{measure.name} segment text: {text}")
+        # Extract value before the unit
+        if measure.unit in text:
+            value = text.split(measure.unit)[0].strip()
+            logger.debug(f"Extracted {measure.name} value: {value}")
+            health_dict[measure.column] = value
+            if confidences is not None:
+                confidences[measure.column] = confidence
+        
+        return health_dict
+
+    def _get_segment_text(
+        self,
+        img: np.ndarray,
+        x_start: int,
+        x_end: int,
+        y_start: int,
+        y_end: int,
+        config: str = DEFAULT_REGION_CONFIG
+    ) -> Tuple[str, float]:
+        """Extract text from a specific segment of the image.
+        
+        Args:
+            img: Decoded image
+            x_start, x_end, y_start, y_end: Coordinates of the segment
+            config: Tesseract configuration of the region, from its OCR mode in the layout
+            
+        Returns:
+            Tuple of (extracted text, mean OCR confidence of its words)
+        """
+        # Crop to segment
+        img_segment = img[y_start:y_end, x_start:x_end]
+        
+        # Numeric regions only allow digits and the unit, so there is nothing to clean up
+        lines = self.ocr(img_segment, config=config)
+        segment_text = lines_to_text(lines)
+
+        words = [word for line in lines for word in line.words]
+        confidence = sum(word.confidence for word in words) / len(words) if words else 0.0
+        
+        return segment_text, confidence
+    
+    def save_data(self, health_dict: MeasurementRecord, confidences: Optional[Dict[str, float]] = None) -> Optional[int]:
+        """Save extracted data to SQLite and the sinks.
+
+        The measurement is inserted in the database right away, the sinks
+        (the CSV and Excel files and the copy of the database by default) are
+        written in the background. Sinks that only hold the latest state skip
+        a write when a newer one is waiting.
+        
+        Args:
+            health_dict: Measurement record with extracted health data
+            confidences: OCR confidence per field, stored in the database next to the values
+
+        Returns:
+            Rowid of the new measurement, or None if saving to the database failed
+        """
+        rowid = None
+        try:
+            rowid = self.db.insert_measurement(health_dict, confidences)
+            logger.info("Data saved to database")
+        except sqlite3.Error as e:
+            logger.error(f"Database error: {e}")
+
+        # The sinks get their own copy, the record isn't used after this
+        row = health_dict.to_dict(missing="")
+        for sink in self.sinks:
+            self.io.submit(sink.lane, sink.write, row, coalesce=sink.coalesce)
+        return rowid
+
+
+def main():
+    """Main function to run the extractor."""
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+    parser = argparse.ArgumentParser(description="Extract measurements from Fitdays images.")
+    parser.add_argument("--export-user", help="Export the measurements of this user instead of processing images")
+    parser.add_argument("--export-file", default="health_data_user.csv", help="CSV file for --export-user")
+    parser.add_argument("--rebuild-rollups", action="store_true",
+                        help="Recompute the daily/weekly/monthly rollups, e.g. after a backfill")
+    parser.add_argument("--profile-report", action="store_true",
+                        help="Add the new measurements to the data-quality profile and print it")
+    parser.add_argument("--rebuild-profile", action="store_true",
+                        help="Profile all measurements from scratch before printing the report")
+    parser.add_argument("--worker", action="store_true",
+                        help="Only process queued images, without scanning the download folder; "
+                             "start several to split a large import")
+    parser.add_argument("--queue-status", action="store_true", help="Print the number of jobs per state")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Put the images that failed too often back in the queue and process it")
+    parser.add_argument("--archive", nargs="+", metavar="PATH",
+                        help="Queue and process the images inside these zip or tar archives")
+    parser.add_argument("--bundle-backups", action="store_true", default=BUNDLE_BACKUPS,
+                        help="Append processed images to rolling zip bundles in the backup folder")
+    parser.add_argument("--low-memory", action="store_true", default=LOW_MEMORY,
+                        help="Decode images as grayscale and OCR them in strips, for machines with little RAM")
+    parser.add_argument("--memory-budget", type=int, default=MEMORY_BUDGET_MB, metavar="MB",
+                        help="Maximum resident memory of this process; images that don't fit wait in the queue")
+    parser.add_argument("--recipes", default=RECIPES_FILE, metavar="PATH",
+                        help="Preprocessing recipes from fitdays_tuning.py, tried in order")
+    args = parser.parse_args()
+
+    try:
+        extractor = MeasurementExtractor(
+            profiles_path=PROFILES_FOLDER,
+            db_path=SQLITE_DB,
+            download_folder=DOWNLOAD_FOLDER,
+            bundle_backups=args.bundle_backups,
+            low_memory=args.low_memory,
+            memory_budget_mb=args.memory_budget,
+            recipes_path=args.recipes
+        )
+        if args.export_user:
+            extractor.db.export_user(args.export_user, args.export_file)
+        elif args.rebuild_rollups:
+            extractor.db.rebuild_rollups()
+        elif args.profile_report or args.rebuild_profile:
+            profiler = MeasurementProfiler(extractor.db.conn)
+            if args.rebuild_profile:
+                profiler.rebuild()
+            else:
+                profiler.update()
+            print(profiler.report())
+        elif args.queue_status:
+            for state, count in extractor.jobs.counts().items():
+                print(f"{state:<8}{count:>7}")
+            for image_path, error in extractor.jobs.failures().items():
+                print(f"  {image_path}: {error}")
+        elif args.worker:
+            extractor.run_jobs()
+        elif args.archive:
+            for archive_path in args.archive:
+                extractor.queue_archive(archive_path)
+            extractor.run_jobs()
+        elif args.retry_failed:
+            logger.info(f"Retrying {extractor.jobs.retry_failed()} failed images")
+            extractor.run_jobs()
+        else:
+            extractor.process_images()
+    except Exception as e:
+        logger.error(f"Error running extractor: {e}")
 
 
-        # Print the insert statement:
-        # print(insert_statement)
-        # Insert the values
-        c.execute(insert_statement, health_dict)
-        conn.commit()
-        conn.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+""" Images in zip and tar archives, read in memory, and backups in rolling zip bundles.
+
+An image inside an archive has a path like 'backup_0001.zip::IMG_1234.jpeg'.
+Such paths go through the job queue and the extractor like the paths of loose
+files; the member is read into memory and decoded from there, nothing is
+extracted to disk. Open archives are kept for the next member, because jobs
+are claimed in the order the members were queued.
+
+Instead of thousands of loose files, processed images can be appended to zip
+bundles in the backup folder. A new bundle is started when the current one
+reaches its maximum size. The bundles can be read back as archives. Workers
+that share the backup folder take turns appending, with a lock file next to
+the bundles.
+"""
+import hashlib
+import io
+import logging
+import os
+import tarfile
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows, where only one worker writes bundles
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SEPARATOR = "::"
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+# Archives kept open between reads
+MAX_OPEN_ARCHIVES = 4
+BUNDLE_PREFIX = "fitdays_images_"
+BUNDLE_MAX_BYTES = 512 * 1024 * 1024
+BUNDLE_LOCK_FILE = ".bundle.lock"
+
+
+def is_archive(path: str) -> bool:
+    """Whether a file is a zip or tar archive, by its name."""
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def member_path(archive_path: str, member: str) -> str:
+    """Path of an image inside an archive."""
+    return f"{archive_path}{ARCHIVE_SEPARATOR}{member}"
+
+
+def split_path(image_path: str) -> Tuple[str, Optional[str]]:
+    """Split an image path into (archive path, member), member is None for a loose file."""
+    if ARCHIVE_SEPARATOR in image_path:
+        archive_path, member = image_path.split(ARCHIVE_SEPARATOR, 1)
+        return archive_path, member
+    return image_path, None
+
+
+def image_name(image_path: str) -> str:
+    """File name of an image, also for images inside an archive."""
+    archive_path, member = split_path(image_path)
+    return Path(member if member is not None else archive_path).name
+
+
+class ArchiveReader:
+    """Reads images from loose files and from members of zip and tar archives."""
+
+    def __init__(self, max_open: int = MAX_OPEN_ARCHIVES):
+        """Initialize the reader.
+
+        Args:
+            max_open: Number of archives kept open between reads
+        """
+        self.max_open = max_open
+        self._archives: "OrderedDict[str, Union[zipfile.ZipFile, tarfile.TarFile]]" = OrderedDict()
+
+    def _open(self, archive_path: str) -> Union[zipfile.ZipFile, tarfile.TarFile]:
+        """Open archive, reused from the previous read if possible."""
+        if archive_path in self._archives:
+            self._archives.move_to_end(archive_path)
+            return self._archives[archive_path]
+
+        if archive_path.lower().endswith(".zip"):
+            archive = zipfile.ZipFile(archive_path)
+        else:
+            archive = tarfile.open(archive_path)
+        self._archives[archive_path] = archive
+        if len(self._archives) > self.max_open:
+            self._archives.popitem(last=False)[1].close()
+        return archive
+
+    def close(self) -> None:
+        """Close all open archives."""
+        for archive in self._archives.values():
+            archive.close()
+        self._archives.clear()
+
+    def members(self, archive_path: str, name_filter: Callable[[str], bool]) -> Iterator[str]:
+        """Paths of the images in an archive, in archive order.
+
+        Args:
+            archive_path: Path to the zip or tar archive
+            name_filter: Selects members by file name
+        """
+        archive = self._open(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+        else:
+            names = [info.name for info in archive.getmembers() if info.isfile()]
+        for name in names:
+            if name_filter(Path(name).name):
+                yield member_path(archive_path, name)
+
+    def read(self, image_path: str) -> Tuple[bytes, float]:
+        """Content and modification time of an image.
+
+        Args:
+            image_path: Path to a loose file, or to a member of an archive
+
+        Returns:
+            Tuple of (file content, modification time as a timestamp)
+        """
+        archive_path, member = split_path(image_path)
+        if member is None:
+            return Path(image_path).read_bytes(), os.path.getmtime(image_path)
+
+        archive = self._open(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            info = archive.getinfo(member)
+            return archive.read(info), time.mktime(info.date_time + (0, 0, -1))
+        info = archive.getmember(member)
+        with archive.extractfile(info) as f:
+            return f.read(), float(info.mtime)
+
+    def open(self, image_path: str) -> io.BytesIO:
+        """Image as a file object in memory."""
+        return io.BytesIO(self.read(image_path)[0])
+
+
+class BundleWriter:
+    """Appends processed images to rolling zip bundles."""
+
+    def __init__(self, folder: str, max_bytes: int = BUNDLE_MAX_BYTES, prefix: str = BUNDLE_PREFIX):
+        """Initialize the writer.
+
+        Args:
+            folder: Folder with the bundles
+            max_bytes: Size at which a new bundle is started
+            prefix: File name of the bundles before their number
+        """
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+
+    def _current_bundle(self) -> Path:
+        """The newest bundle, or a new one if it is full."""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        bundles = sorted(self.folder.glob(f"{self.prefix}*.zip"))
+        if bundles and bundles[-1].stat().st_size < self.max_bytes:
+            return bundles[-1]
+        number = int(bundles[-1].stem[len(self.prefix):]) + 1 if bundles else 1
+        return self.folder / f"{self.prefix}{number:04d}.zip"
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Hold the lock of the bundle folder, so only one process appends at a time."""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with open(self.folder / BUNDLE_LOCK_FILE, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add(self, image_path: str) -> str:
+        """Add a processed image to the current bundle and remove the loose file.
+
+        An image with the name of an image already in the bundle is stored
+        with the start of its SHA-1 hash added to the name. When that name is
+        taken too, the bundle has the same image already.
+
+        Returns:
+            Path of the image inside the bundle
+        """
+        name = image_name(image_path)
+        with self._locked():
+            bundle = self._current_bundle()
+            with zipfile.ZipFile(bundle, mode="a", compression=zipfile.ZIP_DEFLATED) as zf:
+                names = set(zf.namelist())
+                if name in names:
+                    with open(image_path, "rb") as file:
+                        digest = hashlib.sha1(file.read()).hexdigest()[:8]
+                    stem, suffix = os.path.splitext(name)
+                    name = f"{stem}_{digest}{suffix}"
+                    logger.warning(f"{image_name(image_path)} is already in {bundle}, adding this image as {name}")
+                if name in names:
+                    logger.warning(f"The same image is already in {bundle} as {name}, not adding it again")
+                else:
+                    zf.write(image_path, arcname=name)
+        os.remove(image_path)
+        return member_path(str(bundle), name)
@@ -0,0 +1,144 @@
+""" Streamlit dashboard of the measurements in the fitdays database.
+
+Run with:
+    streamlit run src/robiocr/fitdays_dashboard.py -- --db fitdays_health_data.db
+
+The database is opened once, read-only, and shared by all sessions. Query
+results are cached per data version of the database, so they are reused until
+the extractor adds a measurement. The metrics and whether the rollup table
+exists are read again for every data version too, as the extractor adds
+columns and tables. Series are downsampled (or read from the
+rollup table) before they are sent to the browser.
+"""
+import argparse
+import os
+import threading
+from datetime import date
+from typing import List, Optional, Tuple
+
+import pandas as pd
+import streamlit as st
+
+from robiocr.fitdays_timeseries import TimeSeriesStore, downsample, resample
+
+SQLITE_DB = "/Volumes/backup/sqlite/fitdays_health_data.db"
+ALL_USERS = "All users"
+FREQUENCIES = {"All measurements": None, "Day": "D", "Week": "W", "Month": "M"}
+
+
+@st.cache_resource
+def get_store(db_path: str) -> Tuple[TimeSeriesStore, threading.Lock]:
+    """Read-only connection to the database, shared by all sessions.
+
+    Streamlit runs sessions in threads, so queries go through the lock.
+    """
+    return TimeSeriesStore(db_path), threading.Lock()
+
+
+def get_data_version(db_path: str) -> Tuple[int, int]:
+    """Version of the data in the database, changes with every write.
+
+    PRAGMA data_version catches commits by other connections, the
+    modification time catches the file being replaced by a copy.
+    """
+    store, lock = get_store(db_path)
+    mtimes = [os.stat(path).st_mtime_ns for path in (db_path, db_path + "-wal") if os.path.exists(path)]
+    with lock:
+        return store.data_version(), max(mtimes)
+
+
+@st.cache_data(max_entries=64)
+def load_schema(db_path: str, version: Tuple[int, int]) -> Tuple[List[str], bool]:
+    """Metrics in the database and whether it has the rollup table."""
+    store, lock = get_store(db_path)
+    with lock:
+        store.refresh()
+        return store.metrics, store.has_rollups
+
+
+@st.cache_data(max_entries=64)
+def load_overview(db_path: str, version: Tuple[int, int]) -> Tuple[list, list, Tuple[Optional[str], Optional[str]]]:
+    """Users, metrics and date range of the measurements."""
+    metrics, _ = load_schema(db_path, version)
+    store, lock = get_store(db_path)
+    with lock:
+        return store.users(), metrics, store.date_range()
+
+
+@st.cache_data(max_entries=256)
+def load_chart(
+    db_path: str,
+    version: Tuple[int, int],
+    metric: str,
+    user: Optional[str],
+    start: str,
+    end: str,
+    freq: Optional[str],
+    points: int
+) -> pd.DataFrame:
+    """Chart data of one metric, at most `points` points or one row per period."""
+    _, has_rollups = load_schema(db_path, version)
+    store, lock = get_store(db_path)
+    with lock:
+        if freq is not None and has_rollups:
+            envelope = store.load_rollup(metric, freq, user=user, start=start, end=end)
+        elif freq is not None:
+            envelope = resample(store.load(metric, user=user, start=start, end=end), freq)
+        else:
+            series = downsample(store.load(metric, user=user, start=start, end=end), points)
+            return pd.DataFrame({metric: series.values}, index=pd.DatetimeIndex(series.times, name="Date"))
+
+    return pd.DataFrame(
+        {"mean": envelope.mean, "min": envelope.min, "max": envelope.max},
+        index=pd.DatetimeIndex(envelope.times, name="Date")
+    )
+
+
+def main():
+    """Render the dashboard."""
+    parser = argparse.ArgumentParser(description="Dashboard of the fitdays measurements.")
+    parser.add_argument("--db", default=SQLITE_DB, help="Path to the SQLite database")
+    args, _ = parser.parse_known_args()
+
+    st.set_page_config(page_title="Fitdays measurements", layout="wide")
+    st.title("Fitdays measurements")
+
+    version = get_data_version(args.db)
+    users, metrics, (first_date, last_date) = load_overview(args.db, version)
+    if first_date is None:
+        st.info("No measurements in the database yet")
+        return
+
+    with st.sidebar:
+        user = st.selectbox("User", [ALL_USERS] + users)
+        metric = st.selectbox("Metric", metrics, index=metrics.index("Gewicht") if "Gewicht" in metrics else 0)
+        date_range = st.date_input(
+            "Dates",
+            value=(date.fromisoformat(first_date), date.fromisoformat(last_date)),
+            min_value=date.fromisoformat(first_date),
+            max_value=date.fromisoformat(last_date)
+        )
+        frequency = st.radio("Resolution", list(FREQUENCIES))
+        points = st.slider("Maximum points", min_value=100, max_value=5000, value=1000, step=100)
+
+    # The date input returns one date while the user is still picking the range
+    start, end = (date_range if len(date_range) == 2 else (date_range[0], date.fromisoformat(last_date)))
+    chart = load_chart(
+        args.db, version, metric,
+        None if user == ALL_USERS else user,
+        start.isoformat(),
+        # End is exclusive in the queries
+        (pd.Timestamp(end) + pd.Timedelta(days=1)).date().isoformat(),
+        FREQUENCIES[frequency],
+        points
+    )
+
+    if chart.empty:
+        st.info(f"No {metric} measurements in this selection")
+        return
+
+    st.line_chart(chart)
+    st.caption(f"{len(chart)} points")
+
+
+main()
@@ -0,0 +1,464 @@
+""" SQLite storage of the measurements, with one row per image and a users table.
+
+Usernames are read from the header with OCR, so the same person can come out
+as several variants ("Marcel-Jan", "Marcel—Jan", "MarceI-Jan"). Every variant
+is stored as an alias of one user, so a person isn't split into several users.
+Only variants that differ in characters OCR confuses, or in a single character
+of a long name, are merged: in a household "Jan" and "Jane" are two people.
+The username as read is kept next to the canonical one (Ocr_username).
+"""
+import csv
+import logging
+import re
+import sqlite3
+from typing import Dict, List, Optional
+
+from robiocr.fitdays_archive import image_name
+from robiocr.fitdays_record import MeasurementRecord, RecordSchema
+
+logger = logging.getLogger(__name__)
+
+# Periods of the rollups, with the SQLite expression for the start of the period.
+# Weeks start on Monday.
+ROLLUP_PERIODS = {
+    "day": "date({dt})",
+    "week": "date({dt}, 'weekday 0', '-6 days')",
+    "month": "date({dt}, 'start of month')",
+}
+
+# Columns of the measurements table with metadata instead of measurements
+METADATA_COLUMNS = {"Device_name", "Username", "Measurement_datetime", "Image_name", "User_id", "Ocr_username"}
+
+# Value of a metric as a number, and the condition that it holds one, for the rollups and
+# the time series. The body segments are TEXT columns, their values count when they are a plain number.
+METRIC_VALUE = 'CAST("{metric}" AS REAL)'
+METRIC_CONDITION = """(typeof("{metric}") IN ('real', 'integer') OR (typeof("{metric}") = 'text'
+    AND "{metric}" GLOB '*[0-9]*' AND "{metric}" NOT GLOB '*[^0-9.]*'))"""
+
+# Characters OCR reads for each other, folded to one character before usernames are compared
+OCR_CONFUSABLES = str.maketrans({"i": "l", "1": "l", "|": "l", "!": "l", "0": "o"})
+
+
+class MeasurementDatabase:
+    """The measurements database with per-user indexes."""
+
+    def __init__(self, db_path: str, min_typo_length: int = 7):
+        """Initialize the database.
+
+        Args:
+            db_path: Path to the SQLite database
+            min_typo_length: Minimum length of a normalized username for one
+                misread character to count as an OCR variant of an existing user
+        """
+        self.db_path = db_path
+        self.min_typo_length = min_typo_length
+        self._conn: Optional[sqlite3.Connection] = None
+        # Normalized username -> User_id
+        self._alias_cache: Dict[str, int] = {}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Connection to the database, the schema is created on first use."""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path)
+            self.ensure_schema()
+        return self._conn
+
+    def close(self) -> None:
+        """Close the connection to the database."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._alias_cache = {}
+
+    def ensure_schema(self) -> None:
+        """Create the tables and indexes, and migrate measurements to per-user storage."""
+        cursor = self.conn.cursor()
+        self._create_measurements_table(cursor)
+        cursor.execute("""CREATE TABLE IF NOT EXISTS users
+            (User_id INTEGER PRIMARY KEY,
+            Username TEXT NOT NULL UNIQUE,
+            Created_at DATETIME DEFAULT CURRENT_TIMESTAMP)
+        """)
+        cursor.execute("""CREATE TABLE IF NOT EXISTS user_aliases
+            (Alias TEXT PRIMARY KEY,
+            User_id INTEGER NOT NULL REFERENCES users(User_id))
+        """)
+
+        # Databases from before the users table have no User_id column yet
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(measurements)")}
+        if "User_id" not in columns:
+            cursor.execute("ALTER TABLE measurements ADD COLUMN User_id INTEGER REFERENCES users(User_id)")
+        if "Ocr_username" not in columns:
+            cursor.execute("ALTER TABLE measurements ADD COLUMN Ocr_username TEXT")
+
+        # SQLite has no table partitioning. This index keeps the rows of each user
+        # together and in time order, so per-user queries only read that user's range.
+        cursor.execute("""CREATE INDEX IF NOT EXISTS idx_measurements_user_datetime
+            ON measurements (User_id, Measurement_datetime)""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_measurements_image_name ON measurements (Image_name)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_measurements_datetime ON measurements (Measurement_datetime)")
+
+        # OCR confidence (0-100) of every value, by rowid of the measurement and field
+        cursor.execute("""CREATE TABLE IF NOT EXISTS field_confidence
+            (Measurement_id INTEGER NOT NULL,
+            Field TEXT NOT NULL,
+            Value TEXT,
+            Confidence REAL NOT NULL,
+            PRIMARY KEY (Measurement_id, Field)) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+        rollups_exist = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'measurement_rollups'"
+        ).fetchone()
+        self._create_rollups_table(cursor)
+        self._conn.commit()
+
+        self._load_aliases()
+        self._rollup_metrics = self._metric_columns()
+        if self._assign_users() or not rollups_exist or self._missing_rollups():
+            self.rebuild_rollups()
+
+    def _create_measurements_table(self, cursor: sqlite3.Cursor) -> None:
+        """Create the measurements table if it doesn't exist."""
+        create_table = """CREATE TABLE IF NOT EXISTS measurements
+            (Device_name TEXT,
+            Username TEXT,
+            Measurement_datetime DATETIME,
+            Image_name TEXT,
+            Gewicht REAL,
+            BMI REAL,
+            Lichaamsvet REAL,
+            Vetmassa REAL,
+            Spiermassa REAL,
+            Spiersnelheid REAL,
+            Skeletspier REAL,
+            Botmassa REAL,
+            Eiwitmassa REAL,
+            Eiwit REAL,
+            Watergewicht REAL,
+            Lichaamswater REAL,
+            BMR INT,
+            WHR REAL,
+            fatarmleft TEXT,
+            fatarmright TEXT,
+            fatstomach TEXT,
+            fatlegleft TEXT,
+            fatlegright TEXT,
+            musclearmleft TEXT,
+            musclearmright TEXT,
+            musclestomach TEXT,
+            musclelegleft TEXT,
+            musclelegright TEXT,
+            onderhuidsvet REAL,
+            visceraalvet REAL,
+            Vetvrijemassa REAL,
+            Lichaamsleeftijd INT,
+            User_id INTEGER REFERENCES users(User_id),
+            Ocr_username TEXT)
+        """
+        cursor.execute(create_table)
+
+    def _create_rollups_table(self, cursor: sqlite3.Cursor) -> None:
+        """Create the table with the daily, weekly and monthly rollups per user and metric."""
+        cursor.execute("""CREATE TABLE IF NOT EXISTS measurement_rollups
+            (User_id INTEGER NOT NULL,
+            Metric TEXT NOT NULL,
+            Period TEXT NOT NULL,
+            Period_start DATE NOT NULL,
+            Count INTEGER NOT NULL,
+            Sum REAL NOT NULL,
+            Min REAL NOT NULL,
+            Max REAL NOT NULL,
+            Last_value REAL NOT NULL,
+            Last_datetime DATETIME NOT NULL,
+            PRIMARY KEY (User_id, Metric, Period, Period_start)) WITHOUT ROWID
+        """)
+
+    def _metric_columns(self) -> List[str]:
+        """Columns of the measurements table with measurements, these get rollups."""
+        return [
+            row[1] for row in self._conn.execute("PRAGMA table_info(measurements)")
+            if row[1] not in METADATA_COLUMNS
+        ]
+
+    def _missing_rollups(self) -> bool:
+        """Whether a metric with values has no rollups, like the segments in databases from before they had them."""
+        rolled_up = {row[0] for row in self._conn.execute("SELECT DISTINCT Metric FROM measurement_rollups")}
+        missing = [metric for metric in self._rollup_metrics if metric not in rolled_up]
+        if not missing:
+            return False
+        condition = " OR ".join(METRIC_CONDITION.format(metric=metric) for metric in missing)
+        return self._conn.execute(
+            f"SELECT 1 FROM measurements WHERE User_id IS NOT NULL AND ({condition}) LIMIT 1"
+        ).fetchone() is not None
+
+    def _update_rollups(self, rowid: int) -> None:
+        """Add one new measurement to the rollups, without committing."""
+        for metric in self._rollup_metrics:
+            value = METRIC_VALUE.format(metric=metric)
+            condition = METRIC_CONDITION.format(metric=metric)
+            for period, expression in ROLLUP_PERIODS.items():
+                period_start = expression.format(dt="Measurement_datetime")
+                self._conn.execute(f"""INSERT INTO measurement_rollups
+                    SELECT User_id, ?, ?, {period_start}, 1, {value}, {value}, {value}, {value}, Measurement_datetime
+                    FROM measurements
+                    WHERE rowid = ? AND User_id IS NOT NULL AND {condition}
+                    ON CONFLICT (User_id, Metric, Period, Period_start) DO UPDATE SET
+                        Count = Count + 1,
+                        Sum = Sum + excluded.Sum,
+                        Min = MIN(Min, excluded.Min),
+                        Max = MAX(Max, excluded.Max),
+                        Last_value = CASE WHEN excluded.Last_datetime >= Last_datetime
+                            THEN excluded.Last_value ELSE Last_value END,
+                        Last_datetime = MAX(Last_datetime, excluded.Last_datetime)
+                    """, (metric, period, rowid))
+
+    def rebuild_rollups(self) -> None:
+        """Recompute all rollups from the measurements, e.g. after a backfill."""
+        self.conn.execute("DELETE FROM measurement_rollups")
+        for metric in self._rollup_metrics:
+            value = METRIC_VALUE.format(metric=metric)
+            condition = METRIC_CONDITION.format(metric=metric)
+            for period, expression in ROLLUP_PERIODS.items():
+                period_start = expression.format(dt="Measurement_datetime")
+                self._conn.execute(f"""INSERT INTO measurement_rollups
+                    SELECT User_id, ?, ?, Period_start, COUNT(*), SUM(Value), MIN(Value), MAX(Value),
+                    MAX(Last_value), MAX(Measurement_datetime)
+                    FROM (SELECT User_id, {period_start} AS Period_start, {value} AS Value, Measurement_datetime,
+                        LAST_VALUE({value}) OVER (
+                            PARTITION BY User_id, {period_start} ORDER BY Measurement_datetime
+                            ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) AS Last_value
+                        FROM measurements
+                        WHERE User_id IS NOT NULL AND {condition})
+                    GROUP BY User_id, Period_start
+                    """, (metric, period))
+        self._conn.commit()
+        logger.info("Rebuilt the measurement rollups")
+
+    def _assign_users(self) -> int:
+        """Link measurements without a User_id to their user.
+
+        Returns:
+            Number of usernames that were linked
+        """
+        rows = self._conn.execute(
+            "SELECT DISTINCT Username FROM measurements WHERE User_id IS NULL AND Username IS NOT NULL"
+        ).fetchall()
+        for (username,) in rows:
+            user_id = self.resolve_user(username)
+            self._conn.execute(
+                "UPDATE measurements SET User_id = ? WHERE User_id IS NULL AND Username = ?",
+                (user_id, username)
+            )
+        if rows:
+            self._conn.commit()
+            logger.info(f"Linked measurements of {len(rows)} usernames to users")
+        return len(rows)
+
+    @staticmethod
+    def normalize_username(username: str) -> str:
+        """Reduce a username to lowercase letters and digits, which OCR gets right most often."""
+        return re.sub(r"[\W_]+", "", username.casefold())
+
+    @staticmethod
+    def _ocr_skeleton(alias: str) -> str:
+        """Normalized username with the characters that OCR confuses folded together."""
+        return alias.translate(OCR_CONFUSABLES)
+
+    @staticmethod
+    def _one_edit_apart(a: str, b: str) -> bool:
+        """Whether two strings differ by at most one inserted, deleted or replaced character."""
+        if abs(len(a) - len(b)) > 1:
+            return False
+        if len(a) > len(b):
+            a, b = b, a
+        # Skip the common prefix, the rest must match after one edit
+        i = 0
+        while i < len(a) and a[i] == b[i]:
+            i += 1
+        return a[i + 1:] == b[i + 1:] if len(a) == len(b) else a[i:] == b[i + 1:]
+
+    def _is_variant(self, alias: str, existing: str) -> bool:
+        """Whether a normalized username is an OCR variant of the normalized name of an existing user."""
+        a, b = self._ocr_skeleton(alias), self._ocr_skeleton(existing)
+        if a == b:
+            return True
+        return min(len(a), len(b)) >= self.min_typo_length and self._one_edit_apart(a, b)
+
+    def _load_aliases(self) -> None:
+        """Fill the alias cache from the database."""
+        self._alias_cache = dict(self._conn.execute("SELECT Alias, User_id FROM user_aliases"))
+
+    def resolve_user(self, username: str, create: bool = True) -> Optional[int]:
+        """Return the User_id for a username read from an image.
+
+        Known variants come from the alias cache. A new variant is stored as
+        an alias of an existing user if it only differs in characters that OCR
+        confuses (I/l/1, O/0, dashes, spaces), or in one character of a long
+        name. Otherwise it is a new user.
+
+        Args:
+            username: Username as read by OCR
+            create: Whether to create a new user if the username is no variant of an existing user
+
+        Returns:
+            User_id of the user, or None if there is no such user and create is False
+        """
+        alias = self.normalize_username(username)
+        if alias in self._alias_cache:
+            return self._alias_cache[alias]
+
+        variant_of = next((
+            user_id for user_id, existing in self.conn.execute("SELECT User_id, Username FROM users ORDER BY User_id")
+            if self._is_variant(alias, self.normalize_username(existing))
+        ), None)
+
+        if variant_of is not None:
+            user_id = variant_of
+            logger.info(f"Username '{username}' is a variant of user {user_id}")
+        elif not create:
+            return None
+        else:
+            cursor = self.conn.execute("INSERT INTO users (Username) VALUES (?)", (username.strip(),))
+            user_id = cursor.lastrowid
+            logger.info(f"New user '{username}' with id {user_id}")
+
+        self.conn.execute("INSERT OR REPLACE INTO user_aliases (Alias, User_id) VALUES (?, ?)", (alias, user_id))
+        self.conn.commit()
+        self._alias_cache[alias] = user_id
+        return user_id
+
+    def get_username(self, user_id: int) -> str:
+        """Return the canonical username of a user."""
+        row = self.conn.execute("SELECT Username FROM users WHERE User_id = ?", (user_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown user id {user_id}")
+        return row[0]
+
+    def measurement_for_image(self, image_path: str) -> Optional[int]:
+        """Rowid of the measurement of an image, or None if it has not been saved."""
+        row = self.conn.execute("SELECT rowid FROM measurements WHERE Image_name = ?", (image_path,)).fetchone()
+        return row[0] if row else None
+
+    def get_processed_images(self) -> List[str]:
+        """Get list of already processed images from the database."""
+        try:
+            rows = self.conn.execute("SELECT Image_name FROM measurements").fetchall()
+            # Extract filenames without path (or archive) from non-None entries
+            return [image_name(row[0]) for row in rows if row[0] is not None]
+        except sqlite3.Error as e:
+            logger.error(f"Database error: {e}")
+            return []
+
+    def insert_measurement(
+        self,
+        record: MeasurementRecord,
+        confidences: Optional[Dict[str, float]] = None
+    ) -> int:
+        """Insert the measurement of one image into the database.
+
+        The username is replaced by the canonical username of the user, the
+        username as read is kept in Ocr_username, and the rollups of the user
+        are updated in the same transaction.
+
+        Args:
+            record: Measurement record with the extracted health data
+            confidences: OCR confidence per field of the record
+
+        Returns:
+            Rowid of the new measurement
+        """
+        return self.insert_measurements([record], [confidences] if confidences else None)[0]
+
+    def insert_measurements(
+        self,
+        records: List[MeasurementRecord],
+        confidences: Optional[List[Optional[Dict[str, float]]]] = None
+    ) -> List[int]:
+        """Insert the measurements of several images in one transaction.
+
+        Records of the same schema share one positional insert statement.
+        Fields without a value are stored as NULL. If anything fails, the
+        transaction is rolled back and none of the records is stored.
+
+        Args:
+            records: Measurement records with the extracted health data
+            confidences: OCR confidence per field, one dictionary (or None) per record
+
+        Returns:
+            Rowids of the new measurements, in the order of the records
+        """
+        if not records:
+            return []
+        # Users are resolved first, creating a user commits
+        user_ids = [self.resolve_user(record["Username"]) for record in records]
+
+        rowids: List[int] = []
+        # Commits at the end, or rolls back, so a failure doesn't leave half a batch
+        # in an open transaction that holds the lock and is committed by the next insert
+        with self.conn:
+            # Consecutive records of the same schema share one statement
+            start = 0
+            while start < len(records):
+                schema = records[start].schema
+                end = start
+                while end < len(records) and records[end].schema is schema:
+                    end += 1
+                rowids.extend(self._insert_batch(schema, records[start:end], user_ids[start:end]))
+                start = end
+
+            for rowid in rowids:
+                self._update_rollups(rowid)
+            if confidences:
+                self.conn.executemany(
+                    """INSERT OR REPLACE INTO field_confidence (Measurement_id, Field, Value, Confidence)
+                    VALUES (?, ?, ?, ?)""",
+                    [(rowid, field, record.get(field), confidence)
+                     for rowid, record, fields in zip(rowids, records, confidences) if fields
+                     for field, confidence in fields.items()]
+                )
+        return rowids
+
+    def _insert_batch(self, schema: RecordSchema, records: List[MeasurementRecord], user_ids: List[int]) -> List[int]:
+        """Insert records of one schema without committing and return their rowids."""
+        username_index = schema.index["Username"]
+        params = []
+        for record, user_id in zip(records, user_ids):
+            values = list(record.to_params())
+            ocr_username = values[username_index]
+            values[username_index] = self.get_username(user_id)
+            params.append(values + [user_id, ocr_username])
+
+        # Every row is inserted on its own, so its rowid comes from the insert itself and
+        # not from the table, where other processes may have added rows in the meantime
+        statement = schema.insert_statement(extra_columns=("User_id", "Ocr_username"))
+        return [self.conn.execute(statement, values).lastrowid for values in params]
+
+    def export_user(self, username: str, csv_path: str) -> int:
+        """Export all measurements of one user to a CSV file.
+
+        Args:
+            username: Username or one of its OCR variants
+            csv_path: Path of the CSV file to write
+
+        Returns:
+            Number of exported measurements
+        """
+        user_id = self.resolve_user(username, create=False)
+        if user_id is None:
+            raise KeyError(f"Unknown user '{username}'")
+        cursor = self.conn.execute(
+            "SELECT * FROM measurements WHERE User_id = ? ORDER BY Measurement_datetime", (user_id,)
+        )
+        header = [column[0] for column in cursor.description]
+        count = 0
+        with open(csv_path, "w", encoding="utf8", newline="") as file:
+            writer = csv.writer(file, delimiter=";")
+            writer.writerow(header)
+            for row in cursor:
+                writer.writerow(row)
+                count += 1
+        logger.info(f"Exported {count} measurements of {self.get_username(user_id)} to {csv_path}")
+        return count
@@ -0,0 +1,230 @@
+""" Fingerprints of images, to recognise a measurement that was processed before.
+
+The same measurement arrives more than once: shared again from the app,
+AirDropped twice or saved under another name. Every processed image gets
+fingerprints in the database: the SHA-256 of the file, for exact copies, and a
+difference hash (dHash) of the header, for copies that were re-encoded. The
+header holds the username, the date and the summary values, so two different
+measurements never have the same header. Both are checked before any OCR.
+
+A dHash is too coarse to see that one digit of the time differs, so it only
+selects candidates. A candidate is confirmed with a small grayscale thumbnail
+of the header: re-encoding changes every pixel a little, another digit
+changes a few pixels a lot.
+"""
+import hashlib
+import logging
+import sqlite3
+from typing import NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Size of the dHash grid, 32 x 16 = 512 bits
+HASH_WIDTH = 32
+HASH_HEIGHT = 16
+# Maximum number of differing bits for a header to be a candidate duplicate
+MAX_DISTANCE = 48
+# Scale of the header thumbnail, and the maximum local difference (0-255) of a duplicate
+THUMBNAIL_SCALE = 0.25
+MAX_THUMBNAIL_DIFFERENCE = 20
+# Size of the window the thumbnail difference is averaged over, about one character
+DIFFERENCE_WINDOW = 3
+
+
+class Fingerprint(NamedTuple):
+    """Exact and perceptual fingerprint of one image."""
+    sha256: str
+    dhash: bytes
+    thumbnail: np.ndarray
+
+
+def dhash(img: np.ndarray, box: Tuple[int, int, int, int]) -> bytes:
+    """Difference hash of a region of an image.
+
+    The region is scaled down to a small grayscale grid and every bit tells
+    whether a pixel is brighter than its right neighbour. JPEG re-encoding or
+    scaling changes a few bits, other text usually changes more.
+
+    Args:
+        img: Decoded image
+        box: Region to hash (x_start, x_end, y_start, y_end)
+
+    Returns:
+        Packed bits of the hash
+    """
+    x_start, x_end, y_start, y_end = box
+    region = img[y_start:y_end, x_start:x_end]
+    if region.ndim == 3:
+        region = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(region, (HASH_WIDTH + 1, HASH_HEIGHT), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1]).tobytes()
+
+
+def thumbnail(img: np.ndarray, box: Tuple[int, int, int, int]) -> np.ndarray:
+    """Small grayscale copy of a region of an image."""
+    x_start, x_end, y_start, y_end = box
+    region = img[y_start:y_end, x_start:x_end]
+    if region.ndim == 3:
+        region = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(region, None, fx=THUMBNAIL_SCALE, fy=THUMBNAIL_SCALE, interpolation=cv2.INTER_AREA)
+
+
+def thumbnail_difference(a: np.ndarray, b: np.ndarray) -> float:
+    """Largest difference between two thumbnails, averaged over a window of about one character."""
+    if a.shape != b.shape:
+        return 255.0
+    difference = cv2.absdiff(a, b).astype(np.float32)
+    return float(cv2.blur(difference, (DIFFERENCE_WINDOW, DIFFERENCE_WINDOW)).max())
+
+
+def file_hash(data: bytes) -> str:
+    """SHA-256 of the content of an image file, the same for exact copies."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def fingerprint(
+    data: bytes,
+    img: np.ndarray,
+    box: Tuple[int, int, int, int],
+    sha256: Optional[str] = None
+) -> Fingerprint:
+    """Fingerprint of an image from its file content and the decoded image.
+
+    Args:
+        data: Content of the image file
+        img: Decoded image
+        box: Header region (x_start, x_end, y_start, y_end)
+        sha256: file_hash of the data, if it was computed already
+    """
+    return Fingerprint(sha256 or file_hash(data), dhash(img, box), thumbnail(img, box))
+
+
+class FingerprintIndex:
+    """Fingerprints of the processed images, with the measurement they belong to."""
+
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        max_distance: int = MAX_DISTANCE,
+        max_difference: float = MAX_THUMBNAIL_DIFFERENCE
+    ):
+        """Load the fingerprints.
+
+        Args:
+            conn: Connection to the measurements database
+            max_distance: Maximum number of differing dHash bits of a candidate duplicate
+            max_difference: Maximum thumbnail difference of a duplicate
+        """
+        self.conn = conn
+        self.max_distance = max_distance
+        self.max_difference = max_difference
+        self._create_table()
+        rows = self.conn.execute("SELECT Image_name, Dhash FROM image_fingerprints WHERE Duplicate = 0").fetchall()
+        # One row of packed hash bits per processed image, compared all at once
+        self._image_names = [row[0] for row in rows]
+        self._hashes = np.array([np.frombuffer(row[1], dtype=np.uint8) for row in rows], dtype=np.uint8)
+
+    def _create_table(self) -> None:
+        """Create the fingerprints table if it doesn't exist."""
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS image_fingerprints
+            (Image_name TEXT PRIMARY KEY,
+            Sha256 TEXT NOT NULL,
+            Dhash BLOB NOT NULL,
+            Thumbnail BLOB NOT NULL,
+            Measurement_id INTEGER NOT NULL,
+            Duplicate INTEGER NOT NULL DEFAULT 0,
+            Created_at DATETIME DEFAULT CURRENT_TIMESTAMP)
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_image_fingerprints_sha256 ON image_fingerprints (Sha256)")
+        self.conn.commit()
+
+    def linked_measurement(self, image_name: str) -> Optional[int]:
+        """Measurement an image was linked to when it was processed, or None."""
+        row = self.conn.execute("SELECT Measurement_id FROM image_fingerprints WHERE Image_name = ?",
+                                (image_name,)).fetchone()
+        return row[0] if row else None
+
+    def find_exact(self, sha256: str) -> Optional[int]:
+        """Measurement of an image with exactly the same file content."""
+        row = self.conn.execute("SELECT Measurement_id FROM image_fingerprints WHERE Sha256 = ? LIMIT 1",
+                                (sha256,)).fetchone()
+        return row[0] if row else None
+
+    def find_similar(self, fp: Fingerprint) -> Optional[Tuple[int, float]]:
+        """Measurement of an image with the same header, if there is one.
+
+        Returns:
+            Tuple of (measurement rowid, thumbnail difference), or None
+        """
+        if not self._image_names:
+            return None
+        query = np.frombuffer(fp.dhash, dtype=np.uint8)
+        distances = np.unpackbits(self._hashes ^ query, axis=1).sum(axis=1)
+
+        # Confirm the candidates with the thumbnails, closest first
+        for index in np.argsort(distances, kind="stable"):
+            if distances[index] > self.max_distance:
+                break
+            measurement_id, png = self.conn.execute(
+                "SELECT Measurement_id, Thumbnail FROM image_fingerprints WHERE Image_name = ?",
+                (self._image_names[index],)
+            ).fetchone()
+            stored = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+            difference = thumbnail_difference(fp.thumbnail, stored)
+            logger.debug(f"Header differs {distances[index]} bits and {difference:.0f} from measurement "
+                         f"{measurement_id}")
+            if difference <= self.max_difference:
+                return measurement_id, difference
+        return None
+
+    def find(self, fp: Fingerprint) -> Optional[int]:
+        """Measurement of an earlier copy of the image, or None if it is new."""
+        measurement_id = self.find_exact(fp.sha256)
+        if measurement_id is not None:
+            logger.debug(f"Exact copy of measurement {measurement_id}")
+            return measurement_id
+
+        similar = self.find_similar(fp)
+        return similar[0] if similar is not None else None
+
+    def same_image(self, a: Fingerprint, b: Fingerprint) -> bool:
+        """Whether two fingerprints are of the same image, by the rules of find()."""
+        if a.sha256 == b.sha256:
+            return True
+        bits = np.frombuffer(a.dhash, dtype=np.uint8) ^ np.frombuffer(b.dhash, dtype=np.uint8)
+        distance = np.unpackbits(bits).sum()
+        return distance <= self.max_distance and thumbnail_difference(a.thumbnail, b.thumbnail) <= self.max_difference
+
+    def add_exact_copy(self, image_name: str, sha256: str, measurement_id: int) -> None:
+        """Store an exact copy of an earlier image as a duplicate, without decoding it.
+
+        The copy has the content of the earlier image, so it gets its hashes and thumbnail.
+        """
+        self.conn.execute("""INSERT OR REPLACE INTO image_fingerprints
+            (Image_name, Sha256, Dhash, Thumbnail, Measurement_id, Duplicate)
+            SELECT ?, Sha256, Dhash, Thumbnail, ?, 1 FROM image_fingerprints WHERE Sha256 = ? LIMIT 1""",
+            (image_name, measurement_id, sha256))
+        self.conn.commit()
+
+    def add(self, image_name: str, fp: Fingerprint, measurement_id: int, duplicate: bool = False) -> None:
+        """Store the fingerprint of a processed image.
+
+        Args:
+            image_name: Image the fingerprint belongs to
+            fp: Fingerprint of the image
+            measurement_id: Rowid of the measurement of the image, or of the
+                measurement it is a duplicate of
+            duplicate: Whether the image is a copy of an earlier image
+        """
+        _, png = cv2.imencode(".png", fp.thumbnail)
+        self.conn.execute("""INSERT OR REPLACE INTO image_fingerprints
+            (Image_name, Sha256, Dhash, Thumbnail, Measurement_id, Duplicate) VALUES (?, ?, ?, ?, ?, ?)""",
+            (image_name, fp.sha256, fp.dhash, png.tobytes(), measurement_id, int(duplicate)))
+        self.conn.commit()
+        if not duplicate and image_name not in self._image_names:
+            self._image_names.append(image_name)
+            row = np.frombuffer(fp.dhash, dtype=np.uint8)[np.newaxis]
+            self._hashes = row if self._hashes.size == 0 else np.vstack([self._hashes, row])
@@ -1,51 +1,61 @@
-import sqlite3
+import argparse
+
 import matplotlib.pyplot as plt
-# import datetime
-
-# Start date
-start_date = "datetime.datetime(2021, 1, 1)"
-
-# Read the health data from the database
-conn = sqlite3.connect('/Volumes/backup/sqlite/fitdays_health_data.db', detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-c = conn.cursor()
-query = """SELECT Measurement_datetime as "[timestamp]",
-           Gewicht, Lichaamsvet
-           FROM measurements 
-           ORDER BY Measurement_datetime
-        """
-
-c.execute(query)
-rows = c.fetchall()
-print(rows)
-conn.close()
-
-# Create a graph with the Date on the x-axis and the Weight on the y-axis
-dates = []
-weights = []
-fatpercent = []
-for row in rows:
-    print(row)
-    dates.append(row[0])
-    weights.append(row[1])
-    fatpercent.append(row[2])
 
-plt.figure(figsize=(1600/100, 600/100))
+from robiocr.fitdays_timeseries import TimeSeriesStore, downsample, resample, rolling_mean
+
+SQLITE_DB = "/Volumes/backup/sqlite/fitdays_health_data.db"
+
+parser = argparse.ArgumentParser(description="Plot a measurement over time.")
+parser.add_argument("--db", default=SQLITE_DB, help="Path to the SQLite database")
+parser.add_argument("--metric", default="Gewicht", help="Column to plot, like Gewicht or Lichaamsvet")
+parser.add_argument("--user", help="Only plot the measurements of this user")
+parser.add_argument("--start", help="First date to plot (YYYY-MM-DD)")
+parser.add_argument("--end", help="Plot measurements before this date (YYYY-MM-DD)")
+parser.add_argument("--resample", choices=["D", "W", "M"], help="Plot the mean and min/max per day, week or month")
+parser.add_argument("--rolling", type=float, help="Also plot the rolling average over this many days")
+parser.add_argument("--points", type=int, default=1000, help="Maximum number of points to plot")
+args = parser.parse_args()
+
+# Read the health data from the database, filters are done in SQL
+store = TimeSeriesStore(args.db)
+if args.resample and store.has_rollups and not args.rolling:
+    # The rollup table has one row per period, no need to read all measurements
+    series = None
+    envelope = store.load_rollup(args.metric, args.resample, user=args.user, start=args.start, end=args.end)
+    found = len(envelope.times) > 0
+else:
+    series = store.load(args.metric, user=args.user, start=args.start, end=args.end)
+    envelope = resample(series, args.resample) if args.resample else None
+    found = len(series) > 0
+store.close()
+if not found:
+    raise SystemExit(f"No {args.metric} measurements found")
 
-# Minimum y-axis value is 0
-plt.ylim(min(weights) - 15, max(weights) + 5)
-# plt.ylim(min(fatpercent) - 15, max(fatpercent) + 5)
+plt.figure(figsize=(1600/100, 600/100))
 
 # Show date on x axis as date
 plt.gca().xaxis_date()
 
 # Show x-axis labels only every 5 values
 plt.gca().xaxis.set_major_locator(plt.MaxNLocator(5))
-# plt.figure(figsize=(1600/100, 600/100))
-plt.plot(dates, weights)
-# plt.plot(dates, fatpercent)
+
+if envelope is not None:
+    plt.fill_between(envelope.times, envelope.min, envelope.max, alpha=0.3, label="min/max")
+    plt.plot(envelope.times, envelope.mean, label=f"mean per {args.resample}")
+    plt.ylim(envelope.min.min() - 15, envelope.max.max() + 5)
+else:
+    # Only plot as many points as the chart can show
+    points = downsample(series, args.points)
+    plt.plot(points.times, points.values, label=args.metric)
+    plt.ylim(points.values.min() - 15, points.values.max() + 5)
+
+if args.rolling:
+    average = downsample(series._replace(values=rolling_mean(series, args.rolling)), args.points)
+    plt.plot(average.times, average.values, label=f"{args.rolling:g} day average")
 
 plt.xlabel('Measurement_datetime')
-plt.ylabel('Weight')
-plt.title('Weight over time')
+plt.ylabel(args.metric)
+plt.title(f'{args.metric} over time' + (f' ({args.user})' if args.user else ''))
+plt.legend()
 plt.show()
-
@@ -0,0 +1,108 @@
+""" Parsing of the header of a Fitdays image: the username and the date and time of the measurement.
+
+The header is read with OCR, which now and then adds blank lines, reads a 0
+as an O or drops the colon from the time. The parser tolerates that, and if
+there is no date to recover at all the extractor falls back to the EXIF date or the
+modification time of the file, so the image doesn't have to be skipped.
+"""
+import io
+import logging
+import re
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Union
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:00.000'
+
+# Characters that OCR confuses with digits
+DIGIT_LOOKALIKES = str.maketrans({"O": "0", "o": "0", "D": "0", "Q": "0", "I": "1", "l": "1", "|": "1",
+                                  "S": "5", "B": "8", "Z": "2"})
+
+# Time and date, like 11:09 01/01/2026, with optional or misread separators
+DATE_PATTERN = re.compile(
+    r"(?P<hour>\d{1,2})\s*[:.;,]?\s*(?P<minute>\d{2})\s*"
+    r"(?P<first>\d{1,2})\s*[/\\\-.]\s*(?P<second>\d{1,2})\s*[/\\\-.]\s*(?P<year>\d{4})"
+)
+
+# EXIF tags with the date the picture was taken
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 36867
+EXIF_DATETIME = 306
+
+
+class Header(NamedTuple):
+    """Username and date parsed from the header, and the line the date was read from."""
+    username: Optional[str]
+    date: Optional[datetime]
+    date_line: Optional[str] = None
+
+
+def parse_header(header_text: str, date_formats: List[str]) -> Header:
+    """Parse the username and date from the OCR text of the header.
+
+    The date is the first line that looks like a time and a date after
+    replacing characters that OCR confuses with digits. The username is the
+    first non-empty line above it.
+
+    Args:
+        header_text: OCR text of the header
+        date_formats: strptime formats of the time and date, like '%H:%M %d/%m/%Y'
+
+    Returns:
+        Header with None for the parts that could not be recovered
+    """
+    lines = [line.strip() for line in header_text.split("\n") if line.strip()]
+
+    for index, line in enumerate(lines):
+        date = _parse_date_line(line, date_formats)
+        if date is not None:
+            username = lines[0] if index > 0 else None
+            return Header(username, date, line)
+
+    return Header(lines[0] if lines else None, None)
+
+
+def _parse_date_line(line: str, date_formats: List[str]) -> Optional[datetime]:
+    """Parse one line as time and date, or return None."""
+    # Exact match first, this is what a clean OCR result looks like
+    for date_format in date_formats:
+        try:
+            return datetime.strptime(line, date_format)
+        except ValueError:
+            pass
+
+    match = DATE_PATTERN.search(line.translate(DIGIT_LOOKALIKES))
+    if match is None:
+        return None
+
+    # Rebuild the line with clean separators and try the formats again
+    clean = "{hour}:{minute} {first}/{second}/{year}".format(**match.groupdict())
+    for date_format in date_formats:
+        try:
+            return datetime.strptime(clean, date_format)
+        except ValueError:
+            pass
+
+    logger.debug(f"Date line '{line}' looks like a date but matches none of {date_formats}")
+    return None
+
+
+def exif_date(image: Union[str, bytes]) -> Optional[datetime]:
+    """Date the picture was taken from the EXIF data of an image, or None if it has none.
+
+    Args:
+        image: Path to the image, or its content
+    """
+    try:
+        with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as img:
+            exif = img.getexif()
+            value = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+        if value:
+            return datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+    except (OSError, ValueError) as e:
+        logger.debug(f"No EXIF date: {e}")
+    return None
+
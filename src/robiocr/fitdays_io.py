@@ -0,0 +1,108 @@
+""" Background I/O for the side effects of processing an image.
+
+Writing the CSV and Excel files, copying the database and moving images to
+the backup folder on the NAS don't affect the OCR of the next image, so they
+run in background threads. Every kind of task has its own lane: a lane runs
+its tasks one at a time in the order they were submitted, so a move or a copy
+never overtakes an earlier one, while different lanes run side by side. Tasks
+that only need the latest state (like the database copy) can be coalesced:
+when a newer task of the lane is waiting, the older one is skipped. Tasks
+that fail with an OSError, like a network volume that is briefly gone, are
+retried with an increasing delay.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundIO:
+    """Lanes of ordered background tasks with retries."""
+
+    def __init__(self, retries: int = 3, retry_delay: float = 1.0):
+        """Initialize the lanes.
+
+        Args:
+            retries: Attempts of a task that fails with an OSError
+            retry_delay: Delay before the second attempt in seconds, doubled for every next attempt
+        """
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._lanes: Dict[str, ThreadPoolExecutor] = {}
+        self._latest: Dict[str, int] = {}
+        self._futures: List[Future] = []
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def submit(self, lane: str, fn: Callable, *args, coalesce: bool = False) -> Future:
+        """Run a task in the background, after the earlier tasks of its lane.
+
+        Args:
+            lane: Name of the lane, like 'csv' or 'backup'
+            fn: Function to run
+            *args: Arguments of the function
+            coalesce: Skip the task if a newer task of the lane is submitted before it starts
+
+        Returns:
+            Future with False if the task failed, True otherwise
+        """
+        with self._lock:
+            if lane not in self._lanes:
+                self._lanes[lane] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"io-{lane}")
+            sequence = self._latest.get(lane, 0) + 1
+            self._latest[lane] = sequence
+            future = self._lanes[lane].submit(self._run, lane, sequence, coalesce, fn, args)
+            self._futures = [f for f in self._futures if not f.done()] + [future]
+        return future
+
+    def _run(self, lane: str, sequence: int, coalesce: bool, fn: Callable, args: tuple) -> bool:
+        """Run one task with retries."""
+        if coalesce and sequence != self._latest[lane]:
+            logger.debug(f"Skipping {lane} task {sequence}, a newer one is waiting")
+            return True
+
+        for attempt in range(1, self.retries + 1):
+            try:
+                fn(*args)
+                return True
+            except OSError as e:
+                if attempt == self.retries:
+                    logger.error(f"{lane} failed after {attempt} attempts: {e}")
+                    return self._failed()
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning(f"{lane} failed, retrying in {delay:.0f}s: {e}")
+                time.sleep(delay)
+            except Exception as e:
+                logger.error(f"{lane} failed: {e}")
+                return self._failed()
+        return False
+
+    def _failed(self) -> bool:
+        """Count a failed task."""
+        with self._lock:
+            self._failures += 1
+        return False
+
+    def flush(self) -> int:
+        """Wait until all submitted tasks are finished.
+
+        Returns:
+            Number of tasks that failed since the previous flush
+        """
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+        with self._lock:
+            failures, self._failures = self._failures, 0
+        return failures
+
+    def close(self) -> None:
+        """Finish all tasks and stop the threads."""
+        self.flush()
+        with self._lock:
+            for executor in self._lanes.values():
+                executor.shutdown(wait=True)
+            self._lanes.clear()
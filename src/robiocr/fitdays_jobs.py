@@ -0,0 +1,218 @@
+""" Persistent queue of images to process, in the measurements database.
+
+Every image gets a row in the jobs table when it is found in the download
+folder. Workers claim jobs one at a time in a write transaction, so several
+extractor processes can share one queue without processing an image twice.
+A job that fails goes back to pending with an increasing delay and is only
+marked failed, with the reason, after the maximum number of attempts. A
+process that dies leaves its job running. The worker name holds the host and
+the process id, so a worker on the same host sees that the process is gone
+and hands the job out again at once; jobs of other hosts are handed out again
+once they have been running for longer than stale_after.
+"""
+import logging
+import os
+import socket
+import sqlite3
+from typing import Dict, Iterable, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+STATES = (PENDING, RUNNING, DONE, FAILED)
+
+
+class Job(NamedTuple):
+    """A claimed job."""
+    id: int
+    image_path: str
+    attempts: int
+
+
+def worker_name() -> str:
+    """Name of this process in the jobs table."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _process_exists(pid: int) -> bool:
+    """Whether a process with this id is running on this host."""
+    if os.name == "nt":
+        # Signal 0 would send a Ctrl-C on Windows, assume it runs and leave it to stale_after
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Runs as another user
+        return True
+    return True
+
+
+class JobQueue:
+    """Queue of image jobs with states, attempts and backoff, stored in SQLite."""
+
+    def __init__(
+        self,
+        db_path: str,
+        max_attempts: int = 3,
+        backoff_seconds: int = 60,
+        stale_after: int = 900
+    ):
+        """Open the queue.
+
+        Args:
+            db_path: Path to the SQLite database
+            max_attempts: Attempts before a job is marked failed
+            backoff_seconds: Delay before the second attempt, doubled for every next attempt
+            stale_after: Seconds after which a running job of a worker on another host is considered abandoned
+        """
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.stale_after = stale_after
+        # Autocommit mode, transactions are started explicitly where a claim needs one
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self._create_table()
+
+    def _create_table(self) -> None:
+        """Create the jobs table if it doesn't exist."""
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs
+            (Job_id INTEGER PRIMARY KEY,
+            Image_path TEXT NOT NULL UNIQUE,
+            State TEXT NOT NULL DEFAULT 'pending',
+            Attempts INTEGER NOT NULL DEFAULT 0,
+            Not_before DATETIME DEFAULT CURRENT_TIMESTAMP,
+            Worker TEXT,
+            Claimed_at DATETIME,
+            Finished_at DATETIME,
+            Error TEXT,
+            Measurement_id INTEGER,
+            Created_at DATETIME DEFAULT CURRENT_TIMESTAMP)
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (State, Not_before)")
+
+    def close(self) -> None:
+        """Close the connection to the database."""
+        self.conn.close()
+
+    def enqueue(self, image_paths: Iterable[str]) -> int:
+        """Add images to the queue, images that already have a job are skipped.
+
+        Returns:
+            Number of new jobs
+        """
+        before = self.conn.total_changes
+        self.conn.execute("BEGIN")
+        self.conn.executemany("INSERT OR IGNORE INTO jobs (Image_path) VALUES (?)", ((path,) for path in image_paths))
+        self.conn.execute("COMMIT")
+        return self.conn.total_changes - before
+
+    def known_images(self) -> set:
+        """Paths of all images with a job, in any state."""
+        return {row[0] for row in self.conn.execute("SELECT Image_path FROM jobs")}
+
+    def claim(self, worker: Optional[str] = None) -> Optional[Job]:
+        """Claim the next job that is due.
+
+        The job is selected and marked running in one write transaction
+        (BEGIN IMMEDIATE), so no other worker can claim it at the same time.
+
+        Args:
+            worker: Name of the worker, defaults to host:pid
+
+        Returns:
+            The claimed job, or None if no job is due
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._reclaim_dead_workers()
+            row = self.conn.execute(f"""SELECT Job_id, Image_path, Attempts FROM jobs
+                WHERE (State = '{PENDING}' AND Not_before <= CURRENT_TIMESTAMP)
+                OR (State = '{RUNNING}' AND Claimed_at <= datetime('now', ?))
+                ORDER BY Job_id LIMIT 1""", (f"-{self.stale_after} seconds",)).fetchone()
+            if row is None:
+                self.conn.execute("COMMIT")
+                return None
+            job = Job(row[0], row[1], row[2] + 1)
+            self.conn.execute(f"""UPDATE jobs SET State = '{RUNNING}', Attempts = ?, Worker = ?,
+                Claimed_at = CURRENT_TIMESTAMP WHERE Job_id = ?""", (job.attempts, worker or worker_name(), job.id))
+            self.conn.execute("COMMIT")
+        except sqlite3.Error:
+            self.conn.execute("ROLLBACK")
+            raise
+        if job.attempts > 1:
+            logger.info(f"Attempt {job.attempts} of {job.image_path}")
+        return job
+
+    def _reclaim_dead_workers(self) -> None:
+        """Put the running jobs of workers on this host whose process is gone back in the queue."""
+        host = socket.gethostname()
+        for job_id, image_path, worker in self.conn.execute(
+            f"SELECT Job_id, Image_path, Worker FROM jobs WHERE State = '{RUNNING}' AND Worker LIKE ? || ':%'",
+            (host,)
+        ).fetchall():
+            pid = worker[len(host) + 1:]
+            if not pid.isdigit() or _process_exists(int(pid)):
+                continue
+            self.conn.execute(f"""UPDATE jobs SET State = '{PENDING}', Not_before = CURRENT_TIMESTAMP, Error = ?
+                WHERE Job_id = ?""", (f"Worker {worker} stopped during the job", job_id))
+            logger.warning(f"Worker {worker} stopped while processing {image_path}, queueing it again")
+
+    def complete(self, job: Job, measurement_id: Optional[int] = None) -> None:
+        """Mark a job done."""
+        self.conn.execute(f"""UPDATE jobs SET State = '{DONE}', Finished_at = CURRENT_TIMESTAMP, Error = NULL,
+            Measurement_id = ? WHERE Job_id = ?""", (measurement_id, job.id))
+
+    def fail(self, job: Job, error: str) -> None:
+        """Record a failed attempt.
+
+        The job is retried after a delay that doubles with every attempt, and
+        marked failed after max_attempts so a broken image isn't retried forever.
+        """
+        if job.attempts >= self.max_attempts:
+            self.conn.execute(f"""UPDATE jobs SET State = '{FAILED}', Finished_at = CURRENT_TIMESTAMP, Error = ?
+                WHERE Job_id = ?""", (error, job.id))
+            logger.error(f"Giving up on {job.image_path} after {job.attempts} attempts: {error}")
+            return
+
+        delay = self.backoff_seconds * 2 ** (job.attempts - 1)
+        self.conn.execute(f"""UPDATE jobs SET State = '{PENDING}', Not_before = datetime('now', ?), Error = ?
+            WHERE Job_id = ?""", (f"+{delay} seconds", error, job.id))
+        logger.warning(f"Attempt {job.attempts} of {job.image_path} failed, retrying in {delay}s: {error}")
+
+    def release(self, job: Job, reason: str, delay: Optional[int] = None) -> None:
+        """Put a claimed job back without counting the attempt, for when the worker couldn't run it.
+
+        Args:
+            job: The claimed job
+            reason: Why the job wasn't run, stored as its error
+            delay: Seconds before the job is due again, defaults to backoff_seconds
+        """
+        delay = self.backoff_seconds if delay is None else delay
+        self.conn.execute(f"""UPDATE jobs SET State = '{PENDING}', Attempts = ?, Not_before = datetime('now', ?),
+            Error = ? WHERE Job_id = ?""", (job.attempts - 1, f"+{delay} seconds", reason, job.id))
+        logger.info(f"Released {job.image_path}, due again in {delay}s: {reason}")
+
+    def retry_failed(self) -> int:
+        """Put all failed jobs back in the queue with a fresh set of attempts.
+
+        Returns:
+            Number of jobs put back
+        """
+        cursor = self.conn.execute(f"""UPDATE jobs SET State = '{PENDING}', Attempts = 0,
+            Not_before = CURRENT_TIMESTAMP, Finished_at = NULL WHERE State = '{FAILED}'""")
+        return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs per state."""
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.conn.execute("SELECT State, COUNT(*) FROM jobs GROUP BY State").fetchall())
+        return counts
+
+    def failures(self) -> Dict[str, str]:
+        """Failure reason per image of the failed jobs."""
+        return dict(self.conn.execute(f"SELECT Image_path, Error FROM jobs WHERE State = '{FAILED}'").fetchall())
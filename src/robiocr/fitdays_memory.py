@@ -0,0 +1,141 @@
+""" Memory use of the extractor process, for running within a fixed budget.
+
+On a small NAS several extractor workers share little RAM. The budget is
+checked before an image is decoded: if the resident memory plus the expected
+cost of the image would go over it, the image is not started (its job is
+retried later) instead of pushing the machine into swap.
+
+The resident memory is read from /proc on Linux, from psutil if it is
+installed, and from the Mach kernel on macOS. Where none of them works the
+budget is not enforced: the peak that getrusage reports never goes down, so
+checking against it would refuse every image after the first large one.
+"""
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import sys
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """Processing an image would take the process over its memory budget."""
+
+
+class _MachTaskBasicInfo(ctypes.Structure):
+    """mach_task_basic_info from <mach/task_info.h>."""
+    _fields_ = [
+        ("virtual_size", ctypes.c_uint64),
+        ("resident_size", ctypes.c_uint64),
+        ("resident_size_max", ctypes.c_uint64),
+        ("user_time", ctypes.c_int32 * 2),
+        ("system_time", ctypes.c_int32 * 2),
+        ("policy", ctypes.c_int32),
+        ("suspend_count", ctypes.c_int32),
+    ]
+
+
+MACH_TASK_BASIC_INFO = 20
+
+
+def _mach_rss() -> Optional[int]:
+    """Resident memory of this process on macOS, from task_info."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        task = ctypes.c_uint32.in_dll(libc, "mach_task_self_")
+        info = _MachTaskBasicInfo()
+        count = ctypes.c_uint32(ctypes.sizeof(info) // ctypes.sizeof(ctypes.c_uint32))
+        if libc.task_info(task, MACH_TASK_BASIC_INFO, ctypes.byref(info), ctypes.byref(count)) != 0:
+            return None
+        return int(info.resident_size)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def current_rss() -> Optional[int]:
+    """Resident memory of this process in bytes, or None if the platform doesn't tell."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if sys.platform == "darwin":
+        return _mach_rss()
+    return None
+
+
+def peak_rss() -> Optional[int]:
+    """Highest resident memory of this process so far, in bytes, or None on Windows."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def release_memory() -> None:
+    """Collect garbage and give freed heap memory back to the operating system (glibc only)."""
+    gc.collect()
+    libc_name = ctypes.util.find_library("c")
+    if libc_name and sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL(libc_name).malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+class MemoryBudget:
+    """Peak resident memory the process should stay under."""
+
+    def __init__(self, limit_mb: int):
+        """Initialize the budget.
+
+        Args:
+            limit_mb: Maximum resident memory in MB
+        """
+        self.limit = limit_mb * MB
+        self._warned = False
+
+    def check(self, needed: int, what: str = "image") -> None:
+        """Make sure there is room for `needed` more bytes.
+
+        Freed memory is given back first; if that isn't enough, the work must not start.
+        Without a way to read the resident memory the budget isn't enforced.
+
+        Raises:
+            MemoryBudgetExceeded: If the resident memory plus `needed` is over the budget
+        """
+        rss = current_rss()
+        if rss is None:
+            if not self._warned:
+                logger.warning("The resident memory can't be read on this platform, the memory budget is not "
+                               "enforced (install psutil)")
+                self._warned = True
+            return
+        if rss + needed <= self.limit:
+            return
+
+        release_memory()
+        rss = current_rss() or rss
+        if rss + needed > self.limit:
+            raise MemoryBudgetExceeded(
+                f"{what} needs about {needed // MB} MB, {rss // MB} MB of the {self.limit // MB} MB budget is in use"
+            )
+        logger.debug(f"Released memory for {what}, {rss // MB} MB in use")
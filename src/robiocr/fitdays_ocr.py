@@ -0,0 +1,140 @@
+""" OCR with word-level confidences and bounding boxes.
+
+pytesseract.image_to_string throws away the confidence and position of every
+word, while Tesseract's TSV output has them from the same run. This module
+reads the TSV and groups the words into lines, so the text can be interpreted
+line by line like before and every value keeps its confidence.
+
+pytesseract writes every image and every result to a temporary file. Here the
+image is encoded in memory and piped to the tesseract program, which writes
+the TSV to its standard output, so nothing goes through the disk.
+"""
+import shlex
+import subprocess
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# Tesseract program, a full path if it isn't on the PATH
+TESSERACT_CMD = "tesseract"
+# Fast PNG compression, the image only goes through a pipe
+PNG_COMPRESSION = 1
+
+
+class TesseractError(RuntimeError):
+    """Tesseract failed on an image."""
+
+
+class Word(NamedTuple):
+    """One word found by Tesseract, with its confidence (0-100) and box."""
+    text: str
+    confidence: float
+    left: int
+    top: int
+    width: int
+    height: int
+
+    @property
+    def box(self) -> Tuple[int, int, int, int]:
+        """Box as (x_start, x_end, y_start, y_end), like the boxes in the profile layout."""
+        return self.left, self.left + self.width, self.top, self.top + self.height
+
+
+class OcrLine(NamedTuple):
+    """One line of words."""
+    words: List[Word]
+
+    @property
+    def text(self) -> str:
+        return " ".join(word.text for word in self.words)
+
+    @property
+    def confidence(self) -> float:
+        """Mean confidence of the words in the line."""
+        return sum(word.confidence for word in self.words) / len(self.words) if self.words else 0.0
+
+    def find_word(self, value: str) -> Optional[Word]:
+        """First word that contains the value."""
+        return next((word for word in self.words if value and value in word.text), None)
+
+
+def image_to_data(img: np.ndarray, config: str = "", tesseract_cmd: str = TESSERACT_CMD) -> Dict[str, List]:
+    """Run Tesseract on an image in memory and return its TSV output by column.
+
+    Args:
+        img: Image to OCR
+        config: Tesseract configuration, like '--psm 6'
+        tesseract_cmd: Tesseract program
+
+    Returns:
+        Columns of the TSV (text, conf, left, ...), like pytesseract.image_to_data with Output.DICT
+
+    Raises:
+        FileNotFoundError: If the Tesseract program isn't installed
+        TesseractError: If Tesseract fails on the image
+    """
+    ok, png = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+    if not ok:
+        raise TesseractError("Could not encode the image for Tesseract")
+    result = subprocess.run(
+        [tesseract_cmd, "stdin", "stdout", *shlex.split(config), "tsv"],
+        input=png.tobytes(),
+        capture_output=True
+    )
+    if result.returncode != 0:
+        raise TesseractError(f"Tesseract exited with {result.returncode}: "
+                             f"{result.stderr.decode('utf8', 'replace').strip()}")
+
+    rows = result.stdout.decode("utf8", "replace").splitlines()
+    header = rows[0].split("\t") if rows else []
+    data: Dict[str, List] = {name: [] for name in header}
+    for row in rows[1:]:
+        values = row.split("\t")
+        if len(values) < len(header) - 1:
+            continue
+        # The text of rows without a word is missing
+        values += [""] * (len(header) - len(values))
+        for name, value in zip(header, values):
+            data[name].append(value if name == "text" else float(value) if name == "conf" else int(value))
+    return data
+
+
+def ocr_lines(img: np.ndarray, config: str = "", y_offset: int = 0) -> List[OcrLine]:
+    """OCR an image and return the lines with their words.
+
+    Args:
+        img: Image to OCR
+        config: Tesseract configuration, like '--psm 6'
+        y_offset: Added to the top of every word, for images cropped from a larger one
+
+    Returns:
+        Lines in reading order
+    """
+    data = image_to_data(img, config=config)
+
+    lines: List[OcrLine] = []
+    current_key = None
+    for i, text in enumerate(data["text"]):
+        confidence = float(data["conf"][i])
+        # Rows for pages, blocks, paragraphs and lines have confidence -1
+        if confidence < 0 or not text.strip():
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        if key != current_key:
+            lines.append(OcrLine([]))
+            current_key = key
+        lines[-1].words.append(Word(
+            text=text.strip(),
+            confidence=confidence,
+            left=data["left"][i],
+            top=data["top"][i] + y_offset,
+            width=data["width"][i],
+            height=data["height"][i]
+        ))
+    return lines
+
+
+def lines_to_text(lines: List[OcrLine]) -> str:
+    """Text of the lines, like image_to_string returns it."""
+    return "\n".join(line.text for line in lines)
@@ -0,0 +1,208 @@
+""" Measurement profiles for the images that the Fitdays app shares.
+
+A profile describes one language of one device: the labels and units of the
+measurements, the date format in the header and the layout of the page.
+Profiles are JSON files in the profiles folder and are compiled once into
+regular expressions, so interpreting OCR text doesn't loop over raw strings.
+"""
+import json
+import logging
+import re
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from robiocr.fitdays_record import METADATA_FIELDS, TEXT, Field, RecordSchema
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[int, int, int, int]
+
+# Tesseract configuration of regions without an OCR mode (psm 6 = single uniform block of text)
+DEFAULT_REGION_CONFIG = "--psm 6"
+
+
+def tesseract_config(mode: Dict) -> str:
+    """Tesseract configuration string of an OCR mode from the layout.
+
+    Args:
+        mode: OCR mode with optional keys psm, whitelist and dictionaries
+
+    Returns:
+        Configuration string, like '--psm 7 -c tessedit_char_whitelist=0123456789.kg'
+    """
+    options = [f"--psm {mode.get('psm', 6)}"]
+    if mode.get("whitelist"):
+        options.append(f"-c tessedit_char_whitelist={mode['whitelist']}")
+    if not mode.get("dictionaries", True):
+        # Numbers are not words, the dictionaries only slow Tesseract down and 'correct' digits
+        options.append("-c load_system_dawg=0 -c load_freq_dawg=0")
+    return " ".join(options)
+
+
+class Region(NamedTuple):
+    """A box on the page (x_start, x_end, y_start, y_end) that holds one value."""
+    id: str
+    box: Box
+    unit: str = ""
+    config: str = DEFAULT_REGION_CONFIG
+
+
+class CompiledMeasurement(NamedTuple):
+    """A measurement definition with the label that precedes its value in a line."""
+    id: str
+    name: str
+    column: str
+    unit: str
+    label: str
+    db_column: str
+
+
+class MeasurementProfile:
+    """One language/device profile, compiled into matchers."""
+
+    def __init__(self, definition: Dict, source: str = ""):
+        """Compile a profile definition.
+
+        Args:
+            definition: Parsed profile JSON
+            source: Where the definition came from, for log messages
+        """
+        self.source = source
+        self.device_name: str = definition["device_name"]
+        self.language: str = definition["language"]
+        self.date_formats: List[str] = definition.get("date_formats", ["%H:%M %d/%m/%Y"])
+        self.header_keywords: List[str] = definition.get("header_keywords", [])
+        self.key_measurements: List[str] = definition.get("key_measurements", [])
+
+        layout = definition.get("layout", {})
+        self.header_box: Box = tuple(layout.get("header", (0, 1290, 0, 290)))
+        self.text_region: Box = tuple(layout.get("text_region", (0, 1290, 0, 7509)))
+        # Named OCR modes, compiled once into Tesseract configuration strings
+        self.ocr_modes: Dict[str, str] = {name: tesseract_config(mode) for name, mode in layout.get("ocr", {}).items()}
+        self.segments = [self._region(s) for s in layout.get("segments", [])]
+        self.fields = {f["id"]: self._region(f) for f in layout.get("fields", [])}
+
+        self.measurements = [
+            CompiledMeasurement(
+                id=m["id"],
+                name=m["name"],
+                column=m.get("column", m["name"].replace(" ", "")),
+                unit=m["unit"],
+                label=m["string_in_line"],
+                db_column=m.get("db_column", m.get("column", m["name"].replace(" ", "")))
+            )
+            for m in definition["measurements"]
+        ]
+        self.by_id = {m.id: m for m in self.measurements}
+
+        # Records of this profile: metadata, measurements and segments, in this order
+        self.schema = RecordSchema(
+            METADATA_FIELDS
+            + [Field(m.column, m.db_column) for m in self.measurements]
+            + [Field(region.id, region.id, TEXT) for region in self.segments]
+        )
+
+        # One pattern for all labels, the value is the first word after the label.
+        # A label starts a word and the longest one is tried first, so "Weight "
+        # doesn't match inside "Water Weight " or "Body Weight ".
+        self._by_label = {m.label: m for m in self.measurements}
+        labels = sorted(self._by_label, key=len, reverse=True)
+        self._label_value = re.compile(r"(?<!\S)(" + "|".join(re.escape(label) for label in labels) + r")\s*(\S*)")
+        self._keywords = [re.compile(re.escape(k), re.IGNORECASE) for k in self.header_keywords]
+
+    def __repr__(self) -> str:
+        return f"MeasurementProfile({self.device_name!r}, {self.language!r})"
+
+    def _region(self, definition: Dict) -> Region:
+        """Region from the layout, with the Tesseract configuration of its OCR mode."""
+        mode = definition.get("ocr")
+        if mode is not None and mode not in self.ocr_modes:
+            raise ValueError(f"Unknown OCR mode '{mode}' for region '{definition['id']}' in {self.source}")
+        config = self.ocr_modes[mode] if mode is not None else DEFAULT_REGION_CONFIG
+        return Region(definition["id"], tuple(definition["box"]), definition.get("unit", ""), config)
+
+    @property
+    def key_columns(self) -> List[str]:
+        """Columns of the measurements that show that an OCR attempt worked."""
+        return [self.by_id[key].column for key in self.key_measurements if key in self.by_id]
+
+    def header_score(self, header_text: str) -> int:
+        """Count how many of the header keywords of this profile appear in the header text."""
+        return sum(1 for keyword in self._keywords if keyword.search(header_text))
+
+    def match_line(self, line: str) -> Iterator[Tuple[CompiledMeasurement, str]]:
+        """Find the measurements in one line of OCR text.
+
+        Args:
+            line: One line of OCR text
+
+        Yields:
+            Tuples of (measurement, value) with the unit removed from the value
+        """
+        # The matches don't overlap, the text of a longer label is consumed with its value
+        for match in self._label_value.finditer(line):
+            measure = self._by_label[match.group(1)]
+            value = match.group(2)
+            # Check if value starts with a digit
+            if not value or not value[0].isdigit():
+                continue
+
+            # Remove 4g as misspelling of kg for vetvrije massa
+            if measure.id == "fatfreemass" and "4g" in value:
+                value = value.replace("4g", "kg")
+
+            # Remove unit if present
+            if measure.unit and measure.unit in value:
+                value = value.split(measure.unit)[0]
+
+            yield measure, value
+
+
+class ProfileRegistry:
+    """All known measurement profiles, with detection from the header text."""
+
+    def __init__(self, profiles: List[MeasurementProfile], default_language: Optional[str] = None):
+        """Initialize the registry.
+
+        Args:
+            profiles: Compiled profiles
+            default_language: Language of the profile used when detection fails,
+                defaults to the first profile
+        """
+        if not profiles:
+            raise ValueError("No measurement profiles found")
+        self.profiles = profiles
+        self.default = next((p for p in profiles if p.language == default_language), profiles[0])
+
+    @classmethod
+    def from_path(cls, path: str, default_language: Optional[str] = "nl") -> "ProfileRegistry":
+        """Load profiles from a JSON file or from all JSON files in a folder."""
+        path_obj = Path(path)
+        files = sorted(path_obj.glob("*.json")) if path_obj.is_dir() else [path_obj]
+
+        profiles = []
+        for file in files:
+            try:
+                with open(file, "r", encoding="utf8") as json_file:
+                    profiles.append(MeasurementProfile(json.loads(json_file.read()), source=str(file)))
+            except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
+                logger.error(f"Failed to load measurement profile {file}: {e}")
+                raise
+
+        logger.debug(f"Loaded profiles: {profiles}")
+        return cls(profiles, default_language)
+
+    def detect(self, header_text: str) -> MeasurementProfile:
+        """Pick the profile whose header keywords best match the header text.
+
+        Args:
+            header_text: OCR text of the header of the image
+
+        Returns:
+            Best matching profile, or the default profile if no keyword matched
+        """
+        best = max(self.profiles, key=lambda profile: profile.header_score(header_text))
+        if best.header_score(header_text) == 0:
+            logger.warning(f"Could not detect the language of the header, using {self.default}")
+            return self.default
+        return best
@@ -0,0 +1,276 @@
+""" Incremental data-quality profile of the measurements table.
+
+Instead of profiling the whole history again (like ydata-profiling does),
+running statistics per column are kept in the database and updated with every
+batch of new measurements: counts, missing values, values that OCR got wrong
+(not a number), min/max, mean and variance (Welford/Chan) and a histogram.
+The statistics of every batch are kept as well, so a column that suddenly
+goes missing after a run stands out in the report. The profile stores the
+highest rowid it has seen; an update adds the measurements after it.
+"""
+import json
+import logging
+import math
+import sqlite3
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from robiocr.fitdays_database import METADATA_COLUMNS
+from robiocr.fitdays_record import parse_number
+
+logger = logging.getLogger(__name__)
+
+HISTOGRAM_BINS = 20
+# Report a column if the missing rate of the last batch is this much higher than overall
+MISSING_RATE_ALERT = 0.2
+# Rowids per query, older SQLite versions allow at most 999 parameters in a statement
+ROWID_CHUNK_SIZE = 500
+
+
+class ColumnStats:
+    """Running statistics of one column."""
+
+    __slots__ = ("rows", "missing", "failures", "count", "mean", "m2", "min", "max",
+                 "hist_low", "hist_high", "histogram")
+
+    def __init__(self):
+        self.rows = 0
+        self.missing = 0
+        self.failures = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.hist_low: Optional[float] = None
+        self.hist_high: Optional[float] = None
+        self.histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def missing_rate(self) -> float:
+        return self.missing / self.rows if self.rows else 0.0
+
+    @property
+    def failure_rate(self) -> float:
+        """Share of the non-missing values that are not a number."""
+        present = self.rows - self.missing
+        return self.failures / present if present else 0.0
+
+    def update(self, values: List) -> None:
+        """Add a batch of raw column values to the statistics."""
+        self.rows += len(values)
+        numbers = []
+        for value in values:
+            if value is None or (isinstance(value, str) and not value.strip()):
+                self.missing += 1
+                continue
+            number = parse_number(value)
+            if number is None:
+                self.failures += 1
+            else:
+                numbers.append(number)
+
+        if not numbers:
+            return
+        batch = np.array(numbers, dtype=np.float64)
+
+        # Chan et al.: combine the mean and M2 of the batch with the running ones
+        batch_count = len(batch)
+        batch_mean = batch.mean()
+        batch_m2 = ((batch - batch_mean) ** 2).sum()
+        total = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean += delta * batch_count / total
+        self.m2 += batch_m2 + delta ** 2 * self.count * batch_count / total
+        self.count = total
+        self.min = min(self.min, float(batch.min()))
+        self.max = max(self.max, float(batch.max()))
+
+        # The bins are fixed by the first batch, values outside fall in the outer bins
+        if self.hist_low is None:
+            self.hist_low, self.hist_high = float(batch.min()), float(batch.max())
+            if self.hist_low == self.hist_high:
+                self.hist_low, self.hist_high = self.hist_low - 1, self.hist_high + 1
+        width = (self.hist_high - self.hist_low) / HISTOGRAM_BINS
+        bins = np.clip(((batch - self.hist_low) / width).astype(np.int64), 0, HISTOGRAM_BINS - 1)
+        self.histogram += np.bincount(bins, minlength=HISTOGRAM_BINS)
+
+
+class MeasurementProfiler:
+    """Keeps the profile of the measurements table up to date, batch by batch."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        """Initialize the profiler.
+
+        Args:
+            conn: Connection to the measurements database
+        """
+        self.conn = conn
+        self._create_tables()
+
+    def _create_tables(self) -> None:
+        """Create the tables with the running and the per-batch statistics."""
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS data_profile
+            (Column_name TEXT PRIMARY KEY,
+            Rows INTEGER, Missing INTEGER, Failures INTEGER, Count INTEGER,
+            Mean REAL, M2 REAL, Min REAL, Max REAL,
+            Hist_low REAL, Hist_high REAL, Histogram TEXT,
+            Last_rowid INTEGER,
+            Updated_at DATETIME DEFAULT CURRENT_TIMESTAMP)
+        """)
+        # Profiles from before the watermark have no Last_rowid column yet
+        if "Last_rowid" not in {row[1] for row in self.conn.execute("PRAGMA table_info(data_profile)")}:
+            self.conn.execute("ALTER TABLE data_profile ADD COLUMN Last_rowid INTEGER")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS data_profile_batches
+            (Batch_id INTEGER, Column_name TEXT, Rows INTEGER, Missing INTEGER, Failures INTEGER, Mean REAL,
+            Created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (Batch_id, Column_name))
+        """)
+        self.conn.commit()
+
+    def _columns(self) -> List[str]:
+        """Measurement columns of the measurements table."""
+        return [row[1] for row in self.conn.execute("PRAGMA table_info(measurements)")
+                if row[1] not in METADATA_COLUMNS]
+
+    def load(self) -> Dict[str, ColumnStats]:
+        """Running statistics per column from the database."""
+        stats = {}
+        for row in self.conn.execute("""SELECT Column_name, Rows, Missing, Failures, Count, Mean, M2, Min, Max,
+                Hist_low, Hist_high, Histogram FROM data_profile"""):
+            column = ColumnStats()
+            (name, column.rows, column.missing, column.failures, column.count, column.mean, column.m2,
+             column.min, column.max, column.hist_low, column.hist_high, histogram) = row
+            column.min = math.inf if column.min is None else column.min
+            column.max = -math.inf if column.max is None else column.max
+            column.histogram = np.array(json.loads(histogram), dtype=np.int64)
+            stats[name] = column
+        return stats
+
+    def watermark(self) -> Optional[int]:
+        """Highest rowid of the measurements in the profile, or None for a profile from before the watermark."""
+        return self.conn.execute("SELECT MAX(Last_rowid) FROM data_profile").fetchone()[0]
+
+    def update(self) -> int:
+        """Add the measurements that were inserted since the last update to the profile, as one batch.
+
+        Measurements are profiled by rowid from the watermark on, so rows of a
+        run that crashed and rows saved by the upload service are included
+        the next time. The watermark is read and moved in one write
+        transaction, so workers that update at the same time don't profile a
+        row twice.
+
+        Returns:
+            Number of measurements that were added
+        """
+        if self.watermark() is None and self.conn.execute("SELECT 1 FROM data_profile LIMIT 1").fetchone():
+            # No watermark yet, the rows that are already in the profile are unknown
+            logger.info("Data profile has no watermark yet, profiling all measurements again")
+            return self.rebuild()
+
+        columns = self._columns()
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            last_rowid = self.watermark() or 0
+            # The rows are read in chunks of rowids, the whole batch is still profiled as one
+            rows = []
+            while True:
+                chunk = self.conn.execute(
+                    f"SELECT rowid, {column_list} FROM measurements WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, ROWID_CHUNK_SIZE)
+                ).fetchall()
+                if not chunk:
+                    break
+                last_rowid = chunk[-1][0]
+                rows.extend(row[1:] for row in chunk)
+            if rows:
+                self._update_columns(columns, rows, last_rowid)
+            else:
+                self.conn.rollback()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        return len(rows)
+
+    def rebuild(self) -> int:
+        """Profile the whole measurements table from scratch, as one batch.
+
+        Returns:
+            Number of measurements in the profile
+        """
+        self.conn.execute("DELETE FROM data_profile")
+        self.conn.execute("DELETE FROM data_profile_batches")
+        columns = self._columns()
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        rows = self.conn.execute(f"SELECT {column_list} FROM measurements").fetchall()
+        last_rowid = self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM measurements").fetchone()[0]
+        self._update_columns(columns, rows, last_rowid)
+        return len(rows)
+
+    def _update_columns(self, columns: List[str], rows: List[tuple], last_rowid: int) -> None:
+        """Update and store the statistics of every column with a batch of rows, up to rowid last_rowid."""
+        stats = self.load()
+        batch_id = self.conn.execute("SELECT COALESCE(MAX(Batch_id), 0) + 1 FROM data_profile_batches").fetchone()[0]
+
+        for index, name in enumerate(columns):
+            values = [row[index] for row in rows]
+            batch = ColumnStats()
+            batch.update(values)
+            column = stats.setdefault(name, ColumnStats())
+            column.update(values)
+
+            self.conn.execute("""INSERT OR REPLACE INTO data_profile
+                (Column_name, Rows, Missing, Failures, Count, Mean, M2, Min, Max, Hist_low, Hist_high, Histogram,
+                Last_rowid, Updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)""",
+                (name, column.rows, column.missing, column.failures, column.count, column.mean, column.m2,
+                 column.min if column.count else None, column.max if column.count else None,
+                 column.hist_low, column.hist_high, json.dumps(column.histogram.tolist()), last_rowid))
+            self.conn.execute("""INSERT INTO data_profile_batches
+                (Batch_id, Column_name, Rows, Missing, Failures, Mean) VALUES (?, ?, ?, ?, ?, ?)""",
+                (batch_id, name, batch.rows, batch.missing, batch.failures, batch.mean if batch.count else None))
+        self.conn.commit()
+        logger.info(f"Updated data profile with {len(rows)} measurements (batch {batch_id})")
+
+    def alerts(self) -> List[str]:
+        """Columns whose missing or OCR failure rate in the last batch is much higher than overall."""
+        stats = self.load()
+        messages = []
+        for name, rows, missing, failures in self.conn.execute("""SELECT Column_name, Rows, Missing, Failures
+                FROM data_profile_batches
+                WHERE Batch_id = (SELECT MAX(Batch_id) FROM data_profile_batches)"""):
+            if name not in stats or not rows:
+                continue
+            overall = stats[name]
+            if missing / rows - overall.missing_rate >= MISSING_RATE_ALERT:
+                messages.append(f"{name}: {missing}/{rows} missing in the last batch "
+                                f"(overall {overall.missing_rate:.0%})")
+            present = rows - missing
+            if present and failures / present - overall.failure_rate >= MISSING_RATE_ALERT:
+                messages.append(f"{name}: {failures}/{present} not a number in the last batch "
+                                f"(overall {overall.failure_rate:.0%})")
+        return messages
+
+    def report(self) -> str:
+        """Text report of the profile, one line per column, followed by the alerts."""
+        lines = [f"{'Column':<24}{'Rows':>7}{'Missing':>9}{'OCR fail':>10}{'Min':>10}{'Max':>10}"
+                 f"{'Mean':>10}{'Std':>9}"]
+        for name, column in sorted(self.load().items()):
+            if column.count:
+                numbers = f"{column.min:>10.2f}{column.max:>10.2f}{column.mean:>10.2f}{math.sqrt(column.variance):>9.2f}"
+            else:
+                numbers = f"{'':>10}{'':>10}{'':>10}{'':>9}"
+            lines.append(f"{name:<24}{column.rows:>7}{column.missing_rate:>9.1%}{column.failure_rate:>10.1%}{numbers}")
+
+        alerts = self.alerts()
+        if alerts:
+            lines.append("")
+            lines.append("Changes in the last batch:")
+            lines.extend(f"  {alert}" for alert in alerts)
+        return "\n".join(lines)
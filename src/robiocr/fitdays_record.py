@@ -0,0 +1,153 @@
+""" Typed measurement records with a fixed column order.
+
+The fields of a record come from the measurement profile: the metadata of the
+image, the measurements and the body segments. A record stores its values in
+a list in schema order, so it needs no dictionary per image, can be copied
+cheaply for every OCR attempt and converts straight to the positional
+parameters of the database insert. Fields that were not found stay None and
+are inserted as NULL, instead of failing because a named parameter is missing.
+"""
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+TEXT = "text"
+REAL = "real"
+
+
+def parse_number(value) -> Optional[float]:
+    """Value as a float, or None if it isn't a number (e.g. misread by OCR)."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip().replace(",", "."))
+    except ValueError:
+        return None
+
+
+
+class Field(NamedTuple):
+    """One field of a record and the column of the measurements table it is stored in."""
+    name: str
+    db_column: str
+    kind: str = REAL
+    # SQL expression of the parameter in the insert
+    sql: str = "?"
+
+
+# Metadata of every image, before the measurements
+METADATA_FIELDS = [
+    Field("Device_name", "Device_name", TEXT),
+    Field("Username", "Username", TEXT),
+    Field("Date", "Measurement_datetime", TEXT, "DATETIME(?)"),
+    Field("Image_name", "Image_name", TEXT),
+]
+
+
+class RecordSchema:
+    """Fields of the records of one profile, in a fixed order."""
+
+    def __init__(self, fields: List[Field]):
+        """Initialize the schema.
+
+        Args:
+            fields: Fields in the order of the values of a record
+        """
+        self.fields = list(fields)
+        self.names: Tuple[str, ...] = tuple(field.name for field in self.fields)
+        self.db_columns: Tuple[str, ...] = tuple(field.db_column for field in self.fields)
+        self.index: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+        if len(self.index) != len(self.fields):
+            raise ValueError(f"Duplicate field names in {self.names}")
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def new(self, **values: Any) -> "MeasurementRecord":
+        """New record with the given values and None for the other fields."""
+        record = MeasurementRecord(self, [None] * len(self.fields))
+        for name, value in values.items():
+            record[name] = value
+        return record
+
+    def insert_statement(self, table: str = "measurements", extra_columns: Tuple[str, ...] = ()) -> str:
+        """Positional INSERT statement for the records of this schema.
+
+        Args:
+            table: Table to insert into
+            extra_columns: Columns after the fields, like User_id
+
+        Returns:
+            INSERT statement with one parameter per field and extra column
+        """
+        columns = ", ".join(self.db_columns + extra_columns)
+        parameters = ", ".join([field.sql for field in self.fields] + ["?"] * len(extra_columns))
+        return f"INSERT INTO {table} ({columns}) VALUES ({parameters})"
+
+    def to_columns(self, records: Iterable["MeasurementRecord"]) -> Dict[str, np.ndarray]:
+        """Values of many records as one NumPy array per field.
+
+        Measurements become float64 arrays with NaN for missing values and
+        values that are not a number, text fields become object arrays.
+        """
+        rows = [record.values for record in records]
+        columns = {}
+        for i, field in enumerate(self.fields):
+            if field.kind == REAL:
+                numbers = (parse_number(row[i]) if row[i] is not None else None for row in rows)
+                columns[field.name] = np.fromiter(
+                    (np.nan if number is None else number for number in numbers), dtype=np.float64, count=len(rows)
+                )
+            else:
+                columns[field.name] = np.array([row[i] for row in rows], dtype=object)
+        return columns
+
+
+class MeasurementRecord:
+    """Values of one image, in the order of its schema.
+
+    Fields are read and set by name like a dictionary, unknown names raise a
+    KeyError so a typo can't silently add a column.
+    """
+
+    __slots__ = ("schema", "values")
+
+    def __init__(self, schema: RecordSchema, values: List[Any]):
+        self.schema = schema
+        self.values = values
+
+    def __getitem__(self, name: str) -> Any:
+        return self.values[self.schema.index[name]]
+
+    def __setitem__(self, name: str, value: Any) -> None:
+        self.values[self.schema.index[name]] = value
+
+    def __contains__(self, name: str) -> bool:
+        """Whether the field exists and has a value."""
+        index = self.schema.index.get(name)
+        return index is not None and self.values[index] is not None
+
+    def __repr__(self) -> str:
+        return f"MeasurementRecord({self.to_dict()!r})"
+
+    def get(self, name: str, default: Any = None) -> Any:
+        """Value of a field, or the default if it has no value."""
+        index = self.schema.index.get(name)
+        value = self.values[index] if index is not None else None
+        return default if value is None else value
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """Names and values of the fields that have a value."""
+        return ((name, value) for name, value in zip(self.schema.names, self.values) if value is not None)
+
+    def copy(self) -> "MeasurementRecord":
+        """Copy of the record."""
+        return MeasurementRecord(self.schema, list(self.values))
+
+    def to_params(self) -> Tuple[Any, ...]:
+        """Values as positional parameters of the insert statement of the schema."""
+        return tuple(self.values)
+
+    def to_dict(self, missing: Optional[Any] = None) -> Dict[str, Any]:
+        """All fields in schema order, with `missing` for the fields without a value."""
+        return {name: missing if value is None else value for name, value in zip(self.schema.names, self.values)}
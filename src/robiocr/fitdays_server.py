@@ -0,0 +1,386 @@
+""" Local HTTP service that reads the measurements from uploaded Fitdays images.
+
+Instead of AirDropping images into the download folder and waiting for the
+next run, a phone (or a shortcut on it) can post the image and gets the
+measurements back:
+
+    python -m robiocr.fitdays_server --port 8765 --save
+    curl --data-binary @IMG_1234.jpeg "http://localhost:8765/measurements?name=IMG_1234.jpeg"
+
+Uploads go into a bounded queue. A dispatcher thread takes what is waiting
+(up to --batch-size images, waiting at most --batch-wait seconds for more) and
+hands that micro-batch to a pool of worker processes. Every worker builds one
+extractor when it starts and keeps it, so profiles and thread pools are ready
+for the next image. The extractor comes from a factory, which can give it
+another OCR backend or decoder. When a worker process dies, for example
+because it was killed for using too much memory, the pool is started again.
+While all workers are busy the queue fills up; when it is full new uploads
+get a 503 with Retry-After instead of piling up.
+
+With --save the measurements are inserted into the database by one saver
+thread, a micro-batch at a time. Uploads of an image that was processed
+before, or of the same image earlier in the micro-batch, are recognised by
+their fingerprint and not saved again.
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from robiocr.extract_fitdays import LOG_FORMAT, PROFILES_FOLDER, RECIPES_FILE, SQLITE_DB, MeasurementExtractor
+from robiocr.fitdays_database import MeasurementDatabase
+from robiocr.fitdays_fingerprint import Fingerprint, FingerprintIndex, fingerprint
+from robiocr.fitdays_header import exif_date
+from robiocr.fitdays_profiles import ProfileRegistry
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+# Seconds an upload waits for its result before the request times out
+RESULT_TIMEOUT = 120
+
+# Extractor of a worker process, created once by _init_worker
+_extractor = None
+
+
+class Upload(NamedTuple):
+    """One uploaded image waiting for its result."""
+    name: str
+    data: bytes
+    received_at: datetime
+    result: Future
+
+
+def _init_worker(extractor_factory: Callable[[], MeasurementExtractor]) -> None:
+    """Create the extractor of a worker process, it is reused for every image."""
+    global _extractor
+    _extractor = extractor_factory()
+
+
+def _extract_batch(
+    images: List[Tuple[str, bytes, datetime]]
+) -> List[Tuple[Optional[Dict], Optional[Fingerprint], str]]:
+    """Read the measurements of a micro-batch of images in a worker process.
+
+    Returns:
+        One (result, fingerprint, error) per image, result and fingerprint are None if it failed
+    """
+    results = []
+    for name, data, received_at in images:
+        try:
+            img = _extractor.decoder(data, _extractor.low_memory)
+            if img is None:
+                raise ValueError("Not an image")
+            fp = fingerprint(data, img, _extractor.profiles.default.header_box)
+            # The time of the upload stands in for the file date
+            result = _extractor.extract(img, image_name=name, file_date=exif_date(data) or received_at)
+            results.append(({
+                "device": result.profile.device_name,
+                "language": result.profile.language,
+                "values": dict(result.record.items()),
+                "confidences": result.confidences,
+            }, fp, ""))
+        except Exception as e:
+            logger.error(f"Error processing upload {name}: {e}")
+            results.append((None, None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+class IngestService:
+    """Queue, micro-batching dispatcher, worker pool and saver of the uploads."""
+
+    def __init__(
+        self,
+        profiles_path: str,
+        db_path: Optional[str] = None,
+        workers: int = 2,
+        ocr_workers: int = 2,
+        queue_size: int = 32,
+        batch_size: int = 4,
+        batch_wait: float = 0.05,
+        extractor_factory: Optional[Callable[[], MeasurementExtractor]] = None
+    ):
+        """Start the worker processes and the dispatcher.
+
+        Args:
+            profiles_path: Path to the measurement profiles
+            db_path: Database to save the measurements in, None to only return them
+            workers: Number of worker processes
+            ocr_workers: Text blocks OCRed in parallel per worker
+            queue_size: Uploads that can wait before new ones are refused
+            batch_size: Maximum number of images per micro-batch
+            batch_wait: Seconds to wait for more images after the first of a micro-batch
+            extractor_factory: Creates the extractor of a worker process, for example with another
+                OCR backend; it is sent to the workers, so it has to be picklable. Defaults to a
+                MeasurementExtractor with the profiles of profiles_path and the recipes of RECIPES_FILE.
+        """
+        if extractor_factory is None:
+            extractor_factory = functools.partial(
+                MeasurementExtractor, profiles_path=profiles_path, ocr_workers=ocr_workers,
+                recipes_path=RECIPES_FILE
+            )
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.uploads: "queue.Queue[Upload]" = queue.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.extractor_factory = extractor_factory
+        self.pool = self._new_pool()
+        # One micro-batch per worker at a time, the rest waits in the bounded queue
+        self._free_workers = threading.Semaphore(workers)
+        self._stopping = threading.Event()
+
+        self.profiles = ProfileRegistry.from_path(profiles_path)
+        self.db_path = db_path
+        self._finished: "queue.Queue[Tuple[List[Upload], Future]]" = queue.Queue()
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name="dispatcher", daemon=True)
+        self._saver = threading.Thread(target=self._save, name="saver", daemon=True)
+        self._dispatcher.start()
+        self._saver.start()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        """Start the worker processes."""
+        return ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker, initargs=(self.extractor_factory,)
+        )
+
+    def submit(self, name: str, data: bytes) -> Optional[Future]:
+        """Queue an upload.
+
+        Returns:
+            Future with the response of the upload, or None if the queue is full
+        """
+        upload = Upload(name, data, datetime.now(), Future())
+        try:
+            self.uploads.put_nowait(upload)
+        except queue.Full:
+            return None
+        return upload.result
+
+    def _dispatch(self) -> None:
+        """Hand micro-batches of waiting uploads to free workers."""
+        while not self._stopping.is_set():
+            self._free_workers.acquire()
+            try:
+                batch = [self.uploads.get(timeout=0.5)]
+            except queue.Empty:
+                self._free_workers.release()
+                continue
+
+            # Uploads that arrive while the first one is taken are added to the batch
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.uploads.get(timeout=remaining) if remaining > 0 else self.uploads.get_nowait())
+                except queue.Empty:
+                    break
+
+            logger.debug(f"Dispatching a batch of {len(batch)} uploads")
+            images = [(u.name, u.data, u.received_at) for u in batch]
+            try:
+                future = self.pool.submit(_extract_batch, images)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for using too much memory), the batches it had failed.
+                # Without new processes every later batch would fail as well.
+                logger.warning("A worker process died, starting new worker processes")
+                self.pool.shutdown(wait=False)
+                self.pool = self._new_pool()
+                future = self.pool.submit(_extract_batch, images)
+            future.add_done_callback(lambda f, batch=batch: self._batch_done(batch, f))
+
+    def _batch_done(self, batch: List[Upload], future: Future) -> None:
+        """Free the worker and pass the results to the saver."""
+        self._free_workers.release()
+        self._finished.put((batch, future))
+
+    def _save(self) -> None:
+        """Save the results and answer the uploads, in the only thread that uses the database."""
+        db = MeasurementDatabase(self.db_path) if self.db_path else None
+        fingerprints = FingerprintIndex(db.conn) if db else None
+        # Profiles are per device and language
+        profiles = {(profile.device_name, profile.language): profile for profile in self.profiles.profiles}
+
+        while True:
+            item = self._finished.get()
+            if item is None:
+                break
+            batch, future = item
+            try:
+                results = future.result()
+            except Exception as e:
+                # A worker process died, the whole batch failed
+                results = [(None, None, f"{type(e).__name__}: {e}")] * len(batch)
+
+            responses = []
+            new = []
+            # Copies of an image that is new in this micro-batch, with the index of that image in new
+            copies = []
+            for upload, (result, fp, error) in zip(batch, results):
+                if result is None:
+                    responses.append({"image_name": upload.name, "error": error})
+                    continue
+                response = dict(result, image_name=upload.name)
+                responses.append(response)
+                if db is not None:
+                    duplicate_of = fingerprints.find(fp)
+                    if duplicate_of is not None:
+                        response["duplicate_of"] = duplicate_of
+                        fingerprints.add(upload.name, fp, duplicate_of, duplicate=True)
+                        continue
+                    # The new images of this micro-batch aren't in the index until they are saved
+                    original = next(
+                        (i for i, (_, other) in enumerate(new) if fingerprints.same_image(fp, other)), None
+                    )
+                    if original is not None:
+                        copies.append((response, fp, original))
+                    else:
+                        new.append((response, fp))
+
+            if new:
+                try:
+                    records = [profiles[r["device"], r["language"]].schema.new(**r["values"]) for r, _ in new]
+                    rowids = db.insert_measurements(records, [r["confidences"] for r, _ in new])
+                    for (response, fp), rowid in zip(new, rowids):
+                        response["measurement_id"] = rowid
+                        fingerprints.add(response["image_name"], fp, rowid)
+                    for response, fp, original in copies:
+                        response["duplicate_of"] = rowids[original]
+                        fingerprints.add(response["image_name"], fp, rowids[original], duplicate=True)
+                except Exception as e:
+                    logger.error(f"Error saving {len(new)} measurements: {e}")
+                    for response, _ in new:
+                        response["error"] = f"Not saved: {e}"
+                    for response, _, _ in copies:
+                        response["error"] = f"Not saved: {e}"
+
+            for upload, response in zip(batch, responses):
+                upload.result.set_result(response)
+
+        if db is not None:
+            db.close()
+
+    def status(self) -> Dict:
+        """Number of uploads waiting."""
+        return {"queued": self.uploads.qsize(), "queue_size": self.uploads.maxsize}
+
+    def close(self) -> None:
+        """Stop the dispatcher, the workers and the saver."""
+        self._stopping.set()
+        self._dispatcher.join()
+        self.pool.shutdown(wait=True)
+        self._finished.put(None)
+        self._saver.join()
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    """POST /measurements with the image as body, GET /health for the queue status."""
+
+    service: IngestService
+
+    def _send_json(self, status: HTTPStatus, body: Dict, headers: Optional[Dict[str, str]] = None) -> None:
+        content = json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self) -> None:
+        if urlparse(self.path).path != "/health":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+            return
+        self._send_json(HTTPStatus.OK, self.service.status())
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        if url.path != "/measurements":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": "Send the image as the request body"})
+            return
+        if length > MAX_UPLOAD_BYTES:
+            self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "Image too large"})
+            return
+        data = self.rfile.read(length)
+        name = parse_qs(url.query).get("name", [f"upload_{datetime.now():%Y%m%d_%H%M%S_%f}.jpeg"])[0]
+
+        result = self.service.submit(name, data)
+        if result is None:
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": "Too many uploads, try again"},
+                            headers={"Retry-After": "1"})
+            return
+        try:
+            response = result.result(timeout=RESULT_TIMEOUT)
+        except FutureTimeout:
+            self._send_json(HTTPStatus.GATEWAY_TIMEOUT, {"error": "Timed out"})
+            return
+        status = HTTPStatus.UNPROCESSABLE_ENTITY if "values" not in response else HTTPStatus.OK
+        self._send_json(status, response)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.info(f"{self.address_string()} {format % args}")
+
+
+def serve(host: str, port: int, service: IngestService) -> None:
+    """Serve uploads until interrupted."""
+    handler = type("Handler", (IngestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    logger.info(f"Listening on http://{host}:{port}/measurements")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def main():
+    """Run the ingest service."""
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+    parser = argparse.ArgumentParser(description="HTTP service that reads measurements from uploaded images.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on, 0.0.0.0 for the whole network")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--save", action="store_true", help="Save the measurements in the database")
+    parser.add_argument("--db", default=SQLITE_DB, help="Path to the SQLite database")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Number of worker processes")
+    parser.add_argument("--ocr-workers", type=int, default=2, help="Text blocks OCRed in parallel per worker")
+    parser.add_argument("--queue-size", type=int, default=32, help="Uploads that can wait before new ones get a 503")
+    parser.add_argument("--batch-size", type=int, default=4, help="Maximum number of images per micro-batch")
+    parser.add_argument("--batch-wait", type=float, default=0.05,
+                        help="Seconds to wait for more uploads before a micro-batch is dispatched")
+    args = parser.parse_args()
+
+    service = IngestService(
+        profiles_path=PROFILES_FOLDER,
+        db_path=args.db if args.save else None,
+        workers=args.workers,
+        ocr_workers=args.ocr_workers,
+        queue_size=args.queue_size,
+        batch_size=args.batch_size,
+        batch_wait=args.batch_wait
+    )
+    serve(args.host, args.port, service)
+
+
+if __name__ == "__main__":
+    main()
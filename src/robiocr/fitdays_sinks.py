@@ -0,0 +1,111 @@
+""" Outputs that a saved measurement is written to besides the database.
+
+The measurements database is the record the job queue and the fingerprints
+refer to, so the extractor inserts into it itself. Everything else is a sink:
+the CSV and Excel files with the latest measurement and the copy of the
+database on the backup volume. Sinks run in the background lanes of
+BackgroundIO, the OCR of the next image doesn't wait for them. A sink that
+only writes the latest state is coalesced: when newer writes of it are
+waiting, only the newest one runs.
+
+Other outputs (a web hook, a different spreadsheet) can be added by passing
+more sinks to MeasurementExtractor.
+"""
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class Sink(ABC):
+    """Output of saved measurements."""
+
+    # Background lane of the sink, writes of one lane run in order
+    lane = "sink"
+    # Skip a write when a newer one is waiting
+    coalesce = False
+
+    @abstractmethod
+    def write(self, row: Dict[str, Any]) -> None:
+        """Write one saved measurement.
+
+        Args:
+            row: All fields of the record in schema order, '' for missing values
+
+        Raises:
+            OSError: If the write may work when retried
+        """
+
+
+class CsvSink(Sink):
+    """Latest measurement as a CSV file with a header."""
+
+    lane = "csv"
+    coalesce = True
+
+    def __init__(self, path: str = "health_data.csv"):
+        self.path = path
+
+    def write(self, row: Dict[str, Any]) -> None:
+        with open(self.path, "w", encoding="utf8") as file:
+            # Write header (keys)
+            file.write(";".join(row.keys()) + "\n")
+            # Write values
+            file.write(";".join(str(value) for value in row.values()) + "\n")
+        logger.info("Data saved to CSV")
+
+
+class ExcelSink(Sink):
+    """Latest measurement as an Excel file."""
+
+    lane = "excel"
+    coalesce = True
+
+    def __init__(self, path: str = "health_data.xlsx"):
+        self.path = path
+
+    def write(self, row: Dict[str, Any]) -> None:
+        df = pd.DataFrame(row, index=[0])
+        df.to_excel(self.path)
+        logger.info("Data saved to Excel")
+
+
+class DatabaseCopySink(Sink):
+    """Copy of the measurements database, for example on a backup volume."""
+
+    lane = "database copy"
+    coalesce = True
+
+    def __init__(self, db_path: str, target: str):
+        """Initialize the sink.
+
+        Args:
+            db_path: Path to the measurements database
+            target: Path of the copy
+        """
+        self.db_path = db_path
+        self.target = target
+
+    def write(self, row: Dict[str, Any]) -> None:
+        """Copy the database to the target.
+
+        The SQLite backup API makes a consistent copy while the extractor
+        keeps inserting measurements.
+        """
+        Path(self.target).parent.mkdir(parents=True, exist_ok=True)
+        src = sqlite3.connect(self.db_path)
+        dst = sqlite3.connect(self.target)
+        try:
+            src.backup(dst)
+        except sqlite3.OperationalError as e:
+            # Locked or unreachable, worth another attempt
+            raise OSError(str(e)) from e
+        finally:
+            dst.close()
+            src.close()
+        logger.info(f"Database copied to {self.target}")
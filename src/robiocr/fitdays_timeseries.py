@@ -0,0 +1,281 @@
+""" Time series of the measurements in the fitdays database, backed by NumPy.
+
+Filters on user and date range are done in SQL, so only the rows that are
+needed are read. Resampling, rolling averages and downsampling for plotting
+are done on NumPy arrays.
+"""
+import sqlite3
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from robiocr.fitdays_database import METADATA_COLUMNS, METRIC_CONDITION, METRIC_VALUE
+
+# Seconds in a day
+DAY = 86400
+
+# Frequencies of resample and the periods of the rollup table
+ROLLUP_PERIODS = {"D": "day", "W": "week", "M": "month"}
+
+
+class Series(NamedTuple):
+    """Measurements of one metric: times as datetime64[s] and values as float64."""
+    times: np.ndarray
+    values: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+
+class Envelope(NamedTuple):
+    """Resampled measurements: per period the mean, minimum, maximum and count."""
+    times: np.ndarray
+    mean: np.ndarray
+    min: np.ndarray
+    max: np.ndarray
+    count: np.ndarray
+
+
+class TimeSeriesStore:
+    """Load measurements from the fitdays database as time series."""
+
+    def __init__(self, db_path: str):
+        """Open the database read-only.
+
+        Args:
+            db_path: Path to the SQLite database
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        self._columns = set()
+        self.has_rollups = False
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Read the columns and tables again, after the extractor changed the schema."""
+        self._columns = {row[1] for row in self.conn.execute("PRAGMA table_info(measurements)")}
+        self.has_rollups = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'measurement_rollups'"
+        ).fetchone() is not None
+
+    def close(self) -> None:
+        """Close the connection to the database."""
+        self.conn.close()
+
+    @property
+    def metrics(self) -> List[str]:
+        """Columns of the measurements table that can be loaded as a series."""
+        return sorted(self._columns - METADATA_COLUMNS)
+
+    def users(self) -> List[str]:
+        """Usernames in the database."""
+        return [row[0] for row in self.conn.execute("SELECT Username FROM users ORDER BY Username")]
+
+    def data_version(self) -> int:
+        """Number that changes whenever another connection commits to the database."""
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def date_range(self) -> Tuple[Optional[str], Optional[str]]:
+        """Dates (YYYY-MM-DD) of the first and last measurement."""
+        return self.conn.execute(
+            "SELECT date(MIN(Measurement_datetime)), date(MAX(Measurement_datetime)) FROM measurements"
+        ).fetchone()
+
+    def load(
+        self,
+        metric: str,
+        user: Optional[str] = None,
+        start: Optional[str] = None,
+        end: Optional[str] = None
+    ) -> Series:
+        """Load one metric as a time series.
+
+        Args:
+            metric: Column of the measurements table, like Gewicht
+            user: Only load the measurements of this user
+            start: Only load measurements from this date on (YYYY-MM-DD)
+            end: Only load measurements before this date (YYYY-MM-DD)
+
+        Returns:
+            Series sorted by time, without missing values and values that aren't a number
+        """
+        if metric not in self._columns:
+            raise ValueError(f"Unknown metric: {metric}")
+
+        conditions = [METRIC_CONDITION.format(metric=metric)]
+        params = []
+        if user is not None:
+            conditions.append("User_id = (SELECT User_id FROM users WHERE Username = ?)")
+            params.append(user)
+        if start is not None:
+            conditions.append("Measurement_datetime >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("Measurement_datetime < ?")
+            params.append(end)
+
+        query = f"""SELECT CAST(strftime('%s', Measurement_datetime) AS INTEGER), {METRIC_VALUE.format(metric=metric)}
+            FROM measurements
+            WHERE {" AND ".join(conditions)}
+            ORDER BY Measurement_datetime
+        """
+        rows = np.fromiter(
+            self.conn.execute(query, params),
+            dtype=[("time", np.int64), ("value", np.float64)]
+        )
+        return Series(rows["time"].astype("datetime64[s]"), rows["value"])
+
+    def load_rollup(
+        self,
+        metric: str,
+        freq: str,
+        user: Optional[str] = None,
+        start: Optional[str] = None,
+        end: Optional[str] = None
+    ) -> Envelope:
+        """Load a resampled metric from the rollup table instead of the measurements.
+
+        Gives the same result as resample(load(...), freq), but only reads one
+        row per period. Without a user, the rollups of all users are combined.
+
+        Args:
+            metric: Column of the measurements table, like Gewicht
+            freq: 'D', 'W' or 'M'
+            user: Only load the rollups of this user
+            start: Only load periods starting from this date on (YYYY-MM-DD)
+            end: Only load periods starting before this date (YYYY-MM-DD)
+
+        Returns:
+            Mean, minimum, maximum and count per period
+        """
+        if freq not in ROLLUP_PERIODS:
+            raise ValueError(f"Unknown frequency: {freq}")
+
+        conditions = ["Metric = ?", "Period = ?"]
+        params = [metric, ROLLUP_PERIODS[freq]]
+        if user is not None:
+            conditions.append("User_id = (SELECT User_id FROM users WHERE Username = ?)")
+            params.append(user)
+        if start is not None:
+            conditions.append("Period_start >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("Period_start < ?")
+            params.append(end)
+
+        query = f"""SELECT CAST(strftime('%s', Period_start) AS INTEGER), SUM(Sum) / SUM(Count),
+            MIN(Min), MAX(Max), SUM(Count)
+            FROM measurement_rollups
+            WHERE {" AND ".join(conditions)}
+            GROUP BY Period_start
+            ORDER BY Period_start
+        """
+        rows = np.fromiter(
+            self.conn.execute(query, params),
+            dtype=[("time", np.int64), ("mean", np.float64), ("min", np.float64), ("max", np.float64),
+                   ("count", np.int64)]
+        )
+        return Envelope(rows["time"].astype("datetime64[s]").astype("datetime64[D]"),
+                        rows["mean"], rows["min"], rows["max"], rows["count"])
+
+
+def period_starts(times: np.ndarray, freq: str) -> np.ndarray:
+    """Start of the day ('D'), week starting on Monday ('W') or month ('M') of every time."""
+    days = times.astype("datetime64[D]")
+    if freq == "D":
+        return days
+    if freq == "W":
+        # 1970-01-01 was a Thursday
+        day_numbers = days.astype(np.int64)
+        return (day_numbers - (day_numbers + 3) % 7).astype("datetime64[D]")
+    if freq == "M":
+        return times.astype("datetime64[M]").astype("datetime64[D]")
+    raise ValueError(f"Unknown frequency: {freq}")
+
+
+def resample(series: Series, freq: str) -> Envelope:
+    """Aggregate a series per day, week or month.
+
+    Args:
+        series: Series sorted by time
+        freq: 'D', 'W' or 'M'
+
+    Returns:
+        Mean, minimum, maximum and count per period
+    """
+    if len(series) == 0:
+        empty = np.array([], dtype=np.float64)
+        return Envelope(np.array([], dtype="datetime64[D]"), empty, empty, empty, np.array([], dtype=np.int64))
+
+    keys = period_starts(series.times, freq)
+    # The series is sorted, so every period is one contiguous slice
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    counts = np.diff(np.append(starts, len(keys)))
+    sums = np.add.reduceat(series.values, starts)
+    return Envelope(
+        times=keys[starts],
+        mean=sums / counts,
+        min=np.minimum.reduceat(series.values, starts),
+        max=np.maximum.reduceat(series.values, starts),
+        count=counts
+    )
+
+
+def rolling_mean(series: Series, window_days: float) -> np.ndarray:
+    """Mean of the measurements in the window_days before (and including) every measurement."""
+    seconds = series.times.astype(np.int64)
+    cumulative = np.concatenate(([0.0], np.cumsum(series.values)))
+    first = np.searchsorted(seconds, seconds - window_days * DAY, side="left")
+    last = np.arange(1, len(seconds) + 1)
+    return (cumulative[last] - cumulative[first]) / (last - first)
+
+
+def lttb(times: np.ndarray, values: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets downsampling.
+
+    Keeps the points that matter most for the shape of the line, so a chart
+    of years of measurements needs only n_out points.
+
+    Args:
+        times: Times, sorted (datetime64 or numbers)
+        values: Values
+        n_out: Number of points to keep
+
+    Returns:
+        Indices of the points to keep
+    """
+    n = len(values)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = times.astype(np.int64).astype(np.float64)
+    y = np.asarray(values, dtype=np.float64)
+
+    # First and last point are always kept, the rest is divided into buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket is the third point of the triangle
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        areas = np.abs(
+            (x[previous] - avg_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (avg_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+
+    return selected
+
+
+def downsample(series: Series, n_out: int) -> Series:
+    """Downsample a series to at most n_out points with LTTB."""
+    keep = lttb(series.times, series.values, n_out)
+    return Series(series.times[keep], series.values[keep])
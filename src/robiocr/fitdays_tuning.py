@@ -0,0 +1,392 @@
+""" Tune the preprocessing recipes of the general measurements on a labeled corpus.
+
+Every combination of color conversion, scale, blur, threshold and Tesseract
+page segmentation mode in the grid is rendered and OCRed on every image of
+the corpus, with the images spread over all cores. For every recipe the OCR
+time and the share of labeled fields that were read correctly are measured.
+
+The report lists the recipes on the Pareto frontier: those for which no other
+recipe is both faster and more accurate. The recommended chain starts with the
+fastest recipe that meets the accuracy target; fallbacks are added for the
+images on which it doesn't find the key measurements, as long as they improve
+the accuracy of the chain. The chain is written to a JSON file that the
+extractor loads (--recipes, RECIPES_FILE).
+
+The corpus is a folder with images and a labels.json with the correct values
+per image, by the column names of the measurement profile:
+
+    {"IMG_1234.jpeg": {"Gewicht": "82.4", "BMI": "24.1", "Lichaamsvet": "21.3"}}
+
+    python -m robiocr.fitdays_tuning /Volumes/backup/Health/corpus --target 0.98
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from itertools import product
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from robiocr.extract_fitdays import LOG_FORMAT, PROFILES_FOLDER, RECIPES_FILE, PreprocessingEngine, PreprocessingRecipe
+from robiocr.fitdays_ocr import lines_to_text, ocr_lines
+from robiocr.fitdays_profiles import MeasurementProfile, ProfileRegistry
+from robiocr.fitdays_record import parse_number
+
+logger = logging.getLogger(__name__)
+
+LABELS_FILE = "labels.json"
+ACCURACY_TARGET = 0.98
+MAX_CHAIN = 3
+# Block size of the adaptive thresholds in the grid
+ADAPTIVE_BLOCK = 31
+# Maximum height of an OCR block before scaling, like MeasurementExtractor._ocr_blocks
+MAX_BLOCK_HEIGHT = 400
+
+COLOR_CONVERSIONS = {"gray": cv2.COLOR_BGR2GRAY, "color": None}
+THRESHOLDS = ("none", "otsu", "adaptive")
+
+# Profiles and preprocessing of a worker process, created once by _init_worker
+_profiles: Optional[ProfileRegistry] = None
+_engine: Optional[PreprocessingEngine] = None
+_recipes: List[PreprocessingRecipe] = []
+
+
+class ImageScore(NamedTuple):
+    """Results of every recipe on one image, indexed like the recipes."""
+    image: str
+    seconds: List[float]
+    correct: List[int]
+    fields: int
+    key_found: List[bool]
+
+
+class RecipeScore(NamedTuple):
+    """Results of one recipe on the whole corpus."""
+    recipe: PreprocessingRecipe
+    accuracy: float
+    latency_ms: float
+    key_rate: float
+
+
+def recipe_grid(
+    colors: List[str],
+    scales: List[float],
+    blurs: List[int],
+    thresholds: List[str],
+    psms: List[Optional[int]]
+) -> List[PreprocessingRecipe]:
+    """All combinations of the grid values as recipes.
+
+    Thresholds need a single channel, so color recipes are only made without one.
+
+    Args:
+        colors: Names of COLOR_CONVERSIONS
+        scales: Scale factors, used for both axes
+        blurs: Gaussian blur kernel sizes, 0 for no blur
+        thresholds: Names of THRESHOLDS
+        psms: Tesseract page segmentation modes, None for the Tesseract default
+
+    Returns:
+        Recipes with a descriptive name
+    """
+    recipes = []
+    for color, scale, blur, threshold, psm in product(colors, scales, blurs, thresholds, psms):
+        if COLOR_CONVERSIONS[color] is None and threshold != "none":
+            continue
+        name = f"{color} {scale:g}x"
+        if blur:
+            name += f" blur {blur}"
+        if threshold != "none":
+            name += f" {threshold}"
+        if psm is not None:
+            name += f" psm {psm}"
+        recipes.append(PreprocessingRecipe(
+            name,
+            color_conversion=COLOR_CONVERSIONS[color],
+            xscale=scale,
+            yscale=scale,
+            apply_threshold=threshold != "none",
+            psm=psm,
+            blur=blur,
+            adaptive_block=ADAPTIVE_BLOCK if threshold == "adaptive" else 0,
+        ))
+    return recipes
+
+
+def _init_worker(profiles_path: str, recipes: List[PreprocessingRecipe]) -> None:
+    """Load the profiles and recipes of a worker process, they are reused for every image."""
+    global _profiles, _engine, _recipes
+    # One Tesseract thread per process, the images are spread over the cores
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    _profiles = ProfileRegistry.from_path(profiles_path)
+    _engine = PreprocessingEngine()
+    _recipes = recipes
+
+
+def _is_correct(value: Optional[str], label: str) -> bool:
+    """Whether an OCR value matches its label, as numbers if both are numbers."""
+    if value is None:
+        return False
+    number, expected = parse_number(value), parse_number(label)
+    if number is not None and expected is not None:
+        return abs(number - expected) < 1e-6
+    return value.strip() == str(label).strip()
+
+
+def _read_page(recipe: PreprocessingRecipe, profile: MeasurementProfile) -> Dict[str, str]:
+    """OCR the loaded page with one recipe, block by block on this core, and match the measurements."""
+    img = _engine.render(recipe)
+    blocks = _engine.split_blocks(
+        img,
+        min_gap=int(_engine.band_padding * recipe.yscale),
+        max_block_height=int(MAX_BLOCK_HEIGHT * recipe.yscale)
+    )
+    values = {}
+    for y_start, y_end in blocks:
+        for line in ocr_lines(img[y_start:y_end], config=recipe.tesseract_config):
+            for measure, value in profile.match_line(line.text):
+                values[measure.column] = value
+    return values
+
+
+def _score_image(image_path: str, labels: Dict[str, str]) -> Optional[ImageScore]:
+    """Run every recipe on one image in a worker process.
+
+    Returns:
+        Scores of the recipes, or None if the image can't be read or has no labeled measurements
+    """
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if img is None:
+        logger.warning(f"Could not read image: {image_path}")
+        return None
+
+    x_start, x_end, y_start, y_end = _profiles.default.header_box
+    profile = _profiles.detect(lines_to_text(ocr_lines(img[y_start:y_end, x_start:x_end])))
+    # Only the general measurements depend on the recipe
+    columns = {measure.column for measure in profile.measurements}
+    labels = {column: label for column, label in labels.items() if column in columns}
+    if not labels:
+        logger.warning(f"No labels of {profile.language} measurements for {image_path}")
+        return None
+
+    _engine.load(img, profile.text_region)
+    seconds, correct, key_found = [], [], []
+    for recipe in _recipes:
+        start = time.perf_counter()
+        values = _read_page(recipe, profile)
+        seconds.append(time.perf_counter() - start)
+        correct.append(sum(_is_correct(values.get(column), label) for column, label in labels.items()))
+        key_found.append(any(column in values for column in profile.key_columns))
+    return ImageScore(image_path, seconds, correct, len(labels), key_found)
+
+
+def score_corpus(
+    corpus: str,
+    labels_path: str,
+    recipes: List[PreprocessingRecipe],
+    profiles_path: str = PROFILES_FOLDER,
+    workers: Optional[int] = None
+) -> List[ImageScore]:
+    """Run every recipe on every labeled image of the corpus, on all cores.
+
+    Args:
+        corpus: Folder with the images
+        labels_path: JSON file with the correct values per image name
+        recipes: Recipes to score
+        profiles_path: Path to the measurement profiles
+        workers: Number of worker processes, defaults to the number of CPUs
+
+    Returns:
+        Scores of the images that could be read
+    """
+    with open(labels_path, encoding="utf8") as f:
+        labels = json.load(f)
+
+    # A misspelled column would silently not be scored
+    columns = {measure.column for profile in ProfileRegistry.from_path(profiles_path).profiles
+               for measure in profile.measurements}
+    unknown: Dict[str, int] = {}
+    for values in labels.values():
+        for column in values:
+            if column not in columns:
+                unknown[column] = unknown.get(column, 0) + 1
+    for column, count in sorted(unknown.items()):
+        logger.warning(f"Label '{column}' is not a measurement column of any profile and is not scored "
+                       f"(used for {count} images)")
+
+    scores = []
+    with ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count() or 1, initializer=_init_worker, initargs=(profiles_path, recipes)
+    ) as pool:
+        futures = [pool.submit(_score_image, str(Path(corpus) / name), values) for name, values in labels.items()]
+        for done, future in enumerate(as_completed(futures), start=1):
+            score = future.result()
+            if score is not None:
+                scores.append(score)
+            logger.info(f"Scored {done}/{len(futures)} images")
+    return scores
+
+
+def recipe_scores(recipes: List[PreprocessingRecipe], scores: List[ImageScore]) -> List[RecipeScore]:
+    """Accuracy, mean OCR time per image and key measurement rate of every recipe."""
+    seconds = np.array([score.seconds for score in scores])
+    correct = np.array([score.correct for score in scores])
+    fields = sum(score.fields for score in scores)
+    key_found = np.array([score.key_found for score in scores])
+    return [
+        RecipeScore(recipe, correct[:, i].sum() / fields, seconds[:, i].mean() * 1000, key_found[:, i].mean())
+        for i, recipe in enumerate(recipes)
+    ]
+
+
+def pareto_frontier(results: List[RecipeScore]) -> List[RecipeScore]:
+    """Recipes for which no other recipe is both faster and at least as accurate, fastest first."""
+    frontier = []
+    for result in sorted(results, key=lambda r: (r.latency_ms, -r.accuracy)):
+        if not frontier or result.accuracy > frontier[-1].accuracy:
+            frontier.append(result)
+    return frontier
+
+
+def chain_score(chain: List[int], scores: List[ImageScore]) -> Tuple[float, float]:
+    """Accuracy and mean OCR time per image of a recipe chain.
+
+    Like the extractor, the recipes of the chain are tried in order until one
+    finds the key measurements; the values of that attempt (or of the last
+    one) are kept.
+    """
+    correct, fields, seconds = 0, 0, 0.0
+    for score in scores:
+        for i in chain:
+            seconds += score.seconds[i]
+            if score.key_found[i]:
+                break
+        correct += score.correct[i]
+        fields += score.fields
+    return correct / fields, seconds / len(scores) * 1000
+
+
+def recommend_chain(
+    results: List[RecipeScore],
+    scores: List[ImageScore],
+    target: float = ACCURACY_TARGET,
+    max_chain: int = MAX_CHAIN
+) -> List[int]:
+    """Pick the recipe chain for the extractor.
+
+    The chain starts with the fastest recipe that meets the target on its own,
+    or the most accurate one if none does. The recipe that improves the
+    accuracy of the chain most is added as the next fallback, until nothing
+    improves it or the chain has max_chain recipes.
+
+    Returns:
+        Indexes of the recipes in the chain
+    """
+    meeting = [i for i, result in enumerate(results) if result.accuracy >= target]
+    if meeting:
+        chain = [min(meeting, key=lambda i: results[i].latency_ms)]
+    else:
+        chain = [max(range(len(results)), key=lambda i: (results[i].accuracy, -results[i].latency_ms))]
+        logger.warning(f"No recipe reaches an accuracy of {target:.1%}, starting with the most accurate one")
+
+    accuracy, _ = chain_score(chain, scores)
+    while len(chain) < max_chain:
+        candidates = [(chain_score(chain + [i], scores), i) for i in range(len(results)) if i not in chain]
+        if not candidates:
+            break
+        (new_accuracy, _), best = max(candidates, key=lambda c: (c[0][0], -c[0][1]))
+        if new_accuracy <= accuracy:
+            break
+        chain.append(best)
+        accuracy = new_accuracy
+    return chain
+
+
+def report(results: List[RecipeScore], frontier: List[RecipeScore], chain: List[int], scores: List[ImageScore]) -> str:
+    """Text report of the frontier and the recommended chain."""
+    lines = [f"Scored {len(results)} recipes on {len(scores)} images", "", "Pareto frontier (fastest first):"]
+    lines.append(f"  {'recipe':<40}{'accuracy':>10}{'ms/image':>10}{'key found':>11}")
+    for result in frontier:
+        lines.append(f"  {result.recipe.name:<40}{result.accuracy:>10.1%}{result.latency_ms:>10.0f}"
+                     f"{result.key_rate:>11.0%}")
+
+    accuracy, latency = chain_score(chain, scores)
+    lines += ["", f"Recommended chain: {accuracy:.1%} accurate, {latency:.0f} ms per image"]
+    lines += [f"  {n}. {results[i].recipe.name}" for n, i in enumerate(chain, start=1)]
+    return "\n".join(lines)
+
+
+def save_chain(
+    path: str,
+    results: List[RecipeScore],
+    frontier: List[RecipeScore],
+    chain: List[int],
+    scores: List[ImageScore],
+    target: float
+) -> None:
+    """Write the recommended chain in the format of extract_fitdays.load_recipes, with the frontier for reference."""
+    accuracy, latency = chain_score(chain, scores)
+    with open(path, "w", encoding="utf8") as f:
+        json.dump({
+            "generated": datetime.now().isoformat(timespec="seconds"),
+            "images": len(scores),
+            "accuracy_target": target,
+            "accuracy": round(accuracy, 4),
+            "latency_ms": round(latency, 1),
+            "recipes": [results[i].recipe.to_dict() for i in chain],
+            "frontier": [
+                {"recipe": r.recipe.to_dict(), "accuracy": round(r.accuracy, 4), "latency_ms": round(r.latency_ms, 1)}
+                for r in frontier
+            ],
+        }, f, indent=4)
+
+
+def main():
+    """Score the recipe grid on a corpus and write the recommended chain."""
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+    parser = argparse.ArgumentParser(description="Find the fastest preprocessing recipes that meet an accuracy target.")
+    parser.add_argument("corpus", help="Folder with the labeled images")
+    parser.add_argument("--labels", help=f"JSON file with the correct values, defaults to {LABELS_FILE} in the corpus")
+    parser.add_argument("--profiles", default=PROFILES_FOLDER, help="Measurement profile or folder with profiles")
+    parser.add_argument("--output", default=RECIPES_FILE, help="File for the recommended recipe chain")
+    parser.add_argument("--target", type=float, default=ACCURACY_TARGET, help="Share of fields that must be correct")
+    parser.add_argument("--max-chain", type=int, default=MAX_CHAIN, help="Maximum number of recipes in the chain")
+    parser.add_argument("--workers", type=int, help="Worker processes, defaults to the number of CPUs")
+    parser.add_argument("--colors", nargs="+", default=list(COLOR_CONVERSIONS), choices=list(COLOR_CONVERSIONS))
+    parser.add_argument("--scales", nargs="+", type=float, default=[1.0, 1.5, 1.7, 2.0])
+    parser.add_argument("--blurs", nargs="+", type=int, default=[0, 3], help="Gaussian kernel sizes, 0 for none")
+    parser.add_argument("--thresholds", nargs="+", default=list(THRESHOLDS), choices=THRESHOLDS)
+    parser.add_argument("--psms", nargs="+", default=["default", "6", "4"],
+                        help="Tesseract page segmentation modes, 'default' for none")
+    args = parser.parse_args()
+    if any(blur and blur % 2 == 0 for blur in args.blurs):
+        parser.error("Blur kernel sizes must be odd")
+
+    recipes = recipe_grid(
+        args.colors, args.scales, args.blurs, args.thresholds,
+        [None if psm == "default" else int(psm) for psm in args.psms]
+    )
+    logger.info(f"Scoring {len(recipes)} recipes")
+    scores = score_corpus(args.corpus, args.labels or str(Path(args.corpus) / LABELS_FILE), recipes,
+                          args.profiles, args.workers)
+    if not scores:
+        logger.error("No labeled images could be scored")
+        return
+
+    results = recipe_scores(recipes, scores)
+    frontier = pareto_frontier(results)
+    chain = recommend_chain(results, scores, args.target, args.max_chain)
+    print(report(results, frontier, chain, scores))
+    save_chain(args.output, results, frontier, chain, scores, args.target)
+    logger.info(f"Recipe chain saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+""" Tests of the upload service, with a fake OCR backend instead of Tesseract.
+
+Run from the root of the repository:
+
+    python -m unittest discover tests
+"""
+import functools
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from robiocr.extract_fitdays import MeasurementExtractor, decode_image  # noqa: E402
+from robiocr.fitdays_ocr import OcrLine, Word  # noqa: E402
+from robiocr.fitdays_server import IngestHandler, IngestService  # noqa: E402
+
+# Text the fake backend reads in the header and the measurements
+FAKE_PAGE = ["Marcel-Jan", "08:15 01/02/2024", "Gewicht 82.4kg", "BMI 24.1", "BMR 1750kcal"]
+# Text the fake backend reads in a box with a single number
+FAKE_NUMBER = ["31.2kg"]
+
+
+def fake_ocr(img: np.ndarray, config: str = "", y_offset: int = 0) -> List[OcrLine]:
+    """OCR backend that reads the same page from every image."""
+    texts = FAKE_NUMBER if "--psm 7" in config else FAKE_PAGE
+    return [OcrLine([Word(word, 90.0, 0, y_offset, 10, 10) for word in text.split()]) for text in texts]
+
+
+# Upload that makes the worker process exit, like a worker killed for using too much memory
+CRASH = b"crash"
+
+
+def slow_decode(data: bytes, grayscale: bool, delay: float = 0.0) -> Optional[np.ndarray]:
+    """Decoder that takes its time, to keep a worker busy."""
+    if data == CRASH:
+        os._exit(1)
+    time.sleep(delay)
+    return decode_image(data, grayscale)
+
+
+def fake_extractor(delay: float = 0.0) -> MeasurementExtractor:
+    """Extractor of a worker process, with the fake OCR backend and without outputs."""
+    return MeasurementExtractor(
+        decoder=functools.partial(slow_decode, delay=delay), ocr=fake_ocr, recipes_path=None, sinks=[]
+    )
+
+
+def image(number: int) -> bytes:
+    """PNG of the size of a Fitdays image, with a header that differs per number."""
+    img = np.full((6200, 1290), 255, dtype=np.uint8)
+    cv2.putText(img, f"{number:04d}", (100, 300), cv2.FONT_HERSHEY_SIMPLEX, 8, 0, 20)
+    # Lines of text in the measurements, the preprocessing only keeps the rows with text
+    for y in range(600, 3800, 200):
+        cv2.putText(img, "Gewicht 82.4kg", (100, y), cv2.FONT_HERSHEY_SIMPLEX, 3, 0, 6)
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+class IngestServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.folder.name, "measurements.db")
+        self.services = []
+
+    def tearDown(self):
+        for service in self.services:
+            service.close()
+        self.folder.cleanup()
+
+    def start(self, delay: float = 0.0, **kwargs) -> IngestService:
+        service = IngestService(
+            profiles_path=str(Path(__file__).resolve().parent.parent / "src" / "robiocr" / "profiles"),
+            extractor_factory=functools.partial(fake_extractor, delay=delay),
+            **kwargs
+        )
+        self.services.append(service)
+        return service
+
+    def record_batches(self, service: IngestService) -> List[int]:
+        """Sizes of the micro-batches the dispatcher hands to the workers."""
+        sizes = []
+        submit = service.pool.submit
+
+        def recording_submit(fn, images):
+            sizes.append(len(images))
+            return submit(fn, images)
+
+        service.pool.submit = recording_submit
+        return sizes
+
+    def test_uploads_are_batched(self):
+        service = self.start(workers=1, batch_size=3, batch_wait=1.0)
+        sizes = self.record_batches(service)
+
+        results = [service.submit(f"IMG_{n}.jpeg", image(n)) for n in range(3)]
+        responses = [result.result(timeout=60) for result in results]
+
+        self.assertEqual(sizes, [3])
+        for response in responses:
+            self.assertEqual(response["language"], "nl")
+            self.assertEqual(response["values"]["Gewicht"], "82.4")
+            self.assertEqual(response["values"]["Username"], "Marcel-Jan")
+
+    def test_workers_are_restarted(self):
+        service = self.start(workers=1, batch_size=1)
+
+        crashed = service.submit("IMG_1.jpeg", CRASH).result(timeout=60)
+        self.assertIn("BrokenProcessPool", crashed["error"])
+
+        response = service.submit("IMG_2.jpeg", image(2)).result(timeout=60)
+        self.assertEqual(response["values"]["Gewicht"], "82.4")
+
+    def test_full_queue_answers_503(self):
+        service = self.start(delay=2.0, workers=1, queue_size=1, batch_size=1)
+        service.submit("IMG_1.jpeg", image(1))
+        # Wait until the worker has the first upload, the second one then fills the queue
+        deadline = time.monotonic() + 30
+        while service.uploads.qsize() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNotNone(service.submit("IMG_2.jpeg", image(2)))
+
+        handler = type("Handler", (IngestHandler,), {"service": service, "log_message": lambda *args: None})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            connection = HTTPConnection(*server.server_address, timeout=30)
+            connection.request("POST", "/measurements?name=IMG_3.jpeg", body=image(3))
+            response = connection.getresponse()
+            body = json.loads(response.read())
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.getheader("Retry-After"), "1")
+        self.assertIn("error", body)
+
+    def test_save_skips_copies(self):
+        service = self.start(db_path=self.db_path, workers=1, batch_size=3, batch_wait=1.0)
+        sizes = self.record_batches(service)
+
+        # Two copies of the same image in one micro-batch, and another image
+        results = [service.submit(name, image(n)) for name, n in (("IMG_1.jpeg", 1), ("IMG_2.jpeg", 1),
+                                                                     ("IMG_3.jpeg", 2))]
+        first, copy, other = [result.result(timeout=60) for result in results]
+        self.assertEqual(sizes, [3])
+        self.assertIn("measurement_id", first)
+        self.assertIn("measurement_id", other)
+        self.assertNotIn("measurement_id", copy)
+        self.assertEqual(copy["duplicate_of"], first["measurement_id"])
+
+        # A copy in a later micro-batch is found in the database
+        later = service.submit("IMG_4.jpeg", image(1)).result(timeout=60)
+        self.assertEqual(later["duplicate_of"], first["measurement_id"])
+
+        service.close()
+        self.services.remove(service)
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute("SELECT COUNT(*) FROM measurements").fetchone()[0]
+        conn.close()
+        self.assertEqual(count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()